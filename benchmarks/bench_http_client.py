@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Benchmark: shared pooled HTTP client vs. a new client per call
+
+Runs make_usda_request against a local mock transport that charges a
+simulated connection setup cost (DNS + TCP + TLS) for every new connection
+and a smaller cost per request. No network access or API key is needed.
+
+Usage:
+    uv run benchmarks/bench_http_client.py [--calls 200] [--concurrency 10]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+# FastMCP logs every httpx request at INFO; keep benchmark output readable
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+SAMPLE_FOOD = {
+    "fdcId": 171705,
+    "description": "Broccoli, raw",
+    "dataType": "SR Legacy",
+    "foodNutrients": [
+        {"nutrient": {"name": "Energy", "unitName": "kcal"}, "amount": 34},
+        {"nutrient": {"name": "Protein", "unitName": "g"}, "amount": 2.82}
+    ]
+}
+
+class SimulatedNetworkTransport(httpx.AsyncBaseTransport):
+    """Mock FDC transport that models connection reuse.
+
+    A request either reuses an idle keep-alive connection or pays the
+    handshake latency to open a new one.
+    """
+
+    def __init__(self, handshake_latency: float, request_latency: float):
+        self.handshake_latency = handshake_latency
+        self.request_latency = request_latency
+        self.idle_connections = 0
+        self.handshakes = 0
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.idle_connections:
+            self.idle_connections -= 1
+        else:
+            self.handshakes += 1
+            await asyncio.sleep(self.handshake_latency)
+        await asyncio.sleep(self.request_latency)
+        self.requests += 1
+        self.idle_connections += 1
+        return httpx.Response(200, json=SAMPLE_FOOD, request=request)
+
+async def per_call_client(endpoint: str, transport_factory) -> dict:
+    """The pre-pooling behaviour: a fresh AsyncClient for every call."""
+    url = f"{main.USDA_API_BASE}/{endpoint}"
+    async with httpx.AsyncClient(transport=transport_factory()) as client:
+        response = await client.get(url, params={"api_key": main.API_KEY}, timeout=30.0)
+        response.raise_for_status()
+        return response.json()
+
+async def run_calls(call, calls: int, concurrency: int) -> list[float]:
+    """Issue `calls` requests with at most `concurrency` in flight; return latencies."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await call(f"fdc/v1/food/{171705 + i % 5}")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return latencies
+
+def summarize(latencies: list[float], elapsed: float, handshakes: int) -> dict:
+    """Reduce raw latencies to the numbers we compare."""
+    ordered = sorted(latencies)
+    return {
+        "calls": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p95_ms": round(ordered[int(len(ordered) * 0.95) - 1] * 1000, 3),
+        "wall_s": round(elapsed, 3),
+        "handshakes": handshakes
+    }
+
+async def main_async(args) -> dict:
+    main.API_KEY = main.API_KEY or "benchmark-key"
+    # Measure connection handling only, not the response caches or quota pacing
+    main.CACHE_ENABLED = False
+    main.DISK_CACHE_ENABLED = False
+    main.RATE_LIMIT_ENABLED = False
+
+    # Baseline: new client (and therefore new connection) per call
+    baseline_transports = []
+
+    def factory():
+        transport = SimulatedNetworkTransport(args.handshake_ms / 1000, args.request_ms / 1000)
+        baseline_transports.append(transport)
+        return transport
+
+    start = time.perf_counter()
+    latencies = await run_calls(lambda ep: per_call_client(ep, factory), args.calls, args.concurrency)
+    baseline = summarize(latencies, time.perf_counter() - start,
+                         sum(t.handshakes for t in baseline_transports))
+
+    # Shared client: one pooled client for the whole run
+    shared_transport = SimulatedNetworkTransport(args.handshake_ms / 1000, args.request_ms / 1000)
+    main._http_transport = shared_transport
+    await main.close_http_client()
+    start = time.perf_counter()
+    latencies = await run_calls(main.make_usda_request, args.calls, args.concurrency)
+    shared = summarize(latencies, time.perf_counter() - start, shared_transport.handshakes)
+    await main.close_http_client()
+
+    return {
+        "settings": vars(args),
+        "per_call_client": baseline,
+        "shared_client": shared,
+        "mean_saving_ms": round(baseline["mean_ms"] - shared["mean_ms"], 3)
+    }
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--handshake-ms", type=float, default=60.0,
+                        help="Simulated DNS+TCP+TLS cost per new connection")
+    parser.add_argument("--request-ms", type=float, default=15.0,
+                        help="Simulated server time per request")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(main_async(parse_args())), indent=2))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: cached food records as decoded dicts vs. the compact FoodMatrix
+
+Fills the in-memory response cache with mock food records (decoded from
+JSON, as they arrive from USDA) and reports the bytes allocated per food
+with and without USDA_CACHE_COMPACT_FOODS. Holding every record as a dict
+takes gigabytes at 100k foods, so that side is measured on a sample and
+scaled linearly; the compact side is measured at full size.
+
+Usage:
+    uv run --extra numpy benchmarks/bench_memory.py --foods 100000 --output memory.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+from mock_fdc import make_food  # noqa: E402
+
+def fill_cache(count: int, compact: bool, seed: int) -> int:
+    """Cache `count` foods; return the bytes still allocated afterwards."""
+    rng = random.Random(seed)
+    gc.collect()
+    tracemalloc.start()
+    cache = main.ResponseCache(max_entries=count + 1, max_bytes=1 << 62, compact=compact)
+    for fdc_id in range(100000, 100000 + count):
+        body = json.dumps(make_food(fdc_id, rng)).encode()
+        cache.set(main.food_cache_key(fdc_id), json.loads(body), 3600, len(body))
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--foods", type=int, default=100000, help="Foods cached in compact form")
+    parser.add_argument("--sample", type=int, default=5000, help="Foods cached as dicts (scaled to --foods)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if main.np is None:
+        sys.exit("numpy is required: uv sync --extra numpy")
+    sample = min(args.sample, args.foods)
+    dict_bytes = fill_cache(sample, compact=False, seed=args.seed)
+    compact_bytes = fill_cache(args.foods, compact=True, seed=args.seed)
+    dict_per_food = dict_bytes / sample
+    compact_per_food = compact_bytes / args.foods
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": vars(args)
+        },
+        "results": {
+            "dict_bytes_per_food": round(dict_per_food),
+            "compact_bytes_per_food": round(compact_per_food),
+            "reduction": round(dict_per_food / compact_per_food, 1),
+            "dict_mb_at_foods": round(dict_per_food * args.foods / 2**20, 1),
+            "compact_mb_at_foods": round(compact_bytes / 2**20, 1)
+        }
+    }
+    print(f"dict {report['results']['dict_bytes_per_food']} B/food, "
+          f"compact {report['results']['compact_bytes_per_food']} B/food "
+          f"({report['results']['reduction']}x smaller)", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
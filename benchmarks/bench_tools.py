@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: every MCP tool against a local mock FoodData Central
+
+Each tool is driven at several concurrency levels with a skewed (Zipf-like)
+workload, as an assistant session would produce. For every run the suite
+reports p50/p95/p99 latency, throughput, upstream calls (in total and per
+tool call, e.g. per 50-ingredient recipe) and peak RSS, and emits JSON so
+results can be compared between releases.
+
+Usage:
+    uv run benchmarks/bench_tools.py --concurrency 1,8,32 --requests 300 \\
+        --latency-ms 80 --error-rate 0.02 --output bench.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+from mock_fdc import FOOD_WORDS, PREPARATIONS, MockFDC  # noqa: E402
+
+# nutrient_names filters typical of "how much X is in Y" questions
+NUTRIENT_QUERIES = ["protein", "energy,protein,total lipid", "calcium,iron", "vitamin c", "fiber,sugars", "sodium"]
+
+# Quantities of recipe ingredients: weights and the household measures every mock food has
+RECIPE_QUANTITIES = ["100 g", "250 g", "1 cup", "2 tbsp", "3 oz", "1 serving", "0.5 lb"]
+RECIPE_INGREDIENTS = 50
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("usda-api").setLevel(logging.ERROR)
+
+def zipf_sampler(rng: random.Random, items: list, skew: float = 1.1):
+    """Return a function picking items with probability proportional to 1 / rank**skew."""
+    cum_weights = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, len(items) + 1)))
+    return lambda: rng.choices(items, cum_weights=cum_weights)[0]
+
+def make_workloads(fdc: MockFDC, rng: random.Random, output_format: str = "text") -> dict:
+    """Map tool name -> factory returning one coroutine call of that tool."""
+    pick_id = zipf_sampler(rng, fdc.fdc_ids)
+    pick_word = zipf_sampler(rng, FOOD_WORDS)
+    pick_nutrients = zipf_sampler(rng, NUTRIENT_QUERIES)
+    fmt = {"output_format": output_format}
+
+    def recipe() -> str:
+        # Distinct foods, as a long recipe or a day of meals would list them
+        return ", ".join(f"{fdc_id}:{rng.choice(RECIPE_QUANTITIES)}"
+                         for fdc_id in rng.sample(fdc.fdc_ids, RECIPE_INGREDIENTS))
+
+    async def search_then_details() -> str:
+        # The usual assistant pattern: search, then open one of the top hits
+        hits = json.loads(await main.search_foods(pick_word(), page_size=25, output_format="json"))["foods"]
+        if not hits:
+            return "No foods found"
+        await asyncio.sleep(0.05)  # the model reads the results
+        return await main.get_food_details(rng.choice(hits[:3])["fdc_id"], **fmt)
+
+    return {
+        "search_foods": lambda: main.search_foods(pick_word(), page_size=25, **fmt),
+        "get_food_details": lambda: main.get_food_details(pick_id(), **fmt),
+        "get_food_nutrients": lambda: main.get_food_nutrients(pick_id(), **fmt),
+        "get_food_nutrients_filtered": lambda: main.get_food_nutrients(pick_id(), pick_nutrients(), **fmt),
+        "get_multiple_foods": lambda: main.get_multiple_foods(
+            ",".join(str(pick_id()) for _ in range(10)), **fmt),
+        "list_foods": lambda: main.list_foods(page_size=50, page_number=rng.randint(1, 20), **fmt),
+        "search_then_details": search_then_details,
+        "search_foods_batch": lambda: main.search_foods_batch(
+            "; ".join(pick_word() for _ in range(10)), **fmt),
+        f"compute_recipe_nutrients_{RECIPE_INGREDIENTS}": lambda: main.compute_recipe_nutrients(recipe(), servings=4, **fmt),
+        "list_foods_paginated": lambda: main.list_foods(max_results=1000, page_number=rng.randint(1, 5), **fmt)
+    }
+
+def reset_server_state(fdc: MockFDC, cache: bool, prefetch: bool = False) -> None:
+    """Give each run a cold server: fresh caches, counters and client."""
+    main._http_transport = fdc.transport()
+    main._http_client = None
+    main.CACHE_ENABLED = cache
+    main.DISK_CACHE_ENABLED = False
+    main.RATE_LIMIT_ENABLED = False
+    main.RETRY_BASE_DELAY = 0.01
+    main.response_cache = main.ResponseCache()
+    main.singleflight = main.SingleFlight()
+    main.cache_refresher = main.CacheRefresher()
+    main.result_ranges = main.ResultRangeCache()
+    main.negative_cache = main.NegativeCache()
+    main.circuit_breaker = main.CircuitBreaker()
+    main.upstream_latency = main.LatencyTracker()
+    main.metrics = main.Metrics()
+    main.PREFETCH_ENABLED = prefetch
+    main.prefetcher = main.Prefetcher()
+    # Rate limiting is off in benchmarks, so lift the prefetch budget as well
+    main.prefetcher.budget = main.RateLimiter(per_hour=1e9, burst=1e9)
+    fdc.reset_counters()
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+def percentile(ordered: list[float], pct: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def run_tool(call_factory, requests: int, concurrency: int) -> tuple[list[float], int, int, float]:
+    """Run `requests` tool calls with `concurrency` workers.
+
+    Returns latencies, the error count, total response characters and wall time.
+    """
+    latencies: list[float] = []
+    errors = 0
+    chars = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, chars
+        for _ in remaining:
+            start = time.perf_counter()
+            result = await call_factory()
+            latencies.append(time.perf_counter() - start)
+            chars += len(result)
+            if result.startswith("Error"):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, chars, time.perf_counter() - start
+
+def bucket_excess(call_times: list[float], rate: float, burst: float) -> float:
+    """Most calls in any interval beyond what a token bucket of `rate`/s and `burst` allows.
+    
+    At most 0 when the calls respected the limit; below 1 when the excess is
+    only timing noise between taking a token and the call reaching the mock.
+    """
+    return max((j - i + 1 - burst - rate * (call_times[j] - call_times[i])
+                for i in range(len(call_times)) for j in range(i, len(call_times))), default=0.0)
+
+async def compare_batch_search(fdc: MockFDC, args) -> dict:
+    """search_foods_batch against the same queries as sequential search_foods calls.
+    
+    Both run on a cold cache under a rate limit of --batch-rate requests per
+    second (burst --batch-burst), tight enough that the batch has to queue
+    for tokens; the upstream call times are checked against the limit.
+    """
+    rng = random.Random(args.seed)
+    queries = [f"{word} {preparation}" for word, preparation in
+               rng.sample(list(itertools.product(FOOD_WORDS, PREPARATIONS)), args.batch_queries)]
+
+    async def sequential() -> None:
+        for query in queries:
+            await main.search_foods(query, page_size=5)
+
+    async def batch() -> None:
+        await main.search_foods_batch("; ".join(queries), page_size=5)
+
+    report: dict = {"queries": len(queries), "rate_per_s": args.batch_rate, "burst": args.batch_burst}
+    for mode, run in (("sequential", sequential), ("batch", batch)):
+        reset_server_state(fdc, cache=True)
+        main.RATE_LIMIT_ENABLED = True
+        main.rate_limiter = main.RateLimiter(per_hour=args.batch_rate * 3600, burst=args.batch_burst)
+        start = time.perf_counter()
+        await run()
+        wall = time.perf_counter() - start
+        await main.close_http_client()
+        limiter = main.rate_limiter.stats()
+        excess = bucket_excess(fdc.call_times, args.batch_rate, args.batch_burst)
+        report[mode] = {
+            "wall_ms": round(wall * 1000, 1),
+            "upstream_calls": sum(fdc.calls.values()),
+            "limiter_queued": limiter["queued"],
+            "limiter_rejected": limiter["rejected"],
+            "bucket_excess": round(excess, 2),
+            "rate_limit_respected": excess < 1
+        }
+        print(f"{mode:>20} queries={len(queries)} wall={report[mode]['wall_ms']:>8}ms "
+              f"upstream={report[mode]['upstream_calls']} queued={limiter['queued']} "
+              f"respected={report[mode]['rate_limit_respected']}", file=sys.stderr)
+    report["speedup"] = round(report["sequential"]["wall_ms"] / report["batch"]["wall_ms"], 2)
+    return report
+
+async def run_suite(args) -> dict:
+    main.API_KEY = main.API_KEY or "benchmark-key"
+    main.BACKEND = "api"
+    main.LOCAL_SEARCH = False
+    fdc = MockFDC(foods=args.foods, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                  error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                  bandwidth_mbps=args.bandwidth_mbps, seed=args.seed)
+    tools = args.tools.split(",") if args.tools else None
+    results = []
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        rng = random.Random(args.seed)
+        workloads = make_workloads(fdc, rng, args.output_format)
+        for tool, call_factory in workloads.items():
+            if tools and tool not in tools:
+                continue
+            reset_server_state(fdc, cache=not args.no_cache, prefetch=args.prefetch)
+            latencies, errors, chars, wall = await run_tool(call_factory, args.requests, concurrency)
+            await main.close_http_client()
+            ordered = sorted(latencies)
+            results.append({
+                "tool": tool,
+                "concurrency": concurrency,
+                "requests": len(ordered),
+                "errors": errors,
+                "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+                "throughput_rps": round(len(ordered) / wall, 1),
+                "mean_response_chars": round(chars / len(ordered)),
+                "upstream_calls": sum(fdc.calls.values()),
+                "upstream_calls_per_request": round(sum(fdc.calls.values()) / len(ordered), 2),
+                "upstream_bytes": fdc.bytes_sent,
+                "coalesced": main.singleflight.coalesced,
+                "prefetch_use_ratio": main.prefetcher.stats()["use_ratio"],
+                "cache_hit_ratio": main.response_cache.stats()["hit_ratio"],
+                "peak_rss_mb": peak_rss_mb()
+            })
+            print(f"{tool:>20} c={concurrency:<3} p50={results[-1]['p50_ms']:>8}ms "
+                  f"p99={results[-1]['p99_ms']:>8}ms {results[-1]['throughput_rps']:>8} rps "
+                  f"upstream={results[-1]['upstream_calls']}", file=sys.stderr)
+    batch_search = None
+    if not tools or "search_foods_batch" in tools:
+        batch_search = await compare_batch_search(fdc, args)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": vars(args)
+        },
+        "results": results,
+        "batch_vs_sequential_search": batch_search
+    }
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=300, help="Tool calls per tool and concurrency level")
+    parser.add_argument("--tools", default="", help="Comma-separated subset of tools to run")
+    parser.add_argument("--foods", type=int, default=2000, help="Foods served by the mock")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="Mean upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=40.0, help="Uniform latency jitter")
+    parser.add_argument("--bandwidth-mbps", type=float, default=20.0, help="Simulated transfer rate (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of 429 responses")
+    parser.add_argument("--output-format", default="text", choices=main.OUTPUT_FORMATS,
+                        help="output_format passed to every tool")
+    parser.add_argument("--batch-queries", type=int, default=20,
+                        help="Queries in the search_foods_batch vs. sequential search_foods comparison")
+    parser.add_argument("--batch-rate", type=float, default=20.0, help="Rate limit (requests/s) for that comparison")
+    parser.add_argument("--batch-burst", type=float, default=5.0, help="Rate limit burst for that comparison")
+    parser.add_argument("--prefetch", action="store_true", help="Enable speculative prefetch of top search hits")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the response cache")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run_suite(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Ingest check: load the sample bulk downloads in fixtures/ into a fresh store
+
+Ingests the JSON sample (as a file and as a zip) and the CSV sample (as a
+directory and as a zip) into temporary LocalFoodStores and checks row
+counts and the assembled records: nutrients with empty amounts and
+unsupported data types are skipped, portions and branded fields are joined,
+and data type filters match by prefix.
+The JSON sample is also streamed in tiny chunks, so that values containing
+brackets, braces and quotes straddle chunk boundaries. Exits non-zero on
+the first mismatch.
+
+Usage:
+    uv run benchmarks/check_ingest.py
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+JSON_SAMPLE = FIXTURES / "foundation_sample.json"
+CSV_SAMPLE = FIXTURES / "csv_sample"
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        sys.exit(f"FAIL: {message}")
+    print(f"ok   {message}", file=sys.stderr)
+
+def ingest(path: Path, workdir: Path) -> main.LocalFoodStore:
+    """Ingest one download into a new store; check the count it reports against the stored rows."""
+    store = main.LocalFoodStore(workdir / f"{path.name}.sqlite3", readonly=False)
+    count = main.ingest_bulk_download(path, store)
+    check(count == len(store), f"{path.name}: reported {count} foods, stored {len(store)}")
+    return store
+
+def zip_of(path: Path, workdir: Path) -> Path:
+    """Zip a file, or a directory's files under a top-level folder as the USDA downloads do."""
+    archive = workdir / f"{path.stem}.zip"
+    with zipfile.ZipFile(archive, "w") as out:
+        if path.is_dir():
+            for member in sorted(path.iterdir()):
+                out.write(member, f"{path.name}/{member.name}")
+        else:
+            out.write(path, path.name)
+    return archive
+
+def check_json(workdir: Path) -> None:
+    expected = json.loads(JSON_SAMPLE.read_text(encoding="utf-8"))["FoundationFoods"]
+    with open(JSON_SAMPLE, encoding="utf-8") as stream:
+        streamed = list(main.iter_json_array_items(stream, chunk_size=16))
+    check(streamed == expected, "JSON streamed in 16-character chunks matches json.load")
+    bare = io.StringIO(json.dumps(expected))
+    check(list(main.iter_json_array_items(bare, chunk_size=16)) == expected, "bare top-level JSON array")
+
+    for path in (JSON_SAMPLE, zip_of(JSON_SAMPLE, workdir)):
+        store = ingest(path, workdir)
+        check(len(store) == 3, f"{path.name}: 3 foods")
+        cheese = store.get_food(2346384)
+        check(cheese is not None and cheese["description"] == expected[1]["description"],
+              f"{path.name}: description with quotes and brackets kept")
+        check(len(store.get_food(2344719)["foodNutrients"]) == 3, f"{path.name}: 3 nutrients for 2344719")
+        store.close()
+
+def check_csv(workdir: Path) -> None:
+    for path in (CSV_SAMPLE, zip_of(CSV_SAMPLE, workdir)):
+        store = ingest(path, workdir)
+        check(len(store) == 3, f"{path.name}: 3 foods (sub_sample_food skipped)")
+        check(store.get_food(1105905) is None, f"{path.name}: unsupported data type not stored")
+        biscuits = store.get_food(167512)
+        check(len(biscuits["foodNutrients"]) == 3, f"{path.name}: 3 nutrients for 167512")
+        check(biscuits["foodCategory"] == {"description": "Baked Products"}, f"{path.name}: category joined")
+        check(biscuits["foodPortions"][0]["measureUnit"]["name"] == "undetermined", f"{path.name}: measure unit joined")
+        rolls = store.get_food(167513)
+        check(len(rolls["foodNutrients"]) == 2, f"{path.name}: nutrient with empty amount skipped")
+        check([p["gramWeight"] for p in rolls["foodPortions"]] == [44.0, 351.0], f"{path.name}: 2 portions for 167513")
+        energy = next(n for n in rolls["foodNutrients"] if n["nutrient"]["number"] == "208")
+        check(energy["nutrient"]["unitName"] == "kcal", f"{path.name}: CSV unit names mapped")
+        oil = store.get_food(1105904)
+        check(oil["brandOwner"].startswith("Richardson") and oil["servingSize"] == 15.0,
+              f"{path.name}: branded fields joined")
+        check("foodPortions" not in oil, f"{path.name}: no portions for a food without any")
+        check_data_type_filter(store, path.name)
+        store.close()
+
+def check_data_type_filter(store: main.LocalFoodStore, name: str) -> None:
+    """Data types match by prefix, case-insensitively, as against the API."""
+    for data_type, expected in (("SR Legacy", 2), ("sr", 2), ("Branded,SR", 3), ("SR_Legacy", 0), ("Survey", 0)):
+        listed = store.request("fdc/v1/foods/list", {"dataType": data_type, "pageSize": 50})
+        found = store.request("fdc/v1/foods/search", {"query": "", "dataType": data_type, "pageSize": 50})
+        check(len(listed) == expected and found["totalHits"] == expected,
+              f"{name}: dataType {data_type!r} matches {expected} foods")
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        check_json(Path(tmp))
+        check_csv(Path(tmp))
+    print("All ingest checks passed", file=sys.stderr)
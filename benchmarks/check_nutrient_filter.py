@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Nutrient filter check: get_food_nutrients gives the same answer on a cold and a warm cache
+
+On a cold cache a nutrient_names filter may be narrowed to a projected
+request for the matching nutrient numbers; on a warm cache the full cached
+record is filtered instead. The two must agree, including for nutrients
+that NUTRIENT_TABLE does not list (adjusted protein, iodine, "Total
+Sugars"), and common filters such as "protein" must still be projected.
+Runs every filter both ways against a local stand-in for the API and exits
+non-zero on the first difference.
+
+Usage:
+    uv run benchmarks/check_nutrient_filter.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import parse_qs
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+FDC_ID = 1234
+
+# (id, number, name, unit, amount), names as FDC currently publishes them
+NUTRIENTS = [
+    (1008, "208", "Energy", "kcal", 364.0),
+    (2048, "958", "Energy (Atwater Specific Factors)", "kcal", 361.0),
+    (1003, "203", "Protein", "g", 10.3),
+    (1002, "257", "Adjusted Protein", "g", 10.1),
+    (1004, "204", "Total lipid (fat)", "g", 0.98),
+    (1085, "298", "Total fat (NLEA)", "g", 0.85),
+    (1005, "205", "Carbohydrate, by difference", "g", 76.3),
+    (1079, "291", "Fiber, total dietary", "g", 2.7),
+    (2033, "293", "Total dietary fiber (AOAC 2011.25)", "g", 3.1),
+    (1082, "295", "Fiber, soluble", "g", 0.9),
+    (1084, "297", "Fiber, insoluble", "g", 1.8),
+    (2000, "269", "Total Sugars", "g", 0.27),
+    (1087, "301", "Calcium, Ca", "mg", 15.0),
+    (1089, "303", "Iron, Fe", "mg", 1.17),
+    (1100, "314", "Iodine, I", "µg", 2.0),
+    (1162, "401", "Vitamin C, total ascorbic acid", "mg", 0.1),
+    (1185, "430", "Vitamin K (phylloquinone)", "µg", 0.3),
+    (1183, "428", "Vitamin K (Menaquinone-4)", "µg", 0.1),
+    (1184, "429", "Vitamin K (Dihydrophylloquinone)", "µg", 0.2),
+    (1258, "606", "Fatty acids, total saturated", "g", 0.16),
+    (1329, "693", "Fatty acids, total trans-monoenoic", "g", 0.01),
+    (1331, "694", "Fatty acids, total trans-dienoic", "g", 0.02)
+]
+
+FILTERS = ["fiber", "vitamin k", "protein", "sugars", "energy", "fat", "iron", "calcium",
+           "calcium,vitamin c", "Energy,Protein,Total lipid", "trans", "menaquinone", "caffeine",
+           "iodine", "adjusted protein", "total sugars", "protein,iodine"]
+
+# Filters naming a nutrient outside the table need the full record; every
+# other filter is projected on a cold cache
+FULL_RECORD = {"iodine", "adjusted protein", "total sugars", "protein,iodine"}
+
+# Filters matching no nutrient of the food
+EMPTY = {"caffeine"}
+
+def food_record(numbers: set[str] | None = None) -> dict:
+    return {
+        "fdcId": FDC_ID,
+        "description": "Wheat flour, white, all-purpose, unenriched",
+        "dataType": "SR Legacy",
+        "foodNutrients": [
+            {"nutrient": {"id": nid, "number": number, "name": name, "unitName": unit}, "amount": amount}
+            for nid, number, name, unit, amount in NUTRIENTS
+            if numbers is None or number in numbers
+        ]
+    }
+
+class StandIn:
+    """Serves one food, honouring the nutrients= projection; records each query."""
+
+    def __init__(self):
+        self.queries: list[dict[str, list[str]]] = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        params = parse_qs(request.url.query.decode())
+        self.queries.append(params)
+        if not request.url.path.endswith(f"/food/{FDC_ID}"):
+            return httpx.Response(404, json={"error": "not found"})
+        numbers = set(params["nutrients"][0].split(",")) if "nutrients" in params else None
+        return httpx.Response(200, json=food_record(numbers))
+
+def reset(stand_in: StandIn) -> None:
+    main._http_transport = httpx.MockTransport(stand_in.handler)
+    main._http_client = None
+    main.response_cache = main.ResponseCache()
+    main.singleflight = main.SingleFlight()
+    main.negative_cache = main.NegativeCache()
+    stand_in.queries.clear()
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        sys.exit(f"FAIL: {message}")
+    print(f"ok   {message}", file=sys.stderr)
+
+async def lookup(stand_in: StandIn, nutrient_names: str, warm: bool, output_format: str) -> str:
+    reset(stand_in)
+    if warm:
+        await main.get_food_details(FDC_ID)
+    result = await main.get_food_nutrients(FDC_ID, nutrient_names, output_format=output_format)
+    await main.close_http_client()
+    return result
+
+async def run_checks() -> None:
+    main.API_KEY = "check-key"
+    main.BACKEND = "api"
+    main.LOCAL_SEARCH = False
+    main.CACHE_ENABLED = True
+    main.DISK_CACHE_ENABLED = False
+    main.RATE_LIMIT_ENABLED = False
+    main.PREFETCH_ENABLED = False
+    stand_in = StandIn()
+    for nutrient_names in FILTERS:
+        for output_format in ("text", "json"):
+            cold = await lookup(stand_in, nutrient_names, warm=False, output_format=output_format)
+            projected = any("nutrients" in query for query in stand_in.queries)
+            warm = await lookup(stand_in, nutrient_names, warm=True, output_format=output_format)
+            check(cold == warm, f"{nutrient_names!r} ({output_format}): cold and warm cache agree")
+            if output_format == "json":
+                names = [name for group in json.loads(cold)["nutrients"].values() for name in group]
+                check(bool(names) != (nutrient_names in EMPTY), f"{nutrient_names!r}: {len(names)} nutrients shown")
+                check(projected != (nutrient_names in FULL_RECORD),
+                      f"{nutrient_names!r}: {'projected' if projected else 'full record'} on a cold cache")
+
+if __name__ == "__main__":
+    asyncio.run(run_checks())
+    print("All nutrient filter checks passed", file=sys.stderr)
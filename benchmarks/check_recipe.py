@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Recipe check: ingredient parsing and compute_recipe_nutrients errors
+
+Parses well-formed ingredient lists (weights, fractions, household
+measures) and checks that malformed items, including a fraction with a
+zero denominator, are reported by name instead of as a generic failure.
+Needs no network: rejected inputs never reach the API. Exits non-zero on
+the first mismatch.
+
+Usage:
+    uv run benchmarks/check_recipe.py
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        sys.exit(f"FAIL: {message}")
+    print(f"ok   {message}", file=sys.stderr)
+
+def check_parse() -> None:
+    parsed = main.parse_ingredients("171688:150 g, 173944:1/2 cup; 171287:2 large\n170567:.5 oz, 169756:3")
+    check(parsed == [(171688, 150.0, "g"), (173944, 0.5, "cup"), (171287, 2.0, "large"),
+                     (170567, 0.5, "oz"), (169756, 3.0, "")], "weights, fractions and measures parsed")
+    for ingredients, expected in (("171688:1/0 g", "Invalid quantity in '171688:1/0 g'"),
+                                  ("171688:150 g, 173944:0/0 cup", "Invalid quantity in '173944:0/0 cup'"),
+                                  ("171688 150 g", "cannot parse ingredient '171688 150 g'")):
+        try:
+            main.parse_ingredients(ingredients)
+        except ValueError as e:
+            check(str(e).startswith(expected), f"{ingredients!r} rejected: {e}")
+        else:
+            check(False, f"{ingredients!r} rejected")
+
+async def check_tool() -> None:
+    result = await main.compute_recipe_nutrients("171688:150 g, 173944:1/0 cup")
+    check(result == "Error: Invalid quantity in '173944:1/0 cup'", f"compute_recipe_nutrients names the bad item: {result}")
+
+if __name__ == "__main__":
+    check_parse()
+    asyncio.run(check_tool())
+    print("All recipe checks passed", file=sys.stderr)
@@ -0,0 +1,264 @@
+"""
+Local stand-in for the FoodData Central API
+
+MockFDC serves synthetic but realistically shaped FDC payloads (full food
+records with nutrients and portions, search hits, abridged list pages)
+through an httpx.MockTransport, with configurable latency, error and
+rate-limit injection, plus transfer time proportional to the payload size. It counts every upstream call it receives so that
+benchmarks can report how many requests reached "USDA".
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+
+# (id, number, name, unit) for nutrients commonly present in SR Legacy records
+NUTRIENTS = [
+    (1051, "255", "Water", "g"),
+    (1008, "208", "Energy", "kcal"),
+    (1062, "268", "Energy", "kJ"),
+    (1003, "203", "Protein", "g"),
+    (1004, "204", "Total lipid (fat)", "g"),
+    (1007, "207", "Ash", "g"),
+    (1005, "205", "Carbohydrate, by difference", "g"),
+    (1079, "291", "Fiber, total dietary", "g"),
+    (2000, "269", "Sugars, total including NLEA", "g"),
+    (1009, "209", "Starch", "g"),
+    (1087, "301", "Calcium, Ca", "mg"),
+    (1089, "303", "Iron, Fe", "mg"),
+    (1090, "304", "Magnesium, Mg", "mg"),
+    (1091, "305", "Phosphorus, P", "mg"),
+    (1092, "306", "Potassium, K", "mg"),
+    (1093, "307", "Sodium, Na", "mg"),
+    (1095, "309", "Zinc, Zn", "mg"),
+    (1098, "312", "Copper, Cu", "mg"),
+    (1101, "315", "Manganese, Mn", "mg"),
+    (1103, "317", "Selenium, Se", "µg"),
+    (1162, "401", "Vitamin C, total ascorbic acid", "mg"),
+    (1165, "404", "Thiamin", "mg"),
+    (1166, "405", "Riboflavin", "mg"),
+    (1167, "406", "Niacin", "mg"),
+    (1170, "410", "Pantothenic acid", "mg"),
+    (1175, "415", "Vitamin B-6", "mg"),
+    (1177, "417", "Folate, total", "µg"),
+    (1180, "421", "Choline, total", "mg"),
+    (1178, "418", "Vitamin B-12", "µg"),
+    (1106, "320", "Vitamin A, RAE", "µg"),
+    (1104, "318", "Vitamin A, IU", "IU"),
+    (1107, "321", "Carotene, beta", "µg"),
+    (1123, "338", "Lutein + zeaxanthin", "µg"),
+    (1109, "323", "Vitamin E (alpha-tocopherol)", "mg"),
+    (1114, "328", "Vitamin D (D2 + D3)", "µg"),
+    (1110, "324", "Vitamin D (D2 + D3), International Units", "IU"),
+    (1185, "430", "Vitamin K (phylloquinone)", "µg"),
+    (1258, "606", "Fatty acids, total saturated", "g"),
+    (1292, "645", "Fatty acids, total monounsaturated", "g"),
+    (1293, "646", "Fatty acids, total polyunsaturated", "g"),
+    (1257, "605", "Fatty acids, total trans", "g"),
+    (1253, "601", "Cholesterol", "mg"),
+    (1210, "501", "Tryptophan", "g"),
+    (1211, "502", "Threonine", "g"),
+    (1212, "503", "Isoleucine", "g"),
+    (1213, "504", "Leucine", "g"),
+    (1214, "505", "Lysine", "g"),
+    (1215, "506", "Methionine", "g"),
+    (1057, "262", "Caffeine", "mg"),
+    (1018, "221", "Alcohol, ethyl", "g")
+]
+
+FOOD_WORDS = [
+    "chicken", "beef", "pork", "salmon", "tuna", "egg", "milk", "cheese", "yogurt", "butter",
+    "apple", "banana", "orange", "strawberry", "blueberry", "broccoli", "spinach", "carrot",
+    "potato", "tomato", "rice", "bread", "oats", "lentils", "chickpeas", "beans", "almonds",
+    "peanut", "tofu", "pasta"
+]
+PREPARATIONS = ["raw", "cooked", "roasted", "boiled", "fried", "dried", "canned", "frozen"]
+DATA_TYPES = ["SR Legacy", "Foundation", "Survey (FNDDS)", "Branded"]
+BRANDS = ["Acme Foods", "Green Valley", "Harvest Co.", "Sunrise Farms", "Blue Ocean"]
+PORTIONS = [("cup", 1.0, 128.0), ("tbsp", 1.0, 15.0), ("oz", 1.0, 28.35), ("serving", 1.0, 85.0)]
+
+def make_food(fdc_id: int, rng: random.Random) -> dict:
+    """Build a full food record shaped like fdc/v1/food/{id}."""
+    word = FOOD_WORDS[fdc_id % len(FOOD_WORDS)]
+    data_type = DATA_TYPES[(fdc_id // len(FOOD_WORDS)) % len(DATA_TYPES)]
+    description = f"{word.capitalize()}, {rng.choice(PREPARATIONS)}"
+    nutrients = NUTRIENTS if data_type != "Branded" else NUTRIENTS[:18]
+    record = {
+        "fdcId": fdc_id,
+        "description": description,
+        "dataType": data_type,
+        "publicationDate": "2019-04-01",
+        "foodClass": "FinalFood",
+        "foodCategory": {"id": 11, "code": "1100", "description": "Vegetables and Vegetable Products"},
+        "foodNutrients": [
+            {
+                "type": "FoodNutrient",
+                "id": fdc_id * 100 + i,
+                "nutrient": {"id": nid, "number": number, "name": name, "rank": 100 * (i + 1), "unitName": unit},
+                "dataPoints": rng.randint(1, 12),
+                "amount": round(rng.uniform(0, 50), 3)
+            }
+            for i, (nid, number, name, unit) in enumerate(nutrients)
+        ],
+        "foodPortions": [
+            {
+                "id": fdc_id * 10 + i,
+                "sequenceNumber": i + 1,
+                "amount": amount,
+                "gramWeight": grams,
+                "modifier": unit,
+                "portionDescription": f"1 {unit}",
+                "measureUnit": {"id": 1000 + i, "name": unit, "abbreviation": unit}
+            }
+            for i, (unit, amount, grams) in enumerate(PORTIONS)
+        ],
+        "nutrientConversionFactors": [
+            {"type": ".CalorieConversionFactor", "proteinValue": 4.0, "fatValue": 9.0, "carbohydrateValue": 4.0}
+        ],
+        "inputFoods": []
+    }
+    if data_type == "Branded":
+        record.update({
+            "brandOwner": rng.choice(BRANDS),
+            "gtinUpc": f"{rng.randint(10**11, 10**12 - 1)}",
+            "ingredients": ", ".join(rng.sample(FOOD_WORDS, 6)).upper() + ", SALT, CITRIC ACID",
+            "servingSize": 30.0,
+            "servingSizeUnit": "g",
+            "brandedFoodCategory": "Snacks",
+            "labelNutrients": {k: {"value": round(rng.uniform(0, 20), 1)} for k in ("fat", "protein", "calories", "sodium")}
+        })
+    return record
+
+def search_hit(record: dict) -> dict:
+    """Shape a full record like an entry of fdc/v1/foods/search results."""
+    hit = {
+        "fdcId": record["fdcId"],
+        "description": record["description"],
+        "dataType": record["dataType"],
+        "publishedDate": record["publicationDate"],
+        "foodCategory": record["foodCategory"]["description"],
+        "score": 500.0,
+        "foodNutrients": [
+            {
+                "nutrientId": n["nutrient"]["id"],
+                "nutrientName": n["nutrient"]["name"],
+                "nutrientNumber": n["nutrient"]["number"],
+                "unitName": n["nutrient"]["unitName"].upper(),
+                "value": n["amount"]
+            }
+            for n in record["foodNutrients"]
+        ]
+    }
+    for field in ("brandOwner", "ingredients", "gtinUpc"):
+        if field in record:
+            hit[field] = record[field]
+    return hit
+
+def abridged(record: dict) -> dict:
+    """Shape a full record like an entry of fdc/v1/foods/list results."""
+    return {
+        "fdcId": record["fdcId"],
+        "description": record["description"],
+        "dataType": record["dataType"],
+        "publicationDate": record["publicationDate"],
+        "foodNutrients": [
+            {"number": n["nutrient"]["number"], "name": n["nutrient"]["name"],
+             "amount": n["amount"], "unitName": n["nutrient"]["unitName"].upper()}
+            for n in record["foodNutrients"]
+        ]
+    }
+
+class MockFDC:
+    """In-process FDC API with injectable latency and faults."""
+
+    def __init__(self, foods: int = 2000, latency_ms: float = 80.0, jitter_ms: float = 40.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, bandwidth_mbps: float = 20.0,
+                 seed: int = 42, first_id: int = 100000):
+        rng = random.Random(seed)
+        self.foods = {fdc_id: make_food(fdc_id, rng) for fdc_id in range(first_id, first_id + foods)}
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        # Bytes transferred per second; 0 disables transfer time
+        self.bandwidth = bandwidth_mbps * 125000
+        self._rng = random.Random(seed + 1)
+        self.calls: Counter = Counter()
+        # time.monotonic() of every call received, in order
+        self.call_times: list[float] = []
+        self.bytes_sent = 0
+
+    @property
+    def fdc_ids(self) -> list[int]:
+        return list(self.foods)
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def reset_counters(self) -> None:
+        self.calls.clear()
+        self.call_times.clear()
+        self.bytes_sent = 0
+
+    async def _json(self, request: httpx.Request, status: int, payload) -> httpx.Response:
+        body = json.dumps(payload).encode()
+        self.bytes_sent += len(body)
+        if self.bandwidth:
+            await asyncio.sleep(len(body) / self.bandwidth)
+        return httpx.Response(status, content=body, headers={"Content-Type": "application/json"}, request=request)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.lstrip("/")
+        route = "fdc/v1/food/{id}" if path.startswith("fdc/v1/food/") else path
+        self.calls[f"{request.method} {route}"] += 1
+        self.call_times.append(time.monotonic())
+        await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+
+        roll = self._rng.random()
+        if roll < self.throttle_rate:
+            return httpx.Response(429, headers={"Retry-After": "0"}, request=request)
+        if roll < self.throttle_rate + self.error_rate:
+            return httpx.Response(503, request=request)
+
+        params = {k: v[0] for k, v in parse_qs(request.url.query.decode()).items()}
+        if request.method == "POST" and path == "fdc/v1/foods":
+            ids = json.loads(request.content).get("fdcIds", [])
+            return await self._json(request, 200, [self.foods[i] for i in ids if i in self.foods])
+        if path.startswith("fdc/v1/food/"):
+            record = self.foods.get(int(path.rsplit("/", 1)[1]))
+            if record is None:
+                return await self._json(request, 404, {"error": "Not Found"})
+            if "nutrients" in params:
+                wanted = set(params["nutrients"].split(","))
+                record = dict(record, foodNutrients=[
+                    n for n in record["foodNutrients"] if n["nutrient"]["number"] in wanted
+                ])
+            if params.get("format") == "abridged":
+                record = abridged(record)
+            return await self._json(request, 200, record)
+        page_size = int(params.get("pageSize", 50))
+        page_number = int(params.get("pageNumber", 1))
+        start = (page_number - 1) * page_size
+        if path == "fdc/v1/foods/search":
+            terms = params.get("query", "").lower().split()
+            data_type = params.get("dataType")
+            matches = [
+                r for r in self.foods.values()
+                if all(t in r["description"].lower() for t in terms)
+                and (not data_type or r["dataType"] in data_type.split(","))
+            ]
+            return await self._json(request, 200, {
+                "totalHits": len(matches),
+                "currentPage": page_number,
+                "totalPages": -(-len(matches) // page_size),
+                "foods": [search_hit(r) for r in matches[start:start + page_size]]
+            })
+        if path == "fdc/v1/foods/list":
+            records = list(self.foods.values())[start:start + page_size]
+            return await self._json(request, 200, [abridged(r) for r in records])
+        return await self._json(request, 404, {"error": "Not Found"})
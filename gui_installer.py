@@ -9,6 +9,7 @@ import socketserver
 import webbrowser
 import threading
 import json
+import html
 import subprocess
 import os
 import sys
@@ -22,7 +23,9 @@ class InstallerHandler(http.server.SimpleHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
-            self.wfile.write(HTML_CONTENT.encode('utf-8'))
+            # USDA_SERVER_URL (same variable as install.sh) prefills the shared server field
+            server_url = html.escape(os.getenv('USDA_SERVER_URL', ''), quote=True)
+            self.wfile.write(HTML_CONTENT.replace('{server_url}', server_url).encode('utf-8'))
         elif self.path.startswith('/install'):
             self.handle_install()
         else:
@@ -34,6 +37,11 @@ class InstallerHandler(http.server.SimpleHTTPRequestHandler):
         query = urllib.parse.urlparse(self.path).query
         params = urllib.parse.parse_qs(query)
         api_key = params.get('api_key', [''])[0]
+        server_url = params.get('server_url', [''])[0].strip()
+        
+        if server_url:
+            self.install_remote(server_url)
+            return
         
         if not api_key:
             self.send_json({'error': 'API key is required'})
@@ -67,7 +75,7 @@ version = "0.1.0"
 description = "MCP server for USDA API access"
 requires-python = ">=3.11"
 dependencies = [
-    "mcp>=1.2.0",
+    "mcp>=1.10.0",
     "httpx>=0.25.0",
     "python-dotenv>=1.0.0"
 ]
@@ -140,6 +148,47 @@ dependencies = [
         except Exception as e:
             self.send_json({'error': str(e)})
     
+    def install_remote(self, server_url):
+        # Point Claude at a shared server (main.py serve); the API key lives on that server
+        if not server_url.startswith(('http://', 'https://')):
+            self.send_json({'error': 'Server URL must start with http:// or https://'})
+            return
+        if not server_url.rstrip('/').endswith(('/mcp', '/sse')):
+            server_url = server_url.rstrip('/') + '/mcp'
+        
+        try:
+            import shutil
+            npx_path = shutil.which("npx")
+            if not npx_path:
+                self.send_json({'error': 'Node.js (npx) is required to connect to a shared server'})
+                return
+            
+            config_file = Path.home() / "Library/Application Support/Claude/claude_desktop_config.json"
+            config = {}
+            if config_file.exists():
+                try:
+                    with open(config_file, "r") as f:
+                        config = json.load(f)
+                except:
+                    config = {}
+            
+            if "mcpServers" not in config:
+                config["mcpServers"] = {}
+            
+            config["mcpServers"]["usda-api"] = {
+                "command": npx_path,
+                "args": ["-y", "mcp-remote", server_url]
+            }
+            
+            config_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(config_file, "w") as f:
+                json.dump(config, f, indent=2)
+            
+            self.send_json({'success': True, 'message': f'Connected to shared server at {server_url}'})
+            
+        except Exception as e:
+            self.send_json({'error': str(e)})
+    
     def send_json(self, data):
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
@@ -417,6 +466,12 @@ HTML_CONTENT = '''<!DOCTYPE html>
             </div>
         </div>
         
+        <div class="input-group">
+            <label for="serverUrl">Shared server URL (optional):</label>
+            <input type="text" id="serverUrl" placeholder="http://team-host:8000/mcp" value="{server_url}" />
+            <div class="api-link">Leave empty to install locally. A shared server keeps its own API key.</div>
+        </div>
+        
         <button class="install-btn" onclick="install()">
             🚀 Install USDA Tools
         </button>
@@ -434,10 +489,11 @@ HTML_CONTENT = '''<!DOCTYPE html>
         
         function install() {
             const apiKey = document.getElementById('apiKey').value.trim();
+            const serverUrl = document.getElementById('serverUrl').value.trim();
             const button = document.querySelector('.install-btn');
             
-            if (!apiKey) {
-                showStatus('Please enter your USDA API key', 'error');
+            if (!apiKey && !serverUrl) {
+                showStatus('Please enter your USDA API key or a shared server URL', 'error');
                 return;
             }
             
@@ -445,7 +501,7 @@ HTML_CONTENT = '''<!DOCTYPE html>
             button.innerHTML = '<span class="spinner"></span> Installing...';
             showStatus('Installing USDA Food Tools... This may take a moment.', 'loading');
             
-            fetch(`/install?api_key=${encodeURIComponent(apiKey)}`)
+            fetch(`/install?api_key=${encodeURIComponent(apiKey)}&server_url=${encodeURIComponent(serverUrl)}`)
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
@@ -472,10 +528,12 @@ HTML_CONTENT = '''<!DOCTYPE html>
         }
         
         // Allow Enter key to trigger install
-        document.getElementById('apiKey').addEventListener('keypress', function(e) {
-            if (e.key === 'Enter') {
-                install();
-            }
+        ['apiKey', 'serverUrl'].forEach(function(id) {
+            document.getElementById(id).addEventListener('keypress', function(e) {
+                if (e.key === 'Enter') {
+                    install();
+                }
+            });
         });
     </script>
 </body>
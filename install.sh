@@ -47,6 +47,55 @@ fi
 
 print_success "Claude for Desktop found!"
 
+# Connect to a shared server (main.py serve) instead of installing locally:
+#   USDA_SERVER_URL=http://team-host:8000/mcp ./install.sh
+if [ -n "$USDA_SERVER_URL" ]; then
+    case "$USDA_SERVER_URL" in
+        */mcp|*/mcp/|*/sse) ;;
+        *) USDA_SERVER_URL="${USDA_SERVER_URL%/}/mcp" ;;
+    esac
+    
+    NPX_PATH=$(command -v npx || true)
+    if [ -z "$NPX_PATH" ]; then
+        print_error "Node.js (npx) is required to connect to a shared server."
+        print_status "Install it from: https://nodejs.org"
+        exit 1
+    fi
+    
+    CLAUDE_CONFIG_FILE="$CLAUDE_CONFIG_DIR/claude_desktop_config.json"
+    if [ -f "$CLAUDE_CONFIG_FILE" ] && [ -s "$CLAUDE_CONFIG_FILE" ]; then
+        cp "$CLAUDE_CONFIG_FILE" "$CLAUDE_CONFIG_FILE.backup.$(date +%s)"
+        print_status "Backed up existing Claude configuration"
+    fi
+    
+    python3 << EOF
+import json
+
+config_file = "$CLAUDE_CONFIG_FILE"
+
+try:
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+except:
+    config = {}
+
+if 'mcpServers' not in config:
+    config['mcpServers'] = {}
+
+config['mcpServers']['usda-api'] = {
+    "command": "$NPX_PATH",
+    "args": ["-y", "mcp-remote", "$USDA_SERVER_URL"]
+}
+
+with open(config_file, 'w') as f:
+    json.dump(config, f, indent=2)
+EOF
+    
+    print_success "Claude for Desktop now uses the shared server at: $USDA_SERVER_URL"
+    print_warning "⚠️  Remember to restart Claude for Desktop to see the new tools!"
+    exit 0
+fi
+
 # Get API key from user
 echo ""
 print_status "You need a USDA FoodData Central API key to use this service."
@@ -100,7 +149,7 @@ description = "MCP server for USDA API access"
 readme = "README.md"
 requires-python = ">=3.11"
 dependencies = [
-    "mcp>=1.2.0",
+    "mcp>=1.10.0",
     "httpx>=0.25.0",
     "python-dotenv>=1.0.0"
 ]
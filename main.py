@@ -1,48 +1,3800 @@
+import argparse
+import ast
+import asyncio
+import bisect
+import contextvars
+import csv
+import functools
+import heapq
+import io
+import itertools
+import json
+import logging
+import math
+import operator
 import os
-from typing import Any
+import random
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, NamedTuple, TextIO
+from urllib.parse import parse_qsl, urlencode
 import httpx
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 from dotenv import load_dotenv
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+try:
+    import numpy as np
+except ImportError:  # optional: vectorizes local search
+    np = None
 
 # Load environment variables
 load_dotenv()
 
-# Initialize FastMCP server
-mcp = FastMCP("usda-api")
+logger = logging.getLogger("usda-api")
+
+# Constants
+USDA_API_BASE = "https://api.nal.usda.gov"
+API_KEY = os.getenv("USDA_API_KEY")
+
+def _env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# HTTP client settings (shared by every upstream call)
+HTTP_TIMEOUT = float(os.getenv("USDA_HTTP_TIMEOUT", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("USDA_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("USDA_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("USDA_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = _env_flag("USDA_HTTP2")
+
+DEFAULT_HEADERS = {
+    "User-Agent": "usda-mcp-server/1.0",
+    "Accept": "application/json"
+}
+
+# Server-lifetime HTTP client, created lazily on first use
+_http_client: httpx.AsyncClient | None = None
+# Optional transport override (e.g. httpx.MockTransport for benchmarks)
+_http_transport: httpx.AsyncBaseTransport | None = None
+
+def _http2_available() -> bool:
+    """Check whether the optional h2 package needed for HTTP/2 is installed."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+        _http_client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            limits=limits,
+            timeout=HTTP_TIMEOUT,
+            http2=HTTP2_ENABLED and _http2_available(),
+            transport=_http_transport
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client and release its pooled connections."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# Client-side rate limiting (api.data.gov keys allow about 1,000 requests/hour)
+RATE_LIMIT_ENABLED = _env_flag("USDA_RATE_LIMIT_ENABLED", True)
+RATE_LIMIT_PER_HOUR = float(os.getenv("USDA_RATE_LIMIT_PER_HOUR", "1000"))
+RATE_LIMIT_BURST = float(os.getenv("USDA_RATE_LIMIT_BURST", "30"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("USDA_RATE_LIMIT_MAX_WAIT", "10"))
+
+# Scheduling priorities: lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Resilience: retries, circuit breaker and hedged requests
+RETRY_MAX_ATTEMPTS = int(os.getenv("USDA_RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("USDA_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("USDA_RETRY_MAX_DELAY", "10"))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("USDA_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("USDA_BREAKER_COOLDOWN", "30"))
+HEDGE_ENABLED = _env_flag("USDA_HEDGE_ENABLED")
+HEDGE_PERCENTILE = float(os.getenv("USDA_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("USDA_HEDGE_MIN_SAMPLES", "20"))
+
+# Instrumentation: latency histograms and counters, optionally logged as JSON lines
+METRICS_ENABLED = _env_flag("USDA_METRICS_ENABLED", True)
+METRICS_FILE = os.getenv("USDA_METRICS_FILE")
+METRICS_INTERVAL = float(os.getenv("USDA_METRICS_INTERVAL", "60"))
+
+# Response cache settings (TTLs in seconds)
+CACHE_ENABLED = _env_flag("USDA_CACHE_ENABLED", True)
+CACHE_MAX_ENTRIES = int(os.getenv("USDA_CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_BYTES = int(os.getenv("USDA_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_FOOD = float(os.getenv("USDA_CACHE_TTL_FOOD", str(24 * 3600)))
+CACHE_TTL_SEARCH = float(os.getenv("USDA_CACHE_TTL_SEARCH", "3600"))
+CACHE_TTL_LIST = float(os.getenv("USDA_CACHE_TTL_LIST", "3600"))
+# Hold cached food records as a header plus a row of a float32 nutrient matrix (needs numpy)
+CACHE_COMPACT_FOODS = _env_flag("USDA_CACHE_COMPACT_FOODS", True)
+# Hard TTL: how long past its TTL an entry may still be served (stale-while-revalidate
+# or while USDA is unreachable); older entries are never served and are purged from disk
+CACHE_STALE_GRACE = float(os.getenv("USDA_CACHE_STALE_GRACE", str(7 * 24 * 3600)))
+# Serve expired entries at once and refresh them in the background
+CACHE_SWR_ENABLED = _env_flag("USDA_CACHE_SWR", True)
+# Refresh the most frequently read entries before they expire (0 disables)
+CACHE_REFRESH_TOP_N = int(os.getenv("USDA_CACHE_REFRESH_TOP_N", "50"))
+CACHE_REFRESH_INTERVAL = float(os.getenv("USDA_CACHE_REFRESH_INTERVAL", "300"))
+CACHE_REFRESH_AHEAD = float(os.getenv("USDA_CACHE_REFRESH_AHEAD", "600"))
+
+# Search and list results cached by offset, so any page inside an already
+# fetched range is answered locally (0 disables)
+CACHE_RANGE_MAX_RESULTS = int(os.getenv("USDA_CACHE_RANGE_MAX_RESULTS", "20000"))
+
+# How long an FDC ID that USDA answered with 404 is reported missing without asking again (0 disables)
+NEGATIVE_CACHE_TTL = float(os.getenv("USDA_NEGATIVE_CACHE_TTL", "900"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("USDA_NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+
+# Auto-pagination (max_results / all_pages) for search_foods and list_foods
+PAGINATION_MAX_RESULTS = int(os.getenv("USDA_PAGINATION_MAX_RESULTS", "2000"))
+PAGINATION_CONCURRENCY = int(os.getenv("USDA_PAGINATION_CONCURRENCY", "4"))
+
+# Speculative prefetch of the top search hits into the food cache
+PREFETCH_ENABLED = _env_flag("USDA_PREFETCH_ENABLED")
+PREFETCH_TOP_N = int(os.getenv("USDA_PREFETCH_TOP_N", "5"))
+# Share of the hourly request quota prefetching may use
+PREFETCH_BUDGET = float(os.getenv("USDA_PREFETCH_BUDGET", "0.1"))
+
+# Batch lookup settings for get_multiple_foods
+MULTI_FOOD_MAX_IDS = int(os.getenv("USDA_MULTI_FOOD_MAX_IDS", "500"))
+MULTI_FOOD_CHUNK_SIZE = int(os.getenv("USDA_MULTI_FOOD_CHUNK_SIZE", "20"))
+MULTI_FOOD_CONCURRENCY = int(os.getenv("USDA_MULTI_FOOD_CONCURRENCY", "4"))
+
+# Batch search settings for search_foods_batch
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("USDA_SEARCH_BATCH_MAX_QUERIES", "50"))
+SEARCH_BATCH_CONCURRENCY = int(os.getenv("USDA_SEARCH_BATCH_CONCURRENCY", "4"))
+
+# Foods held in memory for rank_foods_by_nutrient and find_similar_foods
+ANALYSIS_MAX_FOODS = int(os.getenv("USDA_ANALYSIS_MAX_FOODS", "250000"))
+
+# Endpoint prefix -> TTL; food records are effectively immutable between releases
+CACHE_TTLS = {
+    "fdc/v1/food/": CACHE_TTL_FOOD,
+    "fdc/v1/foods/search": CACHE_TTL_SEARCH,
+    "fdc/v1/foods/list": CACHE_TTL_LIST
+}
+
+_MISSING = object()
+
+def cache_ttl_for(endpoint: str) -> float:
+    """Return the cache TTL for an endpoint, or 0 if it should not be cached."""
+    for prefix, ttl in CACHE_TTLS.items():
+        if endpoint.startswith(prefix):
+            return ttl
+    return 0
+
+def make_cache_key(endpoint: str, params: dict[str, Any] | None = None) -> str:
+    """Build a normalized cache key from an endpoint and its parameters.
+
+    The API key is excluded and parameters are sorted, so the same logical
+    request always maps to the same key. An empty parameter dict and None
+    are equivalent.
+    """
+    items = []
+    for name, value in sorted((params or {}).items()):
+        if name == "api_key" or value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        items.append((name, str(value)))
+    return f"{endpoint}?{urlencode(items)}" if items else endpoint
+
+class CompactFood:
+    """A food record held as a header plus a row of a FoodMatrix.
+    
+    The header keeps the fields used for filtering; `extra` holds every
+    other field as compact JSON (portions, ingredients, label nutrients),
+    with a placeholder that keeps foodNutrients in its place. Nutrient
+    entries are rebuilt from the interned metadata of their matrix column
+    and their exact amount; entries that cannot be (unusual shapes,
+    integer amounts) are kept verbatim in `overrides` by position.
+    Entries of a NutrientMatrix, which never rebuilds records, have only
+    the header.
+    """
+    
+    __slots__ = ("fdc_id", "description", "data_type", "category", "row", "extra", "abridged",
+                 "columns", "amounts", "overrides")
+    
+    def __init__(self, fdc_id: int, description: str | None, data_type: str | None, category: str | None,
+                 row: int, extra: bytes | None = None, abridged: bool = False, columns: Any = None,
+                 amounts: Any = None, overrides: dict[int, dict[str, Any]] | None = None):
+        self.fdc_id = fdc_id
+        self.description = description
+        self.data_type = data_type
+        self.category = category
+        self.row = row
+        self.extra = extra
+        self.abridged = abridged
+        self.columns = columns
+        self.amounts = amounts
+        self.overrides = overrides
+
+class FoodMatrix:
+    """Columnar store of food nutrient amounts with interned nutrient metadata.
+    
+    Row r of `values` (float32, NaN where a food has no amount) belongs to
+    food `fdc_ids[r]`, column c to nutrient number `numbers[c]`; `live`
+    marks rows in use, and rows of released foods are reused. Nutrient
+    names, units and ranks are stored once per column instead of once per
+    food. float32 does not round-trip printed amounts (11.161 becomes
+    11.16100025), so each food also keeps the exact amounts it has, in
+    record order, for output; the matrix serves vectorized queries.
+    """
+    
+    # Row-major: a food's amounts are written and cleared together
+    order = "C"
+    # Rows never grow past this many
+    max_rows = sys.maxsize
+    
+    def __init__(self, rows: int = 256, columns: int = 64):
+        self.values = np.full((rows, columns), np.nan, dtype=np.float32, order=self.order)
+        self.fdc_ids = np.zeros(rows, dtype=np.int64)
+        self.live = np.zeros(rows, dtype=bool)
+        self.foods: list[CompactFood | None] = [None] * rows
+        self.numbers: list[str] = []
+        self._columns: dict[str, int] = {}
+        # Per column: the full-record "nutrient" object and the abridged (name, unitName)
+        self._meta: list[dict[str, Any] | None] = []
+        self._abridged_meta: list[tuple[Any, Any] | None] = []
+        self._free: list[int] = []
+        self._next_row = 0
+        self.count = 0
+    
+    def column(self, number: str) -> int:
+        """Return the column of a nutrient number, adding one if it is new."""
+        column = self._columns.get(number)
+        if column is None:
+            column = len(self.numbers)
+            if column == self.values.shape[1]:
+                grown = np.full((self.values.shape[0], column * 2), np.nan, dtype=np.float32, order=self.order)
+                grown[:, :column] = self.values
+                self.values = grown
+            self._columns[number] = column
+            self.numbers.append(sys.intern(number))
+            self._meta.append(None)
+            self._abridged_meta.append(None)
+        return column
+    
+    def _allocate_row(self) -> int:
+        if self._free:
+            return self._free.pop()
+        row = self._next_row
+        if row == len(self.fdc_ids):
+            capacity = max(row + 1, min(row * 2, self.max_rows))
+            grown = np.full((capacity, self.values.shape[1]), np.nan, dtype=np.float32, order=self.order)
+            grown[:row] = self.values
+            self.values = grown
+            self.fdc_ids = np.concatenate([self.fdc_ids, np.zeros(capacity - row, dtype=np.int64)])
+            self.live = np.concatenate([self.live, np.zeros(capacity - row, dtype=bool)])
+            self.foods.extend([None] * (capacity - row))
+        self._next_row += 1
+        return row
+    
+    def _entry_column(self, item: Any, abridged: bool) -> int | None:
+        """Column of a nutrient entry rebuildable from interned metadata, else None."""
+        if not isinstance(item, dict):
+            return None
+        amount = item.get("amount")
+        if "amount" in item and type(amount) is not float:
+            return None
+        if abridged:
+            number = item.get("number")
+            if not isinstance(number, str) or not item.keys() <= {"number", "name", "amount", "unitName"}:
+                return None
+            column = self.column(number)
+            meta = (item.get("name"), item.get("unitName"))
+            if self._abridged_meta[column] is None:
+                self._abridged_meta[column] = meta
+            return column if self._abridged_meta[column] == meta else None
+        inner = item.get("nutrient")
+        if not isinstance(inner, dict) or not isinstance(inner.get("number"), str):
+            return None
+        column = self.column(inner["number"])
+        if self._meta[column] is None:
+            self._meta[column] = {name: sys.intern(value) if isinstance(value, str) else value
+                                  for name, value in inner.items()}
+        return column if self._meta[column] == inner else None
+    
+    def add(self, record: dict[str, Any]) -> CompactFood | None:
+        """Store a food record; None if it is not a food record with a nutrient list."""
+        nutrients = record.get("foodNutrients")
+        if not isinstance(nutrients, list) or not isinstance(record.get("fdcId"), int):
+            return None
+        abridged = bool(nutrients) and isinstance(nutrients[0], dict) and "nutrient" not in nutrients[0]
+        columns, amounts, overrides = [], [], {}
+        for position, item in enumerate(nutrients):
+            column = self._entry_column(item, abridged)
+            if column is None:
+                overrides[position] = item
+                columns.append(-1)
+                amounts.append(math.nan)
+            else:
+                columns.append(column)
+                amounts.append(item.get("amount", math.nan))
+        row = self._allocate_row()
+        columns = np.array(columns, dtype=np.int16)
+        amounts = np.array(amounts, dtype=np.float64)
+        present = columns >= 0
+        self.values[row, columns[present]] = amounts[present]
+        self.fdc_ids[row] = record["fdcId"]
+        self.live[row] = True
+        extra = json.dumps({**record, "foodNutrients": None}, separators=(",", ":")).encode()
+        food = CompactFood(record["fdcId"], record.get("description"), record.get("dataType"),
+                           _food_category(record), row, extra, abridged, columns, amounts, overrides or None)
+        self.foods[row] = food
+        self.count += 1
+        return food
+    
+    def record(self, food: CompactFood) -> dict[str, Any]:
+        """Rebuild the food record, as it would print, from its compact form."""
+        items = []
+        for position, (column, amount) in enumerate(zip(food.columns.tolist(), food.amounts.tolist())):
+            if column < 0:
+                items.append(food.overrides[position])
+                continue
+            if food.abridged:
+                name, unit = self._abridged_meta[column]
+                item = {"number": self.numbers[column], "name": name, "amount": amount, "unitName": unit}
+            else:
+                item = {"nutrient": self._meta[column], "amount": amount}
+            if amount != amount:
+                # NaN marks an entry without an amount (JSON has no NaN)
+                del item["amount"]
+            items.append(item)
+        record = json.loads(food.extra)
+        record["foodNutrients"] = items
+        return record
+    
+    def release(self, food: CompactFood) -> None:
+        """Free the food's row for reuse."""
+        if self.foods[food.row] is not food:
+            return
+        self.values[food.row] = np.nan
+        self.live[food.row] = False
+        self.foods[food.row] = None
+        self._free.append(food.row)
+        self.count -= 1
+    
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the matrix arrays and the per-food arrays and JSON."""
+        per_food = sum(food.columns.nbytes + food.amounts.nbytes + len(food.extra)
+                       for food in self.foods if food is not None)
+        return self.values.nbytes + self.fdc_ids.nbytes + self.live.nbytes + per_food
+    
+    def stats(self) -> dict[str, Any]:
+        """Return occupancy of the matrix."""
+        return {
+            "foods": self.count,
+            "rows": len(self.fdc_ids),
+            "nutrients": len(self.numbers),
+            "bytes": self.nbytes
+        }
+
+class ResponseCache:
+    """Bounded in-memory TTL + LRU cache for decoded USDA responses.
+
+    Entries are evicted least-recently-used first whenever the entry count
+    or the approximate byte size (size of the raw response body) exceeds
+    its limit. Cached values are shared, so callers must not mutate them.
+    With numpy installed, food records are held in a FoodMatrix and rebuilt
+    on every read; per-entry fields the tools never show (derivations,
+    data points) are dropped.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 compact: bool = CACHE_COMPACT_FOODS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.foods = FoodMatrix() if compact and np is not None else None
+        self._entries: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        """Check for a live entry without counting a lookup or touching LRU order."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: str, default: Any = None, allow_stale: bool = False) -> Any:
+        """Return a live cached value and mark it recently used.
+
+        Expired entries stay in place until evicted so that they can still
+        be served with `allow_stale`, up to CACHE_STALE_GRACE past expiry.
+        """
+        entry = self.lookup(key, allow_stale)
+        return default if entry is None else entry[0]
+
+    def lookup(self, key: str, allow_stale: bool = False) -> tuple[Any, float] | None:
+        """Return (value, remaining_ttl) and mark the entry recently used.
+
+        With `allow_stale`, expired entries within the hard TTL are returned
+        too, with a negative remaining TTL.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0 and (not allow_stale or remaining <= -CACHE_STALE_GRACE):
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if remaining <= 0:
+            self.stale_hits += 1
+        if isinstance(value, CompactFood):
+            value = self.foods.record(value)
+        return value, remaining
+
+    def peek(self, key: str) -> tuple[Any, float] | None:
+        """Return (value, remaining_ttl) without counting a lookup or touching LRU order."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value = self.foods.record(entry[2]) if isinstance(entry[2], CompactFood) else entry[2]
+        return value, entry[0] - time.monotonic()
+
+    def set(self, key: str, value: Any, ttl: float, size: int) -> None:
+        """Store a value for `ttl` seconds, evicting old entries if needed."""
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        if self.foods is not None and isinstance(value, dict) and "foodNutrients" in value:
+            value = self.foods.add(value) or value
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, value = self._entries.pop(key)
+        self.total_bytes -= size
+        if isinstance(value, CompactFood):
+            self.foods.release(value)
+
+    def iter_food_records(self) -> Iterator[dict[str, Any]]:
+        """Yield the unfiltered single-food records currently live, without touching LRU order."""
+        now = time.monotonic()
+        for key, (expires_at, _, value) in list(self._entries.items()):
+            if key.startswith("fdc/v1/food/") and "?" not in key and expires_at > now:
+                yield self.foods.record(value) if isinstance(value, CompactFood) else value
+
+    def clear(self) -> None:
+        """Drop every entry (counters are kept)."""
+        self._entries.clear()
+        self.total_bytes = 0
+        if self.foods is not None:
+            self.foods = FoodMatrix()
+
+    def stats(self) -> dict[str, Any]:
+        """Return cache counters and current occupancy."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale_hits": self.stale_hits,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            **({"compact_foods": self.foods.stats()} if self.foods is not None else {})
+        }
+
+response_cache = ResponseCache()
+
+# Persistent cache settings
+DISK_CACHE_ENABLED = _env_flag("USDA_DISK_CACHE", True)
+DISK_CACHE_PATH = Path(os.getenv("USDA_DISK_CACHE_PATH", str(Path.home() / ".usda-api-mcp" / "cache.sqlite3")))
+DISK_CACHE_MAX_BYTES = int(os.getenv("USDA_DISK_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+DISK_CACHE_EVICT_INTERVAL = float(os.getenv("USDA_DISK_CACHE_EVICT_INTERVAL", "300"))
+
+class DiskCache:
+    """SQLite-backed response cache that survives server restarts.
+
+    Response bodies are stored zlib-compressed with an absolute expiry time.
+    The database runs in WAL mode so several server processes can read it
+    concurrently. A corrupted database file is discarded and recreated.
+    """
+
+    def __init__(self, path: Path = DISK_CACHE_PATH, max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resets = 0
+        self._open()
+
+    def _open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self._connect()
+        except sqlite3.DatabaseError as e:
+            logger.warning("Discarding corrupted cache database %s: %s", self.path, e)
+            self._reset()
+
+    def _connect(self) -> None:
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        try:
+            if conn.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                raise sqlite3.DatabaseError("integrity check failed")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " body BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+        self._conn = conn
+
+    def _reset(self) -> None:
+        """Delete the database files and start over with an empty cache."""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.path}{suffix}").unlink(missing_ok=True)
+        self.resets += 1
+        self._connect()
+
+    def _run(self, operation: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run an operation on the connection, recovering once from corruption."""
+        with self._lock:
+            try:
+                return operation(self._conn)
+            except sqlite3.OperationalError:
+                # Locked or busy database; not a reason to throw the cache away
+                raise
+            except sqlite3.DatabaseError as e:
+                logger.warning("Cache database error, recreating %s: %s", self.path, e)
+                self._reset()
+                return operation(self._conn)
+
+    def _execute(self, sql: str, args: tuple = ()) -> list[tuple]:
+        return self._run(lambda conn: conn.execute(sql, args).fetchall())
+
+    def get(self, key: str, allow_stale: bool = False) -> tuple[Any, int, float] | None:
+        """Return (value, size, remaining_ttl) for a live entry, or None.
+
+        `size` is that of the decompressed body, the size the memory cache
+        accounts for. With `allow_stale`, expired entries within the hard
+        TTL are returned too (with a negative remaining TTL).
+        """
+        now = time.time()
+        rows = self._execute("SELECT body, expires_at FROM responses WHERE key = ?", (key,))
+        if not rows or (rows[0][1] <= now and (not allow_stale or rows[0][1] <= now - CACHE_STALE_GRACE)):
+            self.misses += 1
+            return None
+        body, expires_at = rows[0]
+        try:
+            raw = zlib.decompress(body)
+            value = json.loads(raw)
+        except (zlib.error, ValueError):
+            self._execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+        self._execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return value, len(raw), expires_at - now
+
+    def set(self, key: str, body: bytes, ttl: float) -> None:
+        """Store a raw JSON response body for `ttl` seconds."""
+        now = time.time()
+        compressed = zlib.compress(body)
+        self._execute(
+            "INSERT OR REPLACE INTO responses (key, body, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, compressed, len(compressed), now + ttl, now)
+        )
+
+    def evict(self) -> int:
+        """Remove entries past their stale grace period, then LRU ones above the size cap."""
+        def operation(conn: sqlite3.Connection) -> int:
+            cutoff = time.time() - CACHE_STALE_GRACE
+            removed = conn.execute("DELETE FROM responses WHERE expires_at <= ?", (cutoff,)).rowcount
+            excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+            if excess > 0:
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                removed += len(victims)
+            return removed
+
+        removed = self._run(operation)
+        self.evictions += removed
+        return removed
+
+    def iter_food_records(self) -> Iterator[dict[str, Any]]:
+        """Yield the unfiltered single-food records currently cached."""
+        rows = self._execute(
+            "SELECT body FROM responses WHERE key LIKE 'fdc/v1/food/%' AND key NOT LIKE '%?%' AND expires_at > ?",
+            (time.time(),)
+        )
+        for (body,) in rows:
+            try:
+                yield json.loads(zlib.decompress(body))
+            except (zlib.error, ValueError):
+                continue
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict[str, Any]:
+        """Return disk cache counters and current occupancy."""
+        entries, size = self._execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses")[0]
+        return {
+            "path": str(self.path),
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "resets": self.resets
+        }
+
+_disk_cache: DiskCache | None = None
+_disk_cache_failed = False
+
+def get_disk_cache() -> DiskCache | None:
+    """Return the persistent cache, opening it on first use (None if disabled)."""
+    global _disk_cache, _disk_cache_failed
+    if not DISK_CACHE_ENABLED or _disk_cache_failed:
+        return None
+    if _disk_cache is None:
+        try:
+            _disk_cache = DiskCache()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Persistent cache disabled: %s", e)
+            _disk_cache_failed = True
+    return _disk_cache
+
+async def _disk_cache_eviction_loop() -> None:
+    """Periodically purge expired and over-budget entries off the event loop."""
+    while True:
+        await asyncio.sleep(DISK_CACHE_EVICT_INTERVAL)
+        disk_cache = get_disk_cache()
+        if disk_cache is None:
+            return
+        try:
+            await asyncio.to_thread(disk_cache.evict)
+        except sqlite3.Error as e:
+            logger.warning("Cache eviction failed: %s", e)
+
+async def cache_lookup(cache_key: str) -> Any:
+    """Look a response up in memory, then on disk; return _MISSING on a miss.
+    
+    With stale-while-revalidate, an expired entry within the hard TTL is
+    returned at once and refreshed in the background.
+    """
+    entry = response_cache.lookup(cache_key, CACHE_SWR_ENABLED)
+    if entry is not None:
+        value, remaining = entry
+        prefetcher.note_hit(cache_key)
+    else:
+        disk_cache = get_disk_cache()
+        if disk_cache is None:
+            return _MISSING
+        try:
+            disk_entry = await asyncio.to_thread(disk_cache.get, cache_key, CACHE_SWR_ENABLED)
+        except sqlite3.Error as e:
+            logger.warning("Cache read failed: %s", e)
+            return _MISSING
+        if disk_entry is None:
+            return _MISSING
+        value, size, remaining = disk_entry
+        response_cache.set(cache_key, value, remaining, size)
+    cache_refresher.note_hit(cache_key)
+    if remaining <= 0:
+        cache_refresher.revalidate(cache_key, value)
+    return value
+
+async def cache_lookup_stale(cache_key: str) -> Any:
+    """Look up a possibly expired response to serve while USDA is unavailable."""
+    cached = response_cache.get(cache_key, _MISSING, allow_stale=True)
+    if cached is not _MISSING:
+        return cached
+    disk_cache = get_disk_cache()
+    if disk_cache is None:
+        return _MISSING
+    try:
+        entry = await asyncio.to_thread(disk_cache.get, cache_key, True)
+    except sqlite3.Error:
+        return _MISSING
+    return _MISSING if entry is None else entry[0]
+
+async def cache_store(cache_key: str, value: Any, body: bytes, ttl: float) -> None:
+    """Store a decoded response in memory and its raw body on disk."""
+    response_cache.set(cache_key, value, ttl, len(body))
+    if _food_matrix is not None:
+        _food_matrix.index_response(value)
+    disk_cache = get_disk_cache()
+    if disk_cache is None:
+        return
+    try:
+        await asyncio.to_thread(disk_cache.set, cache_key, body, ttl)
+    except sqlite3.Error as e:
+        logger.warning("Cache write failed: %s", e)
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream requests into one call.
+
+    The first caller for a key starts the request as a task; callers that
+    arrive while it is in flight await the same task. Each waiter is
+    shielded, so cancelling one waiter never cancels the shared request,
+    and an error is raised to every waiter.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `fetch` for `key`, or join the identical call already running."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the error as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict[str, Any]:
+        """Return coalescing counters."""
+        return {
+            "in_flight": len(self._in_flight),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced
+        }
+
+singleflight = SingleFlight()
+
+class CacheRefresher:
+    """Refresh cached responses in the background (stale-while-revalidate).
+    
+    Expired entries served by cache_lookup are re-fetched at background
+    priority, and the refresh loop re-fetches the most frequently read
+    entries before they expire, so popular foods rarely wait on USDA. Read
+    counts are halved after every pass so the ranking follows recent
+    traffic. Refreshes only use spare rate-limit tokens.
+    """
+
+    def __init__(self, top_n: int = CACHE_REFRESH_TOP_N, remember: int = 10000):
+        self.top_n = top_n
+        self.remember = remember
+        self._reads: OrderedDict[str, float] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.revalidations = 0
+        self.scheduled = 0
+        self.changed = 0
+        self.failures = 0
+        self.skipped_budget = 0
+
+    def note_hit(self, key: str) -> None:
+        """Count a cache read towards the key's access frequency."""
+        self._reads[key] = self._reads.pop(key, 0) + 1
+        if len(self._reads) > self.remember:
+            self._reads.popitem(last=False)
+
+    def hottest(self, n: int) -> list[str]:
+        """Return the `n` most frequently read keys."""
+        return heapq.nlargest(n, self._reads, key=self._reads.__getitem__)
+
+    def revalidate(self, key: str, stale: Any, scheduled: bool = False) -> bool:
+        """Start a background refresh of `key` unless one is running or no quota is spare."""
+        if key in self._tasks or not API_KEY:
+            return False
+        # Never take the last tokens from interactive calls
+        if RATE_LIMIT_ENABLED and rate_limiter.available() < 2:
+            self.skipped_budget += 1
+            return False
+        if scheduled:
+            self.scheduled += 1
+        else:
+            self.revalidations += 1
+        # A fresh context keeps the refresh out of the triggering tool call's metrics
+        task = asyncio.get_running_loop().create_task(self._refresh(key, stale), context=contextvars.Context())
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._tasks.pop(key, None))
+        return True
+
+    async def _refresh(self, key: str, stale: Any) -> None:
+        endpoint, _, query = key.partition("?")
+        params = dict(parse_qsl(query)) or None
+        ttl = cache_ttl_for(endpoint)
+        try:
+            data = await singleflight.do(key, lambda: _fetch_usda(endpoint, params, key, ttl, PRIORITY_BACKGROUND))
+        except Exception as e:
+            self.failures += 1
+            logger.debug("Refreshing %s failed: %s", key, e)
+            return
+        # Compare cached forms: compacted food records drop fields the tools never show
+        entry = response_cache.peek(key)
+        if (entry[0] if entry is not None else data) != stale:
+            self.changed += 1
+
+    def refresh_due(self) -> int:
+        """Refresh hot entries expiring within CACHE_REFRESH_AHEAD; return how many started."""
+        started = 0
+        for key in self.hottest(self.top_n):
+            entry = response_cache.peek(key)
+            if entry is None or entry[1] > CACHE_REFRESH_AHEAD or entry[1] <= -CACHE_STALE_GRACE:
+                continue
+            if self.revalidate(key, entry[0], scheduled=True):
+                started += 1
+        for key in list(self._reads):
+            reads = self._reads[key] / 2
+            if reads < 0.5:
+                del self._reads[key]
+            else:
+                self._reads[key] = reads
+        return started
+
+    def cancel(self) -> None:
+        """Cancel refreshes still running (on shutdown)."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        """Return refresh counters."""
+        return {
+            "stale_while_revalidate": CACHE_SWR_ENABLED,
+            "tracked_keys": len(self._reads),
+            "in_flight": len(self._tasks),
+            "revalidations": self.revalidations,
+            "scheduled_refreshes": self.scheduled,
+            "changed": self.changed,
+            "failures": self.failures,
+            "skipped_budget": self.skipped_budget
+        }
+
+cache_refresher = CacheRefresher()
+
+async def _cache_refresh_loop() -> None:
+    """Periodically refresh the hottest cache entries before they expire."""
+    while True:
+        await asyncio.sleep(CACHE_REFRESH_INTERVAL)
+        cache_refresher.refresh_due()
+
+# Offline backend settings
+# "api": always call USDA; "local": answer only from the ingested store;
+# "auto": use the ingested store when it has the food, otherwise call USDA
+BACKEND = os.getenv("USDA_BACKEND", "api").strip().lower()
+LOCAL_STORE_PATH = Path(os.getenv("USDA_LOCAL_STORE_PATH", str(Path.home() / ".usda-api-mcp" / "fdc.sqlite3")))
+INGEST_BATCH_SIZE = 1000
+# The ingested store holds every FDC food (all datasets), so IDs it lacks do not exist
+LOCAL_STORE_COMPLETE = _env_flag("USDA_LOCAL_STORE_COMPLETE")
+
+# Data type names used by the CSV downloads -> names used by the API
+CSV_DATA_TYPES = {
+    "foundation_food": "Foundation",
+    "sr_legacy_food": "SR Legacy",
+    "survey_fndds_food": "Survey (FNDDS)",
+    "branded_food": "Branded"
+}
+
+# Unit names used by the CSV downloads -> unit names used in full API records
+CSV_UNIT_NAMES = {"G": "g", "MG": "mg", "UG": "µg", "KCAL": "kcal", "KJ": "kJ", "MG_ATE": "mg_ATE", "SP_GR": "sp gr"}
+
+# sortBy values accepted by fdc/v1/foods/list -> store columns
+LIST_SORT_COLUMNS = {
+    "dataType.keyword": "data_type",
+    "lowercaseDescription.keyword": "description COLLATE NOCASE",
+    "description.keyword": "description COLLATE NOCASE",
+    "fdcId": "fdc_id",
+    "publishedDate": "publication_date"
+}
+
+def _split_list(value: Any) -> list[str]:
+    """Normalize a comma-separated string or list parameter into a list of strings."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value).split(",") if v.strip()]
+
+def data_type_matches(name: str, data_types: list[str]) -> bool:
+    """Whether a data type name starts with one of `data_types` ("Survey" matches "Survey (FNDDS)")."""
+    name = name.lower()
+    return any(name.startswith(data_type.lower()) for data_type in data_types)
+
+def data_type_clause(data_types: list[str]) -> tuple[str, list[str]]:
+    """SQL condition and arguments applying data_type_matches to a data_type column."""
+    patterns = [re.sub(r"([\\%_])", r"\\\1", data_type) + "%" for data_type in data_types]
+    return "(" + " OR ".join(["data_type LIKE ? ESCAPE '\\'"] * len(patterns)) + ")", patterns
+
+def _food_category(record: dict[str, Any]) -> str | None:
+    """Return the category description of a food record, whatever its data type."""
+    category = record.get("foodCategory")
+    if isinstance(category, dict):
+        return category.get("description")
+    if isinstance(category, str):
+        return category
+    wweia = record.get("wweiaFoodCategory")
+    if isinstance(wweia, dict):
+        return wweia.get("wweiaFoodCategoryDescription")
+    return record.get("brandedFoodCategory")
+
+def filter_food_nutrients(record: dict[str, Any], nutrient_numbers: list[str]) -> dict[str, Any]:
+    """Return a copy of a full food record keeping only the given nutrient numbers."""
+    wanted = set(nutrient_numbers)
+    filtered = dict(record)
+    filtered["foodNutrients"] = [
+        n for n in record.get("foodNutrients", [])
+        if str(n.get("nutrient", {}).get("number", "")) in wanted
+    ]
+    return filtered
+
+def search_hit_from_record(record: dict[str, Any]) -> dict[str, Any]:
+    """Convert a full food record to the shape fdc/v1/foods/search returns."""
+    hit = {
+        "fdcId": record.get("fdcId"),
+        "description": record.get("description"),
+        "dataType": record.get("dataType"),
+        "publishedDate": record.get("publicationDate"),
+        "foodCategory": _food_category(record),
+        "foodNutrients": [
+            {
+                "nutrientId": n.get("nutrient", {}).get("id"),
+                "nutrientName": n.get("nutrient", {}).get("name"),
+                "nutrientNumber": n.get("nutrient", {}).get("number"),
+                "unitName": n.get("nutrient", {}).get("unitName", "").upper(),
+                "value": n.get("amount")
+            }
+            for n in record.get("foodNutrients", [])
+            if "amount" in n
+        ]
+    }
+    for field in ("brandOwner", "brandName", "gtinUpc", "ingredients"):
+        if record.get(field):
+            hit[field] = record[field]
+    return hit
+
+def abridged_from_record(record: dict[str, Any]) -> dict[str, Any]:
+    """Convert a full food record to the abridged shape fdc/v1/foods/list returns."""
+    abridged = {
+        "fdcId": record.get("fdcId"),
+        "description": record.get("description"),
+        "dataType": record.get("dataType"),
+        "publicationDate": record.get("publicationDate"),
+        "foodNutrients": [
+            {
+                "number": n.get("nutrient", {}).get("number"),
+                "name": n.get("nutrient", {}).get("name"),
+                "amount": n.get("amount"),
+                "unitName": n.get("nutrient", {}).get("unitName", "").upper()
+            }
+            for n in record.get("foodNutrients", [])
+            if "amount" in n
+        ]
+    }
+    if record.get("brandOwner"):
+        abridged["brandOwner"] = record["brandOwner"]
+    return abridged
+
+class LocalFoodStore:
+    """Indexed SQLite store of FoodData Central records ingested from bulk downloads.
+
+    Each food is kept as a compressed full record (the same shape as
+    fdc/v1/food/{id}) next to a few indexed columns used for filtering.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS foods ("
+        " fdc_id INTEGER PRIMARY KEY,"
+        " data_type TEXT,"
+        " description TEXT,"
+        " brand_owner TEXT,"
+        " category TEXT,"
+        " publication_date TEXT,"
+        " record BLOB NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS foods_data_type ON foods (data_type, fdc_id)",
+        "CREATE INDEX IF NOT EXISTS foods_description ON foods (description COLLATE NOCASE)"
+    )
+
+    def __init__(self, path: Path = LOCAL_STORE_PATH, readonly: bool = True):
+        self.path = Path(path)
+        if readonly:
+            uri = f"{self.path.resolve().as_uri()}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM foods").fetchone()[0]
+
+    def _records(self, sql: str, args: tuple = ()) -> list[dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [json.loads(zlib.decompress(row[0])) for row in rows]
+
+    def get_food(self, fdc_id: int) -> dict[str, Any] | None:
+        """Return the full record for one FDC ID."""
+        records = self._records("SELECT record FROM foods WHERE fdc_id = ?", (fdc_id,))
+        return records[0] if records else None
+
+    def id_bitmap(self) -> "FoodIdBitmap":
+        """Build a bitmap of every stored FDC ID."""
+        with self._lock:
+            largest = self._conn.execute("SELECT MAX(fdc_id) FROM foods").fetchone()[0] or 0
+            bitmap = FoodIdBitmap(largest)
+            for (fdc_id,) in self._conn.execute("SELECT fdc_id FROM foods"):
+                bitmap.add(fdc_id)
+        return bitmap
+
+    def get_foods(self, fdc_ids: list[int]) -> list[dict[str, Any]]:
+        """Return full records for the FDC IDs present in the store."""
+        records = []
+        for start in range(0, len(fdc_ids), 500):
+            chunk = [int(i) for i in fdc_ids[start:start + 500]]
+            placeholders = ",".join("?" * len(chunk))
+            records += self._records(f"SELECT record FROM foods WHERE fdc_id IN ({placeholders})", tuple(chunk))
+        return records
+
+    def iter_records(self) -> Iterator[dict[str, Any]]:
+        """Stream every stored record without loading them all at once."""
+        for (blob,) in self._conn.execute("SELECT record FROM foods ORDER BY fdc_id"):
+            yield json.loads(zlib.decompress(blob))
+
+    def search(self, query: str, data_types: list[str], page_size: int, page_number: int) -> dict[str, Any]:
+        """Match every query term against description or brand owner.
+
+        Fallback used when no search index has been built.
+        """
+        clauses, args = [], []
+        for term in query.split():
+            clauses.append("(description LIKE ? OR brand_owner LIKE ?)")
+            args += [f"%{term}%", f"%{term}%"]
+        if data_types:
+            clause, patterns = data_type_clause(data_types)
+            clauses.append(clause)
+            args += patterns
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM foods {where}", args).fetchone()[0]
+        records = self._records(
+            f"SELECT record FROM foods {where} ORDER BY length(description), fdc_id LIMIT ? OFFSET ?",
+            (*args, page_size, (page_number - 1) * page_size)
+        )
+        return {
+            "totalHits": total,
+            "currentPage": page_number,
+            "totalPages": -(-total // page_size),
+            "foods": [search_hit_from_record(r) for r in records]
+        }
+
+    def list_page(self, data_types: list[str], page_size: int, page_number: int,
+                  sort_by: str = None, sort_order: str = None) -> list[dict[str, Any]]:
+        """Return one page of abridged records."""
+        args: list[Any] = []
+        where = ""
+        if data_types:
+            clause, args = data_type_clause(data_types)
+            where = f"WHERE {clause}"
+        column = LIST_SORT_COLUMNS.get(sort_by or "", "fdc_id")
+        direction = "DESC" if (sort_order or "").lower() == "desc" else "ASC"
+        records = self._records(
+            f"SELECT record FROM foods {where} ORDER BY {column} {direction} LIMIT ? OFFSET ?",
+            (*args, page_size, (page_number - 1) * page_size)
+        )
+        return [abridged_from_record(r) for r in records]
+
+    def request(self, endpoint: str, params: dict[str, Any] | None) -> Any:
+        """Answer a USDA API GET locally; return _MISSING if the store cannot."""
+        params = params or {}
+        page_size = min(int(params.get("pageSize", 50)), 200)
+        page_number = max(int(params.get("pageNumber", 1)), 1)
+        data_types = _split_list(params.get("dataType"))
+        if endpoint.startswith("fdc/v1/food/"):
+            record = self.get_food(int(endpoint.rsplit("/", 1)[1]))
+            if record is None:
+                return _MISSING
+            nutrient_numbers = _split_list(params.get("nutrients"))
+            return filter_food_nutrients(record, nutrient_numbers) if nutrient_numbers else record
+        if endpoint == "fdc/v1/foods/search":
+            return self.search(params.get("query", ""), data_types, page_size, page_number)
+        if endpoint == "fdc/v1/foods/list":
+            return self.list_page(data_types, page_size, page_number, params.get("sortBy"), params.get("sortOrder"))
+        return _MISSING
+
+    # Ingestion
+
+    def add_records(self, records: Iterator[dict[str, Any]]) -> int:
+        """Insert full food records in batches; return how many were stored."""
+        count = 0
+        batch = []
+        for record in records:
+            if "fdcId" not in record:
+                continue
+            batch.append((
+                int(record["fdcId"]),
+                record.get("dataType"),
+                record.get("description"),
+                record.get("brandOwner"),
+                _food_category(record),
+                record.get("publicationDate"),
+                zlib.compress(json.dumps(record, separators=(",", ":")).encode())
+            ))
+            if len(batch) >= INGEST_BATCH_SIZE:
+                count += self._insert(batch)
+                batch = []
+                if count % (INGEST_BATCH_SIZE * 50) == 0:
+                    logger.info("Ingested %d foods...", count)
+        if batch:
+            count += self._insert(batch)
+        return count
+
+    def _insert(self, batch: list[tuple]) -> int:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO foods VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        return len(batch)
+
+_local_store: LocalFoodStore | None = None
+_local_store_checked = False
+
+def get_local_store() -> LocalFoodStore | None:
+    """Return the ingested food store, or None if offline data is not in use."""
+    global _local_store, _local_store_checked
+    if BACKEND == "api":
+        return None
+    if not _local_store_checked:
+        _local_store_checked = True
+        if LOCAL_STORE_PATH.exists():
+            try:
+                _local_store = LocalFoodStore(LOCAL_STORE_PATH)
+            except sqlite3.Error as e:
+                logger.warning("Local food store unavailable: %s", e)
+        else:
+            logger.warning("Local food store not found at %s; run 'main.py ingest' first", LOCAL_STORE_PATH)
+    return _local_store
+
+class FoodIdBitmap:
+    """Set of FDC IDs stored as one bit per ID up to the largest.
+    
+    FDC IDs are dense integers below a few million, so even the full
+    database fits in a few hundred kilobytes, with O(1) lookups.
+    """
+    
+    __slots__ = ("_bits", "count")
+    
+    def __init__(self, largest: int):
+        self._bits = bytearray(largest // 8 + 1)
+        self.count = 0
+    
+    def add(self, fdc_id: int) -> None:
+        byte, bit = fdc_id >> 3, 1 << (fdc_id & 7)
+        if not self._bits[byte] & bit:
+            self._bits[byte] |= bit
+            self.count += 1
+    
+    def __contains__(self, fdc_id: int) -> bool:
+        byte = fdc_id >> 3
+        return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << (fdc_id & 7)))
+    
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+_known_food_ids: FoodIdBitmap | None = None
+
+def get_known_food_ids() -> FoodIdBitmap | None:
+    """Return the IDs of every existing food, if the local store is authoritative.
+    
+    That is the case with USDA_BACKEND=local (nothing else is consulted) or
+    when USDA_LOCAL_STORE_COMPLETE says every dataset was ingested.
+    """
+    global _known_food_ids
+    if _known_food_ids is None and (BACKEND == "local" or LOCAL_STORE_COMPLETE):
+        local_store = get_local_store()
+        if local_store is not None:
+            try:
+                _known_food_ids = local_store.id_bitmap()
+            except sqlite3.Error as e:
+                logger.warning("Known FDC ID set unavailable: %s", e)
+    return _known_food_ids
+
+class FoodNotFoundError(Exception):
+    """Raised when USDA answers a food lookup with 404."""
+
+class NegativeCache:
+    """Remember FDC IDs that do not exist, for a short TTL.
+    
+    Hallucinated or mistyped IDs are then answered without a round trip or
+    quota. The TTL is short because new foods are published over time.
+    """
+    
+    def __init__(self, ttl: float = NEGATIVE_CACHE_TTL, max_entries: int = NEGATIVE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[int, float] = OrderedDict()
+        self.hits = 0
+        self.added = 0
+    
+    def add(self, fdc_id: int) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries.pop(fdc_id, None)
+        self._entries[fdc_id] = time.monotonic() + self.ttl
+        self.added += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def __contains__(self, fdc_id: int) -> bool:
+        expires_at = self._entries.get(fdc_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._entries[fdc_id]
+            return False
+        return True
+    
+    def stats(self) -> dict[str, Any]:
+        """Return negative cache counters."""
+        return {"entries": len(self._entries), "hits": self.hits, "added": self.added}
+
+negative_cache = NegativeCache()
+
+def food_may_exist(fdc_id: int) -> bool:
+    """Cheap check that rules out impossible or known-missing FDC IDs without I/O."""
+    if fdc_id <= 0:
+        return False
+    if fdc_id in negative_cache:
+        negative_cache.hits += 1
+        return False
+    known_ids = get_known_food_ids()
+    return known_ids is None or fdc_id in known_ids
+
+def iter_json_array_items(stream: TextIO, chunk_size: int = 1 << 20) -> Iterator[dict[str, Any]]:
+    """Stream the items of a bulk download without loading the whole file.
+
+    Handles both `{"BrandedFoods": [...], ...}` and a bare top-level array.
+    Only one chunk plus the item being decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                return ""
+
+    def decode() -> Any:
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the value continues past the current chunk
+                if len(buffer) - pos > 64 * chunk_size or not fill():
+                    raise
+                continue
+            # A number at the end of the buffer may be truncated
+            if end == len(buffer) and not eof and fill():
+                continue
+            pos = end
+            return value
+
+    def items() -> Iterator[Any]:
+        nonlocal pos
+        pos += 1  # opening bracket
+        while True:
+            char = peek()
+            if char == "]":
+                pos += 1
+                return
+            if char == ",":
+                pos += 1
+                continue
+            if not char:
+                raise ValueError("Unexpected end of file inside array")
+            yield decode()
+
+    first = peek()
+    if first == "[":
+        yield from items()
+        return
+    if first != "{":
+        raise ValueError("Expected a JSON object or array at top level")
+    pos += 1
+    while True:
+        char = peek()
+        if char in ("}", ""):
+            return
+        if char == ",":
+            pos += 1
+            continue
+        decode()  # key
+        if peek() != ":":
+            raise ValueError("Malformed JSON object")
+        pos += 1
+        if peek() == "[":
+            yield from items()
+        else:
+            decode()
+
+class _BulkSource:
+    """A CSV bulk download, either an extracted directory or the original .zip."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path) if path.suffix == ".zip" else None
+
+    def has(self, name: str) -> bool:
+        if self._zip is None:
+            return (self.path / name).exists()
+        return self._member(name) is not None
+
+    def _member(self, name: str) -> str | None:
+        for member in self._zip.namelist():
+            if member == name or member.endswith(f"/{name}"):
+                return member
+        return None
+
+    def rows(self, name: str) -> Iterator[dict[str, str]]:
+        """Stream the rows of one CSV file as dicts."""
+        if not self.has(name):
+            return
+        if self._zip is None:
+            handle = open(self.path / name, newline="", encoding="utf-8")
+        else:
+            handle = io.TextIOWrapper(self._zip.open(self._member(name)), newline="", encoding="utf-8")
+        with handle:
+            yield from csv.DictReader(handle)
+
+def _number(value: str) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def iter_csv_records(source: _BulkSource, conn: sqlite3.Connection) -> Iterator[dict[str, Any]]:
+    """Assemble full food records from a CSV bulk download.
+
+    The large per-food tables (food_nutrient, food_portion, branded_food) are
+    streamed into temporary SQLite tables so that memory use stays flat, then
+    food.csv is streamed and joined against them one food at a time.
+    """
+    nutrients = {
+        row["id"]: {
+            "id": int(row["id"]),
+            "number": row.get("nutrient_nbr", ""),
+            "name": row["name"],
+            "rank": _number(row.get("rank")),
+            "unitName": CSV_UNIT_NAMES.get(row.get("unit_name", ""), row.get("unit_name", ""))
+        }
+        for row in source.rows("nutrient.csv")
+    }
+    categories = {row["id"]: row["description"] for row in source.rows("food_category.csv")}
+    measure_units = {row["id"]: row["name"] for row in source.rows("measure_unit.csv")}
+
+    conn.execute("CREATE TEMP TABLE staged_nutrients (fdc_id INTEGER, nutrient_id TEXT, amount REAL)")
+    conn.execute("CREATE TEMP TABLE staged_portions (fdc_id INTEGER, row TEXT)")
+    conn.execute("CREATE TEMP TABLE staged_branded (fdc_id INTEGER PRIMARY KEY, row TEXT)")
+
+    def stage(sql: str, rows: Iterator[tuple]) -> None:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= INGEST_BATCH_SIZE * 10:
+                conn.executemany(sql, batch)
+                batch = []
+        conn.executemany(sql, batch)
+
+    stage("INSERT INTO staged_nutrients VALUES (?, ?, ?)", (
+        (int(row["fdc_id"]), row["nutrient_id"], _number(row.get("amount")))
+        for row in source.rows("food_nutrient.csv")
+    ))
+    stage("INSERT INTO staged_portions VALUES (?, ?)", (
+        (int(row["fdc_id"]), json.dumps(row)) for row in source.rows("food_portion.csv")
+    ))
+    stage("INSERT OR REPLACE INTO staged_branded VALUES (?, ?)", (
+        (int(row["fdc_id"]), json.dumps(row)) for row in source.rows("branded_food.csv")
+    ))
+    conn.execute("CREATE INDEX staged_nutrients_fdc ON staged_nutrients (fdc_id)")
+    conn.execute("CREATE INDEX staged_portions_fdc ON staged_portions (fdc_id)")
+
+    for row in source.rows("food.csv"):
+        data_type = CSV_DATA_TYPES.get(row.get("data_type", ""))
+        if data_type is None:
+            continue
+        fdc_id = int(row["fdc_id"])
+        record: dict[str, Any] = {
+            "fdcId": fdc_id,
+            "description": row.get("description", ""),
+            "dataType": data_type,
+            "publicationDate": row.get("publication_date", "")
+        }
+        if row.get("food_category_id") in categories:
+            record["foodCategory"] = {"description": categories[row["food_category_id"]]}
+        branded = conn.execute("SELECT row FROM staged_branded WHERE fdc_id = ?", (fdc_id,)).fetchone()
+        if branded:
+            branded = json.loads(branded[0])
+            record.update({
+                "brandOwner": branded.get("brand_owner", ""),
+                "brandName": branded.get("brand_name", ""),
+                "gtinUpc": branded.get("gtin_upc", ""),
+                "ingredients": branded.get("ingredients", ""),
+                "servingSize": _number(branded.get("serving_size")),
+                "servingSizeUnit": branded.get("serving_size_unit", ""),
+                "householdServingFullText": branded.get("household_serving_fulltext", ""),
+                "brandedFoodCategory": branded.get("branded_food_category", "")
+            })
+        record["foodNutrients"] = [
+            {"type": "FoodNutrient", "nutrient": nutrients[nutrient_id], "amount": amount}
+            for nutrient_id, amount in conn.execute(
+                "SELECT nutrient_id, amount FROM staged_nutrients WHERE fdc_id = ?", (fdc_id,)
+            )
+            if nutrient_id in nutrients and amount is not None
+        ]
+        portions = []
+        for (portion_row,) in conn.execute("SELECT row FROM staged_portions WHERE fdc_id = ?", (fdc_id,)):
+            portion = json.loads(portion_row)
+            portions.append({
+                "id": int(portion["id"]) if portion.get("id") else None,
+                "sequenceNumber": _number(portion.get("seq_num")),
+                "amount": _number(portion.get("amount")),
+                "gramWeight": _number(portion.get("gram_weight")),
+                "portionDescription": portion.get("portion_description", ""),
+                "modifier": portion.get("modifier", ""),
+                "measureUnit": {"name": measure_units.get(portion.get("measure_unit_id"), "undetermined")}
+            })
+        if portions:
+            record["foodPortions"] = portions
+        yield record
+
+    for table in ("staged_nutrients", "staged_portions", "staged_branded"):
+        conn.execute(f"DROP TABLE {table}")
+
+def ingest_bulk_download(path: Path, store: LocalFoodStore) -> int:
+    """Ingest one bulk download (JSON file/zip, or CSV directory/zip) into the store."""
+    path = Path(path)
+    if path.is_dir() or (path.suffix == ".zip" and _BulkSource(path).has("food.csv")):
+        return store.add_records(iter_csv_records(_BulkSource(path), store._conn))
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            member = next(name for name in archive.namelist() if name.endswith(".json"))
+            with io.TextIOWrapper(archive.open(member), encoding="utf-8") as stream:
+                return store.add_records(iter_json_array_items(stream))
+    with open(path, encoding="utf-8") as stream:
+        return store.add_records(iter_json_array_items(stream))
+
+# Local search index settings
+SEARCH_INDEX_PATH = Path(os.getenv("USDA_SEARCH_INDEX_PATH", str(Path.home() / ".usda-api-mcp" / "search.idx")))
+LOCAL_SEARCH = _env_flag("USDA_LOCAL_SEARCH", BACKEND != "api")
+
+# BM25 parameters and per-field term weights
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_FIELD_WEIGHTS = (("description", 3), ("brandOwner", 2), ("ingredients", 1))
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def stem(token: str) -> str:
+    """Light suffix-stripping stemmer tuned for food descriptions.
+
+    Folds plurals and common cooking participles together, e.g.
+    tomatoes/tomato, berries/berry, dried/dry, baked/bake, cheeses/cheese.
+    """
+    if len(token) <= 3 or token.isdigit():
+        return token
+    if token.endswith("ies") or token.endswith("ied"):
+        token = token[:-3] + "y"
+    elif token.endswith(("sses", "shes", "ches", "xes", "zes", "oes")):
+        token = token[:-2]
+    elif token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        token = token[:-1]
+    if token.endswith("ing") and len(token) > 5:
+        token = token[:-3]
+    elif token.endswith("ed") and len(token) > 4:
+        token = token[:-2]
+    if token.endswith("e") and len(token) > 3:
+        token = token[:-1]
+    return token
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase stemmed terms."""
+    return [stem(token) for token in _TOKEN_PATTERN.findall(text.lower())]
+
+class SearchIndex:
+    """Inverted index over food descriptions, brand owners and ingredients.
+
+    Postings are stored in flat typed arrays (one contiguous run per term),
+    and the on-disk format is a small JSON header followed by the raw array
+    bytes, so loading is a handful of `frombytes` calls.
+    """
+
+    MAGIC = b"USDAIDX1"
+
+    def __init__(self):
+        self.terms: dict[str, int] = {}
+        self.data_types: list[str] = []
+        self.fdc_ids = array("q")
+        self.doc_lengths = array("I")
+        self.doc_types = array("B")
+        self.term_offsets = array("I", [0])
+        self.postings_docs = array("I")
+        self.postings_tfs = array("H")
+        self.avg_doc_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self.fdc_ids)
+
+    @classmethod
+    def build(cls, records: Iterator[dict[str, Any]]) -> "SearchIndex":
+        """Build an index from full or search-shaped food records."""
+        index = cls()
+        postings: dict[str, tuple[array, array]] = {}
+        type_codes: dict[str, int] = {}
+        seen: set[int] = set()
+        for record in records:
+            fdc_id = record.get("fdcId")
+            if fdc_id is None or fdc_id in seen:
+                continue
+            seen.add(fdc_id)
+            doc = len(index.fdc_ids)
+            counts: dict[str, int] = {}
+            for field, weight in SEARCH_FIELD_WEIGHTS:
+                for term in tokenize(str(record.get(field) or "")):
+                    counts[term] = counts.get(term, 0) + weight
+            data_type = record.get("dataType") or ""
+            if data_type not in type_codes:
+                type_codes[data_type] = len(index.data_types)
+                index.data_types.append(data_type)
+            index.fdc_ids.append(int(fdc_id))
+            index.doc_lengths.append(sum(counts.values()))
+            index.doc_types.append(type_codes[data_type])
+            for term, tf in counts.items():
+                docs, tfs = postings.setdefault(term, (array("I"), array("H")))
+                docs.append(doc)
+                tfs.append(min(tf, 65535))
+        for term in sorted(postings):
+            docs, tfs = postings[term]
+            index.terms[term] = len(index.terms)
+            index.postings_docs.extend(docs)
+            index.postings_tfs.extend(tfs)
+            index.term_offsets.append(len(index.postings_docs))
+        index.avg_doc_length = sum(index.doc_lengths) / len(index.doc_lengths) if index.doc_lengths else 0.0
+        return index
+
+    def save(self, path: Path) -> None:
+        """Write the index atomically in its compact binary format."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = (self.fdc_ids, self.doc_lengths, self.doc_types, self.term_offsets,
+                  self.postings_docs, self.postings_tfs)
+        header = json.dumps({
+            "terms": "\n".join(self.terms),
+            "data_types": self.data_types,
+            "avg_doc_length": self.avg_doc_length,
+            "lengths": [len(a) for a in arrays]
+        }).encode()
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for values in arrays:
+                values.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "SearchIndex":
+        """Read an index written by save()."""
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:8] != cls.MAGIC:
+            raise ValueError(f"{path} is not a search index")
+        header_length = struct.unpack_from("<I", data, 8)[0]
+        header = json.loads(data[12:12 + header_length])
+        index = cls()
+        index.terms = {term: i for i, term in enumerate(header["terms"].split("\n"))} if header["terms"] else {}
+        index.data_types = header["data_types"]
+        index.avg_doc_length = header["avg_doc_length"]
+        offset = 12 + header_length
+        arrays = (index.fdc_ids, index.doc_lengths, index.doc_types, index.term_offsets,
+                  index.postings_docs, index.postings_tfs)
+        del index.term_offsets[:]
+        for values, length in zip(arrays, header["lengths"]):
+            size = length * values.itemsize
+            values.frombytes(data[offset:offset + size])
+            offset += size
+        return index
+
+    def search(self, query: str, data_types: list[str], page_size: int, page_number: int,
+               require_all_words: bool = False) -> tuple[int, list[int]]:
+        """Rank documents with BM25; return (total hits, FDC IDs of the requested page)."""
+        allowed = None
+        if data_types:
+            allowed = {code for code, name in enumerate(self.data_types) if data_type_matches(name, data_types)}
+        query_terms = [t for t in dict.fromkeys(tokenize(query)) if t in self.terms]
+        if not query_terms or (require_all_words and len(query_terms) < len(set(tokenize(query)))):
+            return 0, []
+        if np is not None:
+            return self._search_numpy(query_terms, allowed, page_size, page_number, require_all_words)
+        total_docs = len(self.fdc_ids)
+        # BM25 denominator: tf + k1 * (1 - b + b * doc_length / avg_doc_length)
+        norm = BM25_K1 * (1 - BM25_B)
+        length_factor = BM25_K1 * BM25_B / (self.avg_doc_length or 1)
+        scores: dict[int, float] = {}
+        matched: dict[int, int] = {}
+        for term in query_terms:
+            i = self.terms[term]
+            start, end = self.term_offsets[i], self.term_offsets[i + 1]
+            df = end - start
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            for doc, tf in zip(self.postings_docs[start:end], self.postings_tfs[start:end]):
+                if allowed is not None and self.doc_types[doc] not in allowed:
+                    continue
+                denominator = tf + norm + length_factor * self.doc_lengths[doc]
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / denominator
+                matched[doc] = matched.get(doc, 0) + 1
+        if require_all_words:
+            scores = {doc: score for doc, score in scores.items() if matched[doc] == len(query_terms)}
+        top = heapq.nlargest(page_size * page_number, scores.items(),
+                             key=lambda item: (item[1], -self.fdc_ids[item[0]]))
+        page = top[(page_number - 1) * page_size:]
+        return len(scores), [self.fdc_ids[doc] for doc, _ in page]
+
+    def _numpy_views(self) -> dict[str, Any]:
+        """Zero-copy NumPy views of the index arrays, created once."""
+        views = getattr(self, "_views", None)
+        if views is None:
+            doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32).astype(np.float64)
+            views = self._views = {
+                "fdc_ids": np.frombuffer(self.fdc_ids, dtype=np.int64),
+                "doc_types": np.frombuffer(self.doc_types, dtype=np.uint8),
+                "postings_docs": np.frombuffer(self.postings_docs, dtype=np.uint32),
+                "postings_tfs": np.frombuffer(self.postings_tfs, dtype=np.uint16),
+                # BM25 denominator without tf: k1 * (1 - b + b * doc_length / avg_doc_length)
+                "length_norm": BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / (self.avg_doc_length or 1))
+            }
+        return views
+
+    def _search_numpy(self, query_terms: list[str], allowed: set[int] | None, page_size: int,
+                      page_number: int, require_all_words: bool) -> tuple[int, list[int]]:
+        """Vectorized BM25 scoring used when NumPy is installed."""
+        views = self._numpy_views()
+        total_docs = len(self.fdc_ids)
+        scores = np.zeros(total_docs, dtype=np.float64)
+        matched = np.zeros(total_docs, dtype=np.uint8)
+        for term in query_terms:
+            i = self.terms[term]
+            start, end = self.term_offsets[i], self.term_offsets[i + 1]
+            docs = views["postings_docs"][start:end]
+            tfs = views["postings_tfs"][start:end].astype(np.float64)
+            df = end - start
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            # Doc IDs are unique within one term's postings, so fancy-index adds are safe
+            scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + views["length_norm"][docs])
+            matched[docs] += 1
+        mask = matched == len(query_terms) if require_all_words else matched > 0
+        if allowed is not None:
+            mask &= np.isin(views["doc_types"], np.fromiter(allowed, dtype=np.uint8))
+        candidates = np.flatnonzero(mask)
+        total = len(candidates)
+        wanted = min(page_size * page_number, total)
+        if not wanted:
+            return total, []
+        candidate_scores = scores[candidates]
+        if wanted < total:
+            # Keep everything tied with the cut-off score so ties break by FDC ID
+            cutoff = -np.partition(-candidate_scores, wanted - 1)[wanted - 1]
+            top = np.flatnonzero(candidate_scores >= cutoff)
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+        # Highest score first, ties broken by lowest FDC ID
+        order = np.lexsort((views["fdc_ids"][candidates], -candidate_scores))
+        page = candidates[order][(page_number - 1) * page_size:wanted]
+        return total, views["fdc_ids"][page].tolist()
+
+_search_index: SearchIndex | None = None
+_search_index_checked = False
+
+def get_search_index() -> SearchIndex | None:
+    """Return the local search index, loading it on first use (None if unavailable)."""
+    global _search_index, _search_index_checked
+    if not LOCAL_SEARCH:
+        return None
+    if not _search_index_checked:
+        _search_index_checked = True
+        if SEARCH_INDEX_PATH.exists():
+            try:
+                _search_index = SearchIndex.load(SEARCH_INDEX_PATH)
+            except (OSError, ValueError) as e:
+                logger.warning("Local search index unavailable: %s", e)
+    return _search_index
+
+async def load_food_records(fdc_ids: list[int]) -> dict[int, dict[str, Any]]:
+    """Find full food records locally: ingested store, then the response caches.
+    
+    SQLite reads run in a worker thread, one batch per store, so they do not
+    block the event loop.
+    """
+    found: dict[int, dict[str, Any]] = {}
+    local_store = get_local_store()
+    if local_store is not None and fdc_ids:
+        found = {record["fdcId"]: record for record in await asyncio.to_thread(local_store.get_foods, fdc_ids)}
+    missing = []
+    for fdc_id in fdc_ids:
+        if fdc_id not in found:
+            record = response_cache.get(food_cache_key(fdc_id), _MISSING)
+            if record is _MISSING:
+                missing.append(fdc_id)
+            else:
+                found[fdc_id] = record
+    disk_cache = get_disk_cache()
+    if disk_cache is not None and missing:
+        def read_disk() -> dict[int, dict[str, Any]]:
+            entries = {fdc_id: disk_cache.get(food_cache_key(fdc_id)) for fdc_id in missing}
+            return {fdc_id: entry[0] for fdc_id, entry in entries.items() if entry is not None}
+        found.update(await asyncio.to_thread(read_disk))
+    return found
+
+async def local_search(index: SearchIndex, params: dict[str, Any]) -> dict[str, Any]:
+    """Answer fdc/v1/foods/search from the local index."""
+    page_size = min(int(params.get("pageSize", 50)), 200)
+    page_number = max(int(params.get("pageNumber", 1)), 1)
+    require_all = str(params.get("requireAllWords", "")).lower() == "true"
+    total, fdc_ids = await asyncio.to_thread(index.search, params.get("query", ""), _split_list(params.get("dataType")),
+                                             page_size, page_number, require_all)
+    records = await load_food_records(fdc_ids)
+    foods = [search_hit_from_record(records[fdc_id]) for fdc_id in fdc_ids if fdc_id in records]
+    return {
+        "totalHits": total,
+        "currentPage": page_number,
+        "totalPages": -(-total // page_size),
+        "foods": foods
+    }
+
+def iter_indexable_records(store_path: Path = LOCAL_STORE_PATH) -> Iterator[dict[str, Any]]:
+    """Yield every food record available locally: ingested first, then cached."""
+    if Path(store_path).exists():
+        store = LocalFoodStore(store_path)
+        try:
+            yield from store.iter_records()
+        finally:
+            store.close()
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        yield from disk_cache.iter_food_records()
+
+def build_search_index(store_path: Path = LOCAL_STORE_PATH, index_path: Path = SEARCH_INDEX_PATH) -> SearchIndex:
+    """Rebuild the on-disk search index from ingested and cached records."""
+    index = SearchIndex.build(iter_indexable_records(store_path))
+    index.save(index_path)
+    return index
+
+class UpstreamUnavailableError(Exception):
+    """Base class for failing fast without contacting USDA."""
+
+class QuotaExhaustedError(UpstreamUnavailableError):
+    """Raised when no upstream request slot frees up within the allowed wait."""
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Raised while the circuit breaker is open after repeated upstream failures."""
+
+class RateLimiter:
+    """Token bucket shared by every upstream call, with a priority wait queue.
+
+    Tokens refill continuously at the hourly quota rate up to a burst size.
+    When the bucket is empty, callers queue by priority (then arrival) and
+    only the head of the queue may take the next token, so interactive
+    lookups overtake background prefetch and pagination. The bucket is
+    clamped to the `X-RateLimit-Remaining` value reported by api.data.gov.
+    """
+
+    def __init__(self, per_hour: float = RATE_LIMIT_PER_HOUR, burst: float = RATE_LIMIT_BURST):
+        self.rate = per_hour / 3600
+        self.capacity = burst
+        self.tokens = burst
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Event]] = []
+        self._sequence = itertools.count()
+        self.server_remaining: int | None = None
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wake_head(self) -> None:
+        if self._waiters:
+            self._waiters[0][2].set()
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, max_wait: float = RATE_LIMIT_MAX_WAIT) -> None:
+        """Take one request slot, waiting up to `max_wait` seconds for it."""
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.granted += 1
+            return
+        
+        entry = (priority, next(self._sequence), asyncio.Event())
+        heapq.heappush(self._waiters, entry)
+        self.queued += 1
+        start = time.monotonic()
+        deadline = start + max_wait
+        try:
+            while True:
+                self._refill()
+                is_head = self._waiters[0] is entry
+                if is_head and self.tokens >= 1:
+                    heapq.heappop(self._waiters)
+                    self.tokens -= 1
+                    self.granted += 1
+                    self.total_wait += time.monotonic() - start
+                    self._wake_head()
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (is_head and (1 - self.tokens) / self.rate > remaining):
+                    self.rejected += 1
+                    raise QuotaExhaustedError(
+                        f"USDA API quota exhausted: no request slot available within {max_wait:g}s "
+                        f"(limit {self.rate * 3600:g} requests/hour). Try again later."
+                    )
+                if is_head:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                else:
+                    entry[2].clear()
+                    try:
+                        await asyncio.wait_for(entry[2].wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._wake_head()
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free right now and nobody is queued."""
+        self._refill()
+        if self._waiters or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.granted += 1
+        return True
+
+    def available(self) -> float:
+        """Tokens free right now for callers that must not queue."""
+        self._refill()
+        return 0.0 if self._waiters else self.tokens
+
+    def observe(self, response: httpx.Response) -> None:
+        """Align the bucket with the quota the server reports."""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.isdigit():
+            self.server_remaining = int(remaining)
+            self._refill()
+            self.tokens = min(self.tokens, self.server_remaining)
+        if response.status_code == 429:
+            self.tokens = 0
+
+    def stats(self) -> dict[str, Any]:
+        """Return limiter counters and current state."""
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "waiting": len(self._waiters),
+            "server_remaining": self.server_remaining,
+            "granted": self.granted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "total_wait_s": round(self.total_wait, 3)
+        }
+
+rate_limiter = RateLimiter()
+
+class CircuitBreaker:
+    """Fail fast while USDA is down instead of waiting on every call.
+
+    After `threshold` consecutive transient failures the circuit opens and
+    calls are rejected for `cooldown` seconds. Then a single probe request
+    is let through (half-open): success closes the circuit, failure opens it
+    again.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if a request may not be sent now."""
+        if self.state == "open":
+            remaining = self.cooldown - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                self.short_circuited += 1
+                raise CircuitOpenError(
+                    f"USDA API temporarily unavailable after repeated failures; retrying in {remaining:.0f}s"
+                )
+            self.state = "half-open"
+        if self.state == "half-open":
+            if self._probe_in_flight:
+                self.short_circuited += 1
+                raise CircuitOpenError("USDA API temporarily unavailable; waiting for a probe request")
+            self._probe_in_flight = True
+
+    def release_probe(self) -> None:
+        """Let another probe through after one ended without a verdict."""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == "half-open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited
+        }
+
+circuit_breaker = CircuitBreaker()
+
+class LatencyTracker:
+    """Rolling window of upstream latencies used to pick the hedging delay."""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque[float] = deque(maxlen=window)
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.retries = 0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> float | None:
+        """Return the pct-th percentile latency, or None with too few samples."""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def stats(self) -> dict[str, Any]:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "samples": len(self._samples),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "retries": self.retries,
+            "hedges_sent": self.hedges_sent,
+            "hedges_won": self.hedges_won
+        }
+
+upstream_latency = LatencyTracker()
+
+def endpoint_route(endpoint: str) -> str:
+    """Collapse per-food endpoints so metrics are grouped by route."""
+    return "fdc/v1/food/{id}" if endpoint.startswith("fdc/v1/food/") else endpoint
+
+class Histogram:
+    """Fixed-bucket histogram; recording is a bisect and two additions."""
+
+    # Upper bounds in seconds, roughly 1-2.5-5 spaced from 0.1ms to 30s
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+              0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound of the bucket holding the pct-th percentile (max for the last bucket)."""
+        rank = self.count * pct / 100
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict[str, Any]:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p95_ms": round(self.percentile(95) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "buckets_ms": {
+                (f"{bound * 1000:g}" if i < len(self.BOUNDS) else "+Inf"): count
+                for i, (bound, count) in enumerate(zip(self.BOUNDS + (math.inf,), self.counts)) if count
+            }
+        }
+
+class ToolMetrics:
+    """Per-tool call counters and latency split into data access and formatting."""
+
+    __slots__ = ("calls", "errors", "in_flight", "latency", "data", "format")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+        # Time spent obtaining data (cache, local store, rate limiter, network, JSON decode)
+        self.data = Histogram()
+        # Everything else: argument parsing and building the response text
+        self.format = Histogram()
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "latency": self.latency.snapshot(),
+            "data": self.data.snapshot(),
+            "format": self.format.snapshot()
+        }
+
+class EndpointMetrics:
+    """Per-route upstream latency, status codes, response sizes and decode time."""
+
+    __slots__ = ("latency", "decode", "statuses", "bytes_total", "bytes_max")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.decode = Histogram()
+        self.statuses: dict[str, int] = {}
+        self.bytes_total = 0
+        self.bytes_max = 0
+
+    def snapshot(self) -> dict[str, Any]:
+        requests = sum(self.statuses.values())
+        return {
+            "latency": self.latency.snapshot(),
+            "json_decode": self.decode.snapshot(),
+            "status_codes": dict(sorted(self.statuses.items())),
+            "bytes_total": self.bytes_total,
+            "bytes_max": self.bytes_max,
+            "bytes_mean": round(self.bytes_total / requests) if requests else 0
+        }
+
+class Metrics:
+    """Server-wide instrumentation registry, read by the stats resource and tool."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.tools: dict[str, ToolMetrics] = {}
+        self.endpoints: dict[str, EndpointMetrics] = {}
+        self.upstream_in_flight = 0
+
+    def tool(self, name: str) -> ToolMetrics:
+        entry = self.tools.get(name)
+        if entry is None:
+            entry = self.tools[name] = ToolMetrics()
+        return entry
+
+    def endpoint(self, endpoint: str) -> EndpointMetrics:
+        route = endpoint_route(endpoint)
+        entry = self.endpoints.get(route)
+        if entry is None:
+            entry = self.endpoints[route] = EndpointMetrics()
+        return entry
+
+    def record_upstream(self, endpoint: str, seconds: float, status: str, size: int = 0) -> None:
+        """Record one upstream attempt and its outcome (status code or error name)."""
+        entry = self.endpoint(endpoint)
+        entry.latency.record(seconds)
+        entry.statuses[status] = entry.statuses.get(status, 0) + 1
+        entry.bytes_total += size
+        if size > entry.bytes_max:
+            entry.bytes_max = size
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "timestamp": round(time.time(), 3),
+            "uptime_s": round(time.time() - self.started, 1),
+            "tools": {name: entry.snapshot() for name, entry in sorted(self.tools.items())},
+            "upstream": {
+                "in_flight": self.upstream_in_flight,
+                "endpoints": {route: entry.snapshot() for route, entry in sorted(self.endpoints.items())}
+            }
+        }
+
+metrics = Metrics()
+
+# Per tool call timing state, shared with the tasks a tool call spawns
+_tool_call: contextvars.ContextVar[dict[str, Any] | None] = contextvars.ContextVar("usda_tool_call", default=None)
+
+def instrumented(fn: Callable[..., Awaitable[str]]) -> Callable[..., Awaitable[str]]:
+    """Record latency, errors and in-flight count of a tool."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return await fn(*args, **kwargs)
+        entry = metrics.tool(name)
+        entry.calls += 1
+        entry.in_flight += 1
+        call = {"data": 0.0, "depth": 0}
+        token = _tool_call.set(call)
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await fn(*args, **kwargs)
+            failed = isinstance(result, str) and result.startswith("Error")
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            _tool_call.reset(token)
+            entry.in_flight -= 1
+            entry.errors += failed
+            entry.latency.record(elapsed)
+            entry.data.record(call["data"])
+            entry.format.record(max(0.0, elapsed - call["data"]))
+    return wrapper
+
+def data_access(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Attribute the time of the outermost data fetch to the calling tool."""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        call = _tool_call.get()
+        if call is None or call["depth"]:
+            return await fn(*args, **kwargs)
+        call["depth"] += 1
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            call["data"] += time.perf_counter() - start
+            call["depth"] -= 1
+    return wrapper
+
+def decode_json(endpoint: str, response: httpx.Response) -> Any:
+    """Decode a response body, timing it per route."""
+    if not METRICS_ENABLED:
+        return response.json()
+    start = time.perf_counter()
+    data = response.json()
+    metrics.endpoint(endpoint).decode.record(time.perf_counter() - start)
+    return data
+
+def collect_server_stats() -> dict[str, Any]:
+    """Gather metrics and the state of every cache, queue and breaker."""
+    stats = metrics.snapshot()
+    disk_cache = get_disk_cache()
+    try:
+        disk_stats = disk_cache.stats() if disk_cache is not None else None
+    except sqlite3.Error as e:
+        disk_stats = {"error": str(e)}
+    stats.update({
+        "metrics_enabled": METRICS_ENABLED,
+        "cache": {"memory": response_cache.stats(), "disk": disk_stats,
+                  "ranges": result_ranges.stats(), "refresh": cache_refresher.stats(),
+                  "negative": negative_cache.stats()},
+        "analysis": {"matrix": _food_matrix.stats() if _food_matrix is not None else None,
+                     "similarity": _similarity_index.stats() if _similarity_index is not None else None},
+        "coalescing": singleflight.stats(),
+        "prefetch": prefetcher.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "circuit_breaker": circuit_breaker.stats(),
+        "resilience": upstream_latency.stats()
+    })
+    return stats
+
+async def _metrics_writer_loop() -> None:
+    """Append a stats snapshot to METRICS_FILE every METRICS_INTERVAL seconds."""
+    path = Path(METRICS_FILE).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write_line() -> None:
+        line = json.dumps(collect_server_stats(), separators=(",", ":"))
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            await asyncio.to_thread(write_line)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Metrics write failed: %s", e)
+
+def retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    """Seconds to wait before retry number `attempt` (0-based).
+
+    Honors a Retry-After header when present; otherwise uses exponential
+    backoff with full jitter.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# Shared network server settings (main.py serve)
+SERVER_TRANSPORT = os.getenv("USDA_TRANSPORT", "streamable-http")
+SERVER_HOST = os.getenv("USDA_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("USDA_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("USDA_WORKERS", "1"))
+SERVER_SHUTDOWN_TIMEOUT = float(os.getenv("USDA_SHUTDOWN_TIMEOUT", "30"))
+
+# HTTP workers manage resources for the process, not per MCP session
+_process_managed = False
+
+@asynccontextmanager
+async def server_resources() -> AsyncIterator[None]:
+    """Start background maintenance and release resources on shutdown."""
+    tasks = [asyncio.create_task(_disk_cache_eviction_loop())]
+    if CACHE_ENABLED and CACHE_REFRESH_TOP_N > 0:
+        tasks.append(asyncio.create_task(_cache_refresh_loop()))
+    if METRICS_FILE:
+        tasks.append(asyncio.create_task(_metrics_writer_loop()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        prefetcher.cancel()
+        cache_refresher.cancel()
+        await close_http_client()
+        if _disk_cache is not None:
+            _disk_cache.close()
+        if _local_store is not None:
+            _local_store.close()
+
+@asynccontextmanager
+async def server_lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """Per-session lifespan: stdio runs one session per process, HTTP one per request."""
+    if _process_managed:
+        yield
+        return
+    async with server_resources():
+        yield
+
+# Initialize FastMCP server
+mcp = FastMCP("usda-api", lifespan=server_lifespan)
+
+@data_access
+async def make_usda_request(endpoint: str, params: dict[str, Any] = None,
+                            priority: int = PRIORITY_INTERACTIVE) -> dict[str, Any] | None:
+    """Make a request to the USDA API with proper error handling."""
+    # Unknown FDC IDs are answered before any lookup
+    if endpoint.startswith("fdc/v1/food/") and not food_may_exist(int(endpoint.rsplit("/", 1)[1])):
+        return None
+    if endpoint == "fdc/v1/foods/search":
+        search_index = get_search_index()
+        if search_index is not None:
+            return await local_search(search_index, params or {})
+    # Answer from ingested bulk data when the offline backend is enabled
+    local_store = get_local_store()
+    if local_store is not None and (BACKEND == "local" or endpoint.startswith("fdc/v1/food/")):
+        data = await asyncio.to_thread(local_store.request, endpoint, params)
+        if data is not _MISSING:
+            return data
+    if BACKEND == "local":
+        return None
+    
+    if not API_KEY:
+        raise ValueError("USDA_API_KEY environment variable is required")
+    
+    # Pages inside an already fetched range of results need no upstream call
+    if endpoint in PAGED_ENDPOINTS and CACHE_ENABLED and CACHE_RANGE_MAX_RESULTS > 0:
+        return await result_ranges.page(endpoint, params or {}, priority)
+    return await cached_request(endpoint, params, priority)
+
+async def cached_request(endpoint: str, params: dict[str, Any] | None,
+                         priority: int = PRIORITY_INTERACTIVE) -> Any:
+    """GET one upstream response through the memory/disk cache and request coalescing."""
+    # Serve repeated lookups from the memory or disk cache
+    ttl = cache_ttl_for(endpoint) if CACHE_ENABLED else 0
+    cache_key = make_cache_key(endpoint, params)
+    if ttl:
+        cached = await cache_lookup(cache_key)
+        if cached is not _MISSING:
+            return cached
+        # A prefetch already fetching this food is cheaper to wait for than a new request
+        if await prefetcher.join(cache_key):
+            cached = await cache_lookup(cache_key)
+            if cached is not _MISSING:
+                return cached
+    
+    # Concurrent identical requests share one upstream call
+    try:
+        return await singleflight.do(cache_key, lambda: _fetch_usda(endpoint, params, cache_key, ttl, priority))
+    except FoodNotFoundError:
+        return None
+    except Exception:
+        # Serve an expired copy rather than nothing while USDA is unavailable
+        if ttl:
+            stale = await cache_lookup_stale(cache_key)
+            if stale is not _MISSING:
+                logger.warning("Serving stale %s: upstream unavailable", cache_key)
+                return stale
+        raise
+
+async def _send_once(method: str, endpoint: str, priority: int, kwargs: dict[str, Any],
+                     hedge: bool = False) -> httpx.Response:
+    """One upstream attempt through the rate limiter and the shared client."""
+    if RATE_LIMIT_ENABLED and not hedge:
+        await rate_limiter.acquire(priority)
+    start = time.monotonic()
+    if not METRICS_ENABLED:
+        response = await get_http_client().request(method, f"{USDA_API_BASE}/{endpoint}", **kwargs)
+    else:
+        metrics.upstream_in_flight += 1
+        try:
+            response = await get_http_client().request(method, f"{USDA_API_BASE}/{endpoint}", **kwargs)
+        except asyncio.CancelledError:
+            # Usually the losing half of a hedged pair
+            metrics.record_upstream(endpoint, time.monotonic() - start, "cancelled")
+            raise
+        except Exception as e:
+            metrics.record_upstream(endpoint, time.monotonic() - start, type(e).__name__)
+            raise
+        else:
+            metrics.record_upstream(endpoint, time.monotonic() - start, str(response.status_code), len(response.content))
+        finally:
+            metrics.upstream_in_flight -= 1
+    upstream_latency.record(time.monotonic() - start)
+    rate_limiter.observe(response)
+    return response
+
+async def _send_hedged(method: str, endpoint: str, priority: int, kwargs: dict[str, Any]) -> httpx.Response:
+    """Send an attempt, racing a duplicate if it is slower than the hedge percentile."""
+    delay = upstream_latency.percentile(HEDGE_PERCENTILE) if HEDGE_ENABLED else None
+    if delay is None:
+        return await _send_once(method, endpoint, priority, kwargs)
+    primary = asyncio.ensure_future(_send_once(method, endpoint, priority, kwargs))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    # Hedges only use spare quota; never queue for them
+    if done or (RATE_LIMIT_ENABLED and not rate_limiter.try_acquire()):
+        return await primary
+    upstream_latency.hedges_sent += 1
+    hedge = asyncio.ensure_future(_send_once(method, endpoint, priority, kwargs, hedge=True))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code not in RETRYABLE_STATUS_CODES:
+                    if task is hedge:
+                        upstream_latency.hedges_won += 1
+                    return task.result()
+        # Both attempts failed; report the primary's outcome
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def send_upstream(method: str, endpoint: str, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> httpx.Response:
+    """Send a request to USDA with retries, circuit breaking and optional hedging.
+    
+    Only idempotent lookups are sent through here (GETs and the read-only
+    fdc/v1/foods POST), so every attempt is safe to repeat.
+    """
+    attempt = 0
+    while True:
+        circuit_breaker.check()
+        response = None
+        try:
+            response = await _send_hedged(method, endpoint, priority, kwargs)
+        except httpx.TransportError:
+            circuit_breaker.record_failure()
+            if attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                raise
+        except BaseException:
+            # Quota exhaustion or cancellation says nothing about USDA's health
+            circuit_breaker.release_probe()
+            raise
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                circuit_breaker.record_success()
+                response.raise_for_status()
+                return response
+            if response.status_code >= 500:
+                circuit_breaker.record_failure()
+            else:
+                # 429 means we are over quota, not that USDA is down
+                circuit_breaker.record_success()
+            if attempt + 1 >= RETRY_MAX_ATTEMPTS:
+                response.raise_for_status()
+        delay = retry_delay(attempt, response)
+        if response is not None and delay > RETRY_MAX_DELAY:
+            # Retry-After asks for longer than we are willing to wait
+            response.raise_for_status()
+        attempt += 1
+        upstream_latency.retries += 1
+        await asyncio.sleep(delay)
+
+async def _fetch_usda(endpoint: str, params: dict[str, Any] | None, cache_key: str, ttl: float,
+                      priority: int = PRIORITY_INTERACTIVE) -> Any:
+    """Perform the upstream GET for make_usda_request and cache the result."""
+    # Add API key to parameters
+    if params is None:
+        params = {}
+    params["api_key"] = API_KEY
+    
+    try:
+        response = await send_upstream("GET", endpoint, priority, params=params)
+        data = decode_json(endpoint, response)
+        if ttl:
+            await cache_store(cache_key, data, response.content, ttl)
+        return data
+    except UpstreamUnavailableError:
+        raise
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404 and endpoint.startswith("fdc/v1/food/"):
+            negative_cache.add(int(endpoint.rsplit("/", 1)[1]))
+            raise FoodNotFoundError(endpoint)
+        raise Exception(f"USDA API request failed: {e}")
+    except httpx.HTTPError as e:
+        raise Exception(f"USDA API request failed: {e}")
+    except Exception as e:
+        raise Exception(f"Unexpected error: {e}")
+
+# Endpoints whose results are addressed by pageSize/pageNumber
+PAGED_ENDPOINTS = ("fdc/v1/foods/search", "fdc/v1/foods/list")
+
+class ResultRange:
+    """Results of one search or list query, by offset."""
+    
+    __slots__ = ("items", "end", "extra", "expires_at")
+    
+    def __init__(self, expires_at: float):
+        self.items: dict[int, dict[str, Any]] = {}
+        # Number of results (totalHits, or the offset after a short page); None while unknown
+        self.end: int | None = None
+        # Search response fields other than the results
+        self.extra: dict[str, Any] = {}
+        self.expires_at = expires_at
+
+def covering_page(start: int, stop: int) -> tuple[int, int] | None:
+    """Smallest (pageSize, pageNumber) whose page contains offsets [start, stop), if any."""
+    for page_size in range(stop - start, 201):
+        page = start // page_size
+        if (page + 1) * page_size >= stop:
+            return page_size, page + 1
+    return None
+
+class ResultRangeCache:
+    """Cache search and list results at offset granularity.
+    
+    Results are kept per normalized query, data type and sort order rather
+    than per (pageSize, pageNumber), so page 2 of 25 is served from an
+    earlier page 1 of 100. Only offsets not yet fetched go upstream, as the
+    smallest page covering them; those pages still pass through the
+    response cache. Ranges expire with the TTL of their first page and are
+    evicted least-recently-used above `max_results` cached results.
+    """
+    
+    def __init__(self, max_results: int = CACHE_RANGE_MAX_RESULTS):
+        self.max_results = max_results
+        self._ranges: OrderedDict[str, ResultRange] = OrderedDict()
+        self.total_results = 0
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+    
+    @staticmethod
+    def range_key(endpoint: str, params: dict[str, Any]) -> str:
+        """Key of a query regardless of page size and number."""
+        normalized = {name: value for name, value in params.items() if name not in ("pageSize", "pageNumber")}
+        if "query" in normalized:
+            normalized["query"] = " ".join(str(normalized["query"]).lower().split())
+        if "dataType" in normalized:
+            normalized["dataType"] = sorted(_split_list(normalized["dataType"]))
+        return make_cache_key(endpoint, normalized)
+    
+    async def page(self, endpoint: str, params: dict[str, Any], priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """Answer one page request, fetching only the offsets not cached yet."""
+        page_size = min(int(params.get("pageSize", 50)), 200)
+        page_number = max(int(params.get("pageNumber", 1)), 1)
+        start = (page_number - 1) * page_size
+        key = self.range_key(endpoint, params)
+        
+        entry = self._ranges.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            self._discard(key)
+            entry = None
+        if entry is not None:
+            self._ranges.move_to_end(key)
+            stop = start + page_size if entry.end is None else min(start + page_size, entry.end)
+            missing = [offset for offset in range(start, stop) if offset not in entry.items]
+            if not missing:
+                self.hits += 1
+                return self._response(endpoint, entry, start, page_size, page_number)
+            self.partial += 1
+            fetch = covering_page(missing[0], missing[-1] + 1) or (page_size, page_number)
+        else:
+            self.misses += 1
+            fetch = (page_size, page_number)
+        
+        data = await cached_request(endpoint, {**params, "pageSize": fetch[0], "pageNumber": fetch[1]}, priority)
+        if data is None or (endpoint == "fdc/v1/foods/search" and not isinstance(data, dict)):
+            return data
+        if fetch == (page_size, page_number):
+            # The upstream page is exactly what was asked for
+            self._merge(key, endpoint, data, fetch)
+            return data
+        entry = self._merge(key, endpoint, data, fetch)
+        return self._response(endpoint, entry, start, page_size, page_number)
+    
+    def _merge(self, key: str, endpoint: str, data: Any, fetch: tuple[int, int]) -> ResultRange:
+        entry = self._ranges.get(key)
+        if entry is None:
+            entry = ResultRange(time.monotonic() + cache_ttl_for(endpoint))
+            self._ranges[key] = entry
+        page_size, page_number = fetch
+        offset = page_size * (page_number - 1)
+        items = page_items(endpoint, data)
+        for i, item in enumerate(items):
+            if offset + i not in entry.items:
+                self.total_results += 1
+            entry.items[offset + i] = item
+        if endpoint == "fdc/v1/foods/search":
+            entry.extra = {name: value for name, value in data.items() if name != "foods"}
+            if isinstance(data.get("totalHits"), int):
+                entry.end = data["totalHits"]
+        elif len(items) < page_size:
+            entry.end = offset + len(items)
+        while self.total_results > self.max_results and self._ranges:
+            self._discard(next(iter(self._ranges)))
+        return entry
+    
+    def _response(self, endpoint: str, entry: ResultRange, start: int, page_size: int, page_number: int) -> Any:
+        """Rebuild the upstream response of one page from cached results."""
+        stop = start + page_size if entry.end is None else min(start + page_size, entry.end)
+        items = [entry.items[offset] for offset in range(start, stop)]
+        if endpoint != "fdc/v1/foods/search":
+            return items
+        total = entry.end or 0
+        return {**entry.extra, "currentPage": page_number, "totalPages": -(-total // page_size), "foods": items}
+    
+    def _discard(self, key: str) -> None:
+        self.total_results -= len(self._ranges.pop(key).items)
+    
+    def clear(self) -> None:
+        """Drop every range (counters are kept)."""
+        self._ranges.clear()
+        self.total_results = 0
+    
+    def stats(self) -> dict[str, Any]:
+        """Return range cache counters and occupancy."""
+        return {
+            "queries": len(self._ranges),
+            "results": self.total_results,
+            "hits": self.hits,
+            "partial_hits": self.partial,
+            "misses": self.misses
+        }
+
+result_ranges = ResultRangeCache()
+
+@data_access
+async def make_usda_post(endpoint: str, payload: dict[str, Any], priority: int = PRIORITY_INTERACTIVE) -> Any:
+    """POST a JSON body to the USDA API with proper error handling."""
+    local_store = get_local_store()
+    if local_store is not None and endpoint == "fdc/v1/foods":
+        nutrient_numbers = _split_list(payload.get("nutrients"))
+        records = local_store.get_foods(payload.get("fdcIds", []))
+        found = [filter_food_nutrients(r, nutrient_numbers) if nutrient_numbers else r for r in records]
+        if BACKEND == "local" or len(found) == len(payload.get("fdcIds", [])):
+            return found
+    
+    if not API_KEY:
+        raise ValueError("USDA_API_KEY environment variable is required")
+    
+    key = f"POST {endpoint} {json.dumps(payload, sort_keys=True)}"
+    return await singleflight.do(key, lambda: _post_usda(endpoint, payload, priority))
+
+async def _post_usda(endpoint: str, payload: dict[str, Any], priority: int = PRIORITY_INTERACTIVE) -> Any:
+    """Perform the upstream POST for make_usda_post."""
+    try:
+        response = await send_upstream("POST", endpoint, priority, params={"api_key": API_KEY}, json=payload)
+        return decode_json(endpoint, response)
+    except UpstreamUnavailableError:
+        raise
+    except httpx.HTTPError as e:
+        raise Exception(f"USDA API request failed: {e}")
+    except Exception as e:
+        raise Exception(f"Unexpected error: {e}")
+
+def food_cache_key(fdc_id: int, nutrients: str = None) -> str:
+    """Cache key of the single-food record, as requested by get_food_details."""
+    return make_cache_key(f"fdc/v1/food/{fdc_id}", {"nutrients": nutrients} if nutrients else None)
+
+@data_access
+async def fetch_foods(fdc_ids: list[int], nutrients: str = None,
+                      priority: int = PRIORITY_INTERACTIVE) -> tuple[dict[int, dict], list[int], dict[int, str]]:
+    """Fetch many food records with cached lookups and chunked concurrent POSTs.
+    
+    Returns the records found (by FDC ID), the IDs upstream did not return,
+    and an error message for each ID whose chunk failed.
+    """
+    found: dict[int, dict] = {}
+    ttl = cache_ttl_for("fdc/v1/food/") if CACHE_ENABLED else 0
+    
+    # Serve whatever is already available locally
+    local_store = get_local_store()
+    if local_store is not None:
+        nutrient_numbers = _split_list(nutrients)
+        for record in local_store.get_foods(list(dict.fromkeys(fdc_ids))):
+            found[record["fdcId"]] = filter_food_nutrients(record, nutrient_numbers) if nutrient_numbers else record
+    
+    to_fetch = []
+    known_missing = []
+    for fdc_id in dict.fromkeys(fdc_ids):
+        if fdc_id in found:
+            continue
+        if not food_may_exist(fdc_id):
+            known_missing.append(fdc_id)
+            continue
+        if BACKEND == "local":
+            to_fetch.append(fdc_id)
+            continue
+        cached = await cache_lookup(food_cache_key(fdc_id, nutrients)) if ttl else _MISSING
+        if cached is _MISSING:
+            to_fetch.append(fdc_id)
+        else:
+            found[fdc_id] = cached
+    
+    failed: dict[int, str] = {}
+    semaphore = asyncio.Semaphore(MULTI_FOOD_CONCURRENCY)
+    
+    async def fetch_chunk(chunk: list[int]) -> None:
+        params = {"fdcIds": chunk}
+        if nutrients:
+            params["nutrients"] = nutrients
+        async with semaphore:
+            try:
+                data = await make_usda_post("fdc/v1/foods", params, priority)
+            except Exception as e:
+                for fdc_id in chunk:
+                    stale = await cache_lookup_stale(food_cache_key(fdc_id, nutrients)) if ttl else _MISSING
+                    if stale is _MISSING:
+                        failed[fdc_id] = str(e)
+                    else:
+                        found[fdc_id] = stale
+                return
+        for food in data or []:
+            fdc_id = food.get("fdcId")
+            if fdc_id not in chunk:
+                continue
+            found[fdc_id] = food
+            if ttl:
+                await cache_store(food_cache_key(fdc_id, nutrients), food, json.dumps(food).encode(), ttl)
+    
+    chunks = [to_fetch[i:i + MULTI_FOOD_CHUNK_SIZE] for i in range(0, len(to_fetch), MULTI_FOOD_CHUNK_SIZE)]
+    await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))
+    
+    missing = [fdc_id for fdc_id in to_fetch if fdc_id not in found and fdc_id not in failed]
+    # Asked for and not returned: the ID does not exist
+    for fdc_id in missing:
+        negative_cache.add(fdc_id)
+    missing = set(known_missing + missing)
+    return found, [fdc_id for fdc_id in dict.fromkeys(fdc_ids) if fdc_id in missing], failed
+
+class Prefetcher:
+    """Warm the food cache with the top hits of each search.
+    
+    The IDs not cached yet are fetched in the background with one batched
+    fdc/v1/foods POST at background priority. A token bucket of its own caps
+    prefetching at PREFETCH_BUDGET of the hourly quota, and nothing is
+    prefetched while the shared limiter is short of tokens. Prefetched keys
+    are remembered until first use so the hit rate can be reported.
+    """
+
+    def __init__(self, share: float = PREFETCH_BUDGET, remember: int = 1000):
+        self.budget = RateLimiter(RATE_LIMIT_PER_HOUR * share, max(1.0, RATE_LIMIT_BURST * share))
+        self.remember = remember
+        self._tasks: set[asyncio.Task] = set()
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._unused: OrderedDict[str, None] = OrderedDict()
+        self.batches = 0
+        self.prefetched = 0
+        self.used = 0
+        self.joined = 0
+        self.skipped_cached = 0
+        self.skipped_budget = 0
+        self.failed = 0
 
-# Constants
-USDA_API_BASE = "https://api.nal.usda.gov"
-API_KEY = os.getenv("USDA_API_KEY")
+    def schedule(self, fdc_ids: list[int]) -> None:
+        """Start prefetching `fdc_ids` in the background, if enabled."""
+        if not (PREFETCH_ENABLED and CACHE_ENABLED and API_KEY) or BACKEND == "local" or not fdc_ids:
+            return
+        # Run outside the calling tool's context so its timings are unaffected
+        task = asyncio.get_running_loop().create_task(self._prefetch(list(dict.fromkeys(fdc_ids))),
+                                                      context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-async def make_usda_request(endpoint: str, params: dict[str, Any] = None) -> dict[str, Any] | None:
-    """Make a request to the USDA API with proper error handling."""
-    if not API_KEY:
-        raise ValueError("USDA_API_KEY environment variable is required")
+    async def _prefetch(self, fdc_ids: list[int]) -> None:
+        local_store = get_local_store()
+        local_ids = ({record["fdcId"] for record in await asyncio.to_thread(local_store.get_foods, fdc_ids)}
+                     if local_store is not None else set())
+        wanted = []
+        for fdc_id in fdc_ids:
+            key = food_cache_key(fdc_id)
+            if fdc_id in local_ids or key in self._in_flight or key in response_cache:
+                self.skipped_cached += 1
+            elif await cache_lookup(key) is not _MISSING:
+                # Promoted from the disk cache
+                self.skipped_cached += 1
+            else:
+                wanted.append(fdc_id)
+        wanted = wanted[:MULTI_FOOD_CHUNK_SIZE]
+        if not wanted:
+            return
+        # Never take the last tokens from interactive calls
+        if (RATE_LIMIT_ENABLED and rate_limiter.available() < 2) or not self.budget.try_acquire():
+            self.skipped_budget += len(wanted)
+            return
+        
+        keys = [food_cache_key(fdc_id) for fdc_id in wanted]
+        current = asyncio.current_task()
+        for key in keys:
+            self._in_flight[key] = current
+        self.batches += 1
+        try:
+            found, _, failed = await fetch_foods(wanted, priority=PRIORITY_BACKGROUND)
+        except Exception as e:
+            logger.debug("Prefetch failed: %s", e)
+            self.failed += len(wanted)
+            return
+        finally:
+            for key in keys:
+                self._in_flight.pop(key, None)
+        self.failed += len(failed)
+        for fdc_id in found:
+            self.prefetched += 1
+            self._unused[food_cache_key(fdc_id)] = None
+        while len(self._unused) > self.remember:
+            self._unused.popitem(last=False)
+
+    async def join(self, cache_key: str) -> bool:
+        """Wait for an in-flight prefetch of `cache_key`; return whether there was one."""
+        task = self._in_flight.get(cache_key)
+        if task is None:
+            return False
+        self.joined += 1
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            pass
+        return True
+
+    def note_hit(self, cache_key: str) -> None:
+        """Count the first cache hit on a prefetched entry."""
+        if cache_key in self._unused:
+            del self._unused[cache_key]
+            self.used += 1
+
+    def cancel(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": PREFETCH_ENABLED,
+            "batches": self.batches,
+            "prefetched": self.prefetched,
+            "used": self.used,
+            "joined": self.joined,
+            "use_ratio": round(self.used / self.prefetched, 4) if self.prefetched else 0.0,
+            "skipped_cached": self.skipped_cached,
+            "skipped_budget": self.skipped_budget,
+            "failed": self.failed,
+            "budget_tokens": round(self.budget.available(), 2)
+        }
+
+prefetcher = Prefetcher()
+
+# Nutrient groups in display order: key used in JSON output -> heading used in text output
+NUTRIENT_CATEGORIES = {
+    "macronutrients": "Macronutrients",
+    "vitamins": "Vitamins",
+    "minerals": "Minerals",
+    "lipids": "Fats and Fatty Acids",
+    "amino_acids": "Amino Acids",
+    "other": "Other Nutrients"
+}
+
+class NutrientInfo(NamedTuple):
+    """Static description of a USDA nutrient."""
+    number: str
+    name: str
+    unit: str
+    category: str
+    order: int
+
+# USDA nutrient number -> (canonical name, unit, category), in display order
+_NUTRIENT_ROWS: dict[str, tuple[str, str, str]] = {
+    # Macronutrients
+    "208": ("Energy", "kcal", "macronutrients"),
+    "268": ("Energy", "kJ", "macronutrients"),
+    "957": ("Energy (Atwater General Factors)", "kcal", "macronutrients"),
+    "958": ("Energy (Atwater Specific Factors)", "kcal", "macronutrients"),
+    "203": ("Protein", "g", "macronutrients"),
+    "204": ("Total lipid (fat)", "g", "macronutrients"),
+    "205": ("Carbohydrate, by difference", "g", "macronutrients"),
+    "298": ("Total fat (NLEA)", "g", "macronutrients"),
+    "291": ("Fiber, total dietary", "g", "macronutrients"),
+    "293": ("Total dietary fiber (AOAC 2011.25)", "g", "macronutrients"),
+    "295": ("Fiber, soluble", "g", "macronutrients"),
+    "297": ("Fiber, insoluble", "g", "macronutrients"),
+    "269": ("Sugars, total including NLEA", "g", "macronutrients"),
+    "539": ("Sugars, added", "g", "macronutrients"),
+    "209": ("Starch", "g", "macronutrients"),
+    "210": ("Sucrose", "g", "macronutrients"),
+    "211": ("Glucose", "g", "macronutrients"),
+    "212": ("Fructose", "g", "macronutrients"),
+    "213": ("Lactose", "g", "macronutrients"),
+    "214": ("Maltose", "g", "macronutrients"),
+    "287": ("Galactose", "g", "macronutrients"),
+    "205.2": ("Carbohydrate, by summation", "g", "macronutrients"),
+    "269.3": ("Sugars, Total", "g", "macronutrients"),
+    # Vitamins
+    "320": ("Vitamin A, RAE", "µg", "vitamins"),
+    "318": ("Vitamin A, IU", "IU", "vitamins"),
+    "319": ("Retinol", "µg", "vitamins"),
+    "401": ("Vitamin C, total ascorbic acid", "mg", "vitamins"),
+    "404": ("Thiamin", "mg", "vitamins"),
+    "405": ("Riboflavin", "mg", "vitamins"),
+    "406": ("Niacin", "mg", "vitamins"),
+    "410": ("Pantothenic acid", "mg", "vitamins"),
+    "415": ("Vitamin B-6", "mg", "vitamins"),
+    "417": ("Folate, total", "µg", "vitamins"),
+    "431": ("Folic acid", "µg", "vitamins"),
+    "432": ("Folate, food", "µg", "vitamins"),
+    "435": ("Folate, DFE", "µg", "vitamins"),
+    "418": ("Vitamin B-12", "µg", "vitamins"),
+    "578": ("Vitamin B-12, added", "µg", "vitamins"),
+    "421": ("Choline, total", "mg", "vitamins"),
+    "323": ("Vitamin E (alpha-tocopherol)", "mg", "vitamins"),
+    "573": ("Vitamin E, added", "mg", "vitamins"),
+    "341": ("Tocopherol, beta", "mg", "vitamins"),
+    "342": ("Tocopherol, gamma", "mg", "vitamins"),
+    "343": ("Tocopherol, delta", "mg", "vitamins"),
+    "328": ("Vitamin D (D2 + D3)", "µg", "vitamins"),
+    "324": ("Vitamin D (D2 + D3), International Units", "IU", "vitamins"),
+    "325": ("Vitamin D2 (ergocalciferol)", "µg", "vitamins"),
+    "326": ("Vitamin D3 (cholecalciferol)", "µg", "vitamins"),
+    "430": ("Vitamin K (phylloquinone)", "µg", "vitamins"),
+    "428": ("Vitamin K (Menaquinone-4)", "µg", "vitamins"),
+    "429": ("Vitamin K (Dihydrophylloquinone)", "µg", "vitamins"),
+    # Minerals
+    "301": ("Calcium, Ca", "mg", "minerals"),
+    "303": ("Iron, Fe", "mg", "minerals"),
+    "304": ("Magnesium, Mg", "mg", "minerals"),
+    "305": ("Phosphorus, P", "mg", "minerals"),
+    "306": ("Potassium, K", "mg", "minerals"),
+    "307": ("Sodium, Na", "mg", "minerals"),
+    "309": ("Zinc, Zn", "mg", "minerals"),
+    "312": ("Copper, Cu", "mg", "minerals"),
+    "315": ("Manganese, Mn", "mg", "minerals"),
+    "317": ("Selenium, Se", "µg", "minerals"),
+    "313": ("Fluoride, F", "µg", "minerals"),
+    # Lipids
+    "606": ("Fatty acids, total saturated", "g", "lipids"),
+    "645": ("Fatty acids, total monounsaturated", "g", "lipids"),
+    "646": ("Fatty acids, total polyunsaturated", "g", "lipids"),
+    "605": ("Fatty acids, total trans", "g", "lipids"),
+    "693": ("Fatty acids, total trans-monoenoic", "g", "lipids"),
+    "695": ("Fatty acids, total trans-polyenoic", "g", "lipids"),
+    "601": ("Cholesterol", "mg", "lipids"),
+    "636": ("Phytosterols", "mg", "lipids"),
+    "607": ("SFA 4:0", "g", "lipids"),
+    "608": ("SFA 6:0", "g", "lipids"),
+    "609": ("SFA 8:0", "g", "lipids"),
+    "610": ("SFA 10:0", "g", "lipids"),
+    "611": ("SFA 12:0", "g", "lipids"),
+    "612": ("SFA 14:0", "g", "lipids"),
+    "613": ("SFA 16:0", "g", "lipids"),
+    "614": ("SFA 18:0", "g", "lipids"),
+    "615": ("SFA 20:0", "g", "lipids"),
+    "624": ("SFA 22:0", "g", "lipids"),
+    "625": ("MUFA 14:1", "g", "lipids"),
+    "626": ("MUFA 16:1", "g", "lipids"),
+    "617": ("MUFA 18:1", "g", "lipids"),
+    "628": ("MUFA 20:1", "g", "lipids"),
+    "630": ("MUFA 22:1", "g", "lipids"),
+    "618": ("PUFA 18:2", "g", "lipids"),
+    "619": ("PUFA 18:3", "g", "lipids"),
+    "627": ("PUFA 18:4", "g", "lipids"),
+    "620": ("PUFA 20:4", "g", "lipids"),
+    "629": ("PUFA 20:5 n-3 (EPA)", "g", "lipids"),
+    "631": ("PUFA 22:5 n-3 (DPA)", "g", "lipids"),
+    "621": ("PUFA 22:6 n-3 (DHA)", "g", "lipids"),
+    # Amino acids
+    "501": ("Tryptophan", "g", "amino_acids"),
+    "502": ("Threonine", "g", "amino_acids"),
+    "503": ("Isoleucine", "g", "amino_acids"),
+    "504": ("Leucine", "g", "amino_acids"),
+    "505": ("Lysine", "g", "amino_acids"),
+    "506": ("Methionine", "g", "amino_acids"),
+    "507": ("Cystine", "g", "amino_acids"),
+    "508": ("Phenylalanine", "g", "amino_acids"),
+    "509": ("Tyrosine", "g", "amino_acids"),
+    "510": ("Valine", "g", "amino_acids"),
+    "511": ("Arginine", "g", "amino_acids"),
+    "512": ("Histidine", "g", "amino_acids"),
+    "513": ("Alanine", "g", "amino_acids"),
+    "514": ("Aspartic acid", "g", "amino_acids"),
+    "515": ("Glutamic acid", "g", "amino_acids"),
+    "516": ("Glycine", "g", "amino_acids"),
+    "517": ("Proline", "g", "amino_acids"),
+    "518": ("Serine", "g", "amino_acids"),
+    "521": ("Hydroxyproline", "g", "amino_acids"),
+    # Other
+    "255": ("Water", "g", "other"),
+    "207": ("Ash", "g", "other"),
+    "221": ("Alcohol, ethyl", "g", "other"),
+    "262": ("Caffeine", "mg", "other"),
+    "263": ("Theobromine", "mg", "other"),
+    "321": ("Carotene, beta", "µg", "other"),
+    "322": ("Carotene, alpha", "µg", "other"),
+    "334": ("Cryptoxanthin, beta", "µg", "other"),
+    "337": ("Lycopene", "µg", "other"),
+    "338": ("Lutein + zeaxanthin", "µg", "other"),
+    "454": ("Betaine", "mg", "other")
+}
+
+# Built once at import; display order is the row order above
+NUTRIENT_TABLE: dict[str, NutrientInfo] = {
+    number: NutrientInfo(number, name, unit, category, order)
+    for order, (number, (name, unit, category)) in enumerate(_NUTRIENT_ROWS.items())
+}
+
+_NUTRIENT_NAMES_LOWER = [(info.number, info.name.lower()) for info in NUTRIENT_TABLE.values()]
+
+# Names FDC uses for nutrients outside NUTRIENT_TABLE (and alternate names for
+# ones inside it). A name filter that refers to one of these cannot be
+# narrowed to table numbers.
+_UNLISTED_NUTRIENT_NAMES = tuple(name.lower() for name in (
+    # Proximates and carbohydrates
+    "Adjusted Protein", "Nitrogen", "Total Sugars", "Sugars, Total NLEA", "Carbohydrate, other",
+    "Fiber, total dietary (AOAC 2011.25)", "High Molecular Weight Dietary Fiber (HMWDF)",
+    "Low Molecular Weight Dietary Fiber (LMWDF)", "Beta-glucans", "Inulin", "Raffinose", "Stachyose",
+    "Verbascose", "Ribose", "Xylitol", "Sorbitol", "Total Sugar Alcohols", "Specific Gravity",
+    "Energy (Atwater General Factors), kJ", "Energy (Atwater Specific Factors), kJ",
+    # Vitamins
+    "Biotin", "Vitamin K (Menaquinone-7)", "Vitamin D4", "25-hydroxycholecalciferol",
+    "Tocotrienol, alpha", "Tocotrienol, beta", "Tocotrienol, gamma", "Tocotrienol, delta",
+    "Choline, free", "Choline, from phosphocholine", "Choline, from phosphotidyl choline",
+    "Choline, from glycerophosphocholine", "Choline, from sphingomyelin",
+    "5-methyl tetrahydrofolate (5-MTHF)", "10-Formyl folic acid (10HCOFA)",
+    "5-Formyltetrahydrofolic acid (5-HCOH4)", "Vitamin A", "Vitamin E", "Vitamin D (D2 + D3), IU",
+    # Minerals
+    "Iodine, I", "Molybdenum, Mo", "Chromium, Cr", "Boron, B", "Cobalt, Co", "Nickel, Ni",
+    "Sulfur, S", "Chlorine, Cl", "Iron, heme", "Iron, non-heme",
+    # Lipids
+    "Fatty acids, total trans-dienoic", "Fatty acids, total sat., NLEA", "Fatty acids, total monounsat., NLEA",
+    "Fatty acids, total polyunsat., NLEA", "SFA 5:0", "SFA 7:0", "SFA 9:0", "SFA 11:0", "SFA 13:0",
+    "SFA 15:0", "SFA 17:0", "SFA 21:0", "SFA 23:0", "SFA 24:0", "MUFA 12:1", "MUFA 15:1",
+    "MUFA 16:1 c", "MUFA 17:1", "MUFA 18:1 c", "MUFA 18:1-11 t (18:1t n-7)", "MUFA 20:1 c",
+    "MUFA 22:1 c", "MUFA 22:1 n-9", "MUFA 22:1 n-11", "MUFA 24:1 c", "TFA 14:1 t", "TFA 16:1 t",
+    "TFA 18:1 t", "TFA 18:2 t not further defined", "TFA 18:2 t,t", "TFA 18:3 t", "TFA 20:1 t",
+    "TFA 22:1 t", "PUFA 18:2 c", "PUFA 18:2 n-6 c,c", "PUFA 18:2 CLAs", "PUFA 18:2 i", "PUFA 18:3 c",
+    "PUFA 18:3 n-3 c,c,c (ALA)", "PUFA 18:3 n-6 c,c,c", "PUFA 18:3i", "PUFA 20:2 c",
+    "PUFA 20:2 n-6 c,c", "PUFA 20:3", "PUFA 20:3 c", "PUFA 20:3 n-3", "PUFA 20:3 n-6", "PUFA 20:3 n-9",
+    "PUFA 20:4c", "PUFA 20:4 n-3", "PUFA 20:4 n-6", "PUFA 21:5", "PUFA 22:2", "PUFA 22:3", "PUFA 22:4",
+    "PUFA 22:5 c", "PUFA 22:6 c", "Stigmasterol", "Campesterol", "Beta-sitosterol", "Brassicasterol",
+    "Ergosterol", "Stigmastadiene", "Delta-5-avenasterol", "Delta-7-Stigmastenol", "Phytosterols, other",
+    "Beta-sitostanol", "Campestanol", "Cholesterol, NLEA",
+    # Amino acids
+    "Cysteine", "Glutamine", "Asparagine", "Taurine", "Ornithine", "Citrulline",
+    # Carotenoids and other components
+    "Carotene, gamma", "cis-beta-Carotene", "trans-beta-Carotene", "Cryptoxanthin, alpha",
+    "cis-Lycopene", "trans-Lycopene", "Lutein", "Zeaxanthin", "cis-Lutein/Zeaxanthin", "Phytoene",
+    "Phytofluene", "Acetic acid", "Citric acid", "Lactic acid", "Malic acid", "Oxalic acid",
+    "Pyruvic acid", "Quinic acid", "Daidzein", "Genistein", "Glycitein", "Total isoflavones",
+    "Quercetin", "Kaempferol", "Myricetin", "Luteolin", "Apigenin", "Catechin", "Epicatechin"
+))
+
+# Per unlisted name, the terms no table name has ("adjusted" in "Adjusted Protein")
+_TABLE_NAME_TERMS = {term for _, name in _NUTRIENT_NAMES_LOWER for term in tokenize(name)}
+_UNLISTED_NAME_TERMS = [(name, set(tokenize(name)) - _TABLE_NAME_TERMS) for name in _UNLISTED_NUTRIENT_NAMES]
+
+def refers_to_unlisted_nutrient(filter_name: str) -> bool:
+    """Whether a lowercase name filter is, or names a distinctive term of, a nutrient outside the table.
     
-    headers = {
-        "User-Agent": "usda-mcp-server/1.0",
-        "Accept": "application/json"
-    }
+    "adjusted protein" and "iodine" do; "protein" does not, although it is
+    part of "Adjusted Protein".
+    """
+    terms = set(tokenize(filter_name))
+    return any(filter_name == name or terms & distinctive for name, distinctive in _UNLISTED_NAME_TERMS)
+
+# fdc/v1/food/{id} accepts at most this many nutrient numbers
+MAX_PROJECTED_NUTRIENTS = 25
+
+def resolve_nutrient_numbers(nutrient_names: str) -> list[str] | None:
+    """Map comma-separated name filters to the numbers of nutrients whose names contain them.
     
-    # Add API key to parameters
-    if params is None:
-        params = {}
-    params["api_key"] = API_KEY
+    Returns None (the caller then needs the full food record, filtered by
+    name only) if a filter refers to a nutrient outside the table, matches
+    nothing known, or too many match for one projected request. Otherwise
+    the caller shows only these numbers, whether the record was projected
+    or came whole from the cache, so both give the same answer.
+    """
+    numbers: list[str] = []
+    for filter_name in (name.strip().lower() for name in nutrient_names.split(",")):
+        if refers_to_unlisted_nutrient(filter_name):
+            return None
+        matches = [number for number, name in _NUTRIENT_NAMES_LOWER if filter_name in name]
+        if not matches:
+            return None
+        numbers.extend(matches)
+    numbers = list(dict.fromkeys(numbers))
+    return numbers if len(numbers) <= MAX_PROJECTED_NUTRIENTS else None
+
+# Common names accepted by rank_foods_by_nutrient; energy is taken from the
+# first of kcal, Atwater specific and Atwater general that a food reports
+RANKING_ALIASES = {
+    "energy": ("208", "958", "957"),
+    "calories": ("208", "958", "957"),
+    "kcal": ("208", "958", "957"),
+    "kj": ("268",),
+    "fat": ("204",),
+    "carbs": ("205",),
+    "carbohydrate": ("205",),
+    "carbohydrates": ("205",),
+    "fiber": ("291",),
+    "sugar": ("269",),
+    "sugars": ("269",),
+    "added sugar": ("539",),
+    "saturated fat": ("606",),
+    "vitamin k": ("430",)
+}
+
+MAX_RANKED_FOODS = 100
+
+def resolve_ranking_term(term: str) -> tuple[str, tuple[str, ...]]:
+    """Map a ranking term to (label, nutrient numbers to try in order).
+    
+    A term is a nutrient number, a common name from RANKING_ALIASES, or a
+    nutrient name (or part of one) that identifies a single nutrient.
+    """
+    term = " ".join(term.lower().split())
+    if term.isdigit():
+        info = NUTRIENT_TABLE.get(term)
+        return (info.name if info else f"Nutrient {term}"), (term,)
+    numbers = RANKING_ALIASES.get(term)
+    if numbers is None:
+        matches = ([number for number, name in _NUTRIENT_NAMES_LOWER if name == term]
+                   or [number for number, name in _NUTRIENT_NAMES_LOWER if term in name])
+        if not matches:
+            raise ValueError(f"unknown nutrient {term!r}")
+        if len(matches) > 1:
+            candidates = ", ".join(f"'{number}' ({NUTRIENT_TABLE[number].name})" for number in matches[:8])
+            raise ValueError(f"{term!r} matches several nutrients, use one of: {candidates}")
+        numbers = (matches[0],)
+    return NUTRIENT_TABLE[numbers[0]].name, numbers
+
+_EXPRESSION_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+class NutrientExpression:
+    """Arithmetic (+ - * /) over nutrient amounts and numbers, e.g. "protein / energy".
     
-    url = f"{USDA_API_BASE}/{endpoint}"
+    Nutrient terms are names (underscores for spaces, as in vitamin_c) or
+    quoted names and numbers ('vitamin c', '203'); bare numbers are
+    constants. Anything else is rejected while parsing, so evaluating an
+    expression never runs arbitrary code.
+    """
     
-    async with httpx.AsyncClient() as client:
+    def __init__(self, expression: str):
         try:
-            response = await client.get(url, headers=headers, params=params, timeout=30.0)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
-            raise Exception(f"USDA API request failed: {e}")
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError:
+            raise ValueError(f"cannot parse expression {expression!r} (quote names with spaces, "
+                             "e.g. 'vitamin c')") from None
+        self.terms: dict[str, tuple[str, ...]] = {}
+        self._labels: dict[ast.AST, str] = {}
+        self._body = tree.body
+        self._check(self._body)
+        if not self.terms:
+            raise ValueError("expression names no nutrient")
+    
+    def _check(self, node: ast.AST) -> None:
+        if isinstance(node, ast.BinOp) and type(node.op) in _EXPRESSION_OPERATORS:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            self._check(node.operand)
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return
+        elif isinstance(node, ast.Name) or (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+            term = node.id.replace("_", " ") if isinstance(node, ast.Name) else node.value
+            label, numbers = resolve_ranking_term(term)
+            self.terms[label] = numbers
+            self._labels[node] = label
+        else:
+            raise ValueError(f"unsupported element {ast.unparse(node)!r}; use nutrients, numbers and + - * /")
+    
+    def evaluate(self, vectors: dict[str, Any]) -> Any:
+        """Compute the expression from one array of amounts per term label."""
+        return self._evaluate(self._body, vectors)
+    
+    def _evaluate(self, node: ast.AST, vectors: dict[str, Any]) -> Any:
+        if isinstance(node, ast.BinOp):
+            return _EXPRESSION_OPERATORS[type(node.op)](self._evaluate(node.left, vectors),
+                                                        self._evaluate(node.right, vectors))
+        if isinstance(node, ast.UnaryOp):
+            value = self._evaluate(node.operand, vectors)
+            return -value if isinstance(node.op, ast.USub) else value
+        label = self._labels.get(node)
+        return vectors[label] if label is not None else float(node.value)
+
+class NutrientMatrix(FoodMatrix):
+    """FoodMatrix for analysis: one row per FDC ID, headers only.
+    
+    Indexing a food again merges its amounts into its row, so a projected
+    or search-hit record adds to what a full record stored instead of
+    replacing it. Data types and categories are coded per row so filters
+    are vectorized too. Values are column-major, since queries read whole
+    nutrient columns. At most `max_foods` foods are held; beyond that the
+    food indexed or looked up least recently gives up its row.
+    """
+    
+    order = "F"
+    
+    def __init__(self, rows: int = 1024, columns: int = 64, max_foods: int = ANALYSIS_MAX_FOODS):
+        self.max_rows = max(1, max_foods)
+        rows = min(rows, self.max_rows)
+        super().__init__(rows, columns)
+        self.type_codes = np.full(rows, -1, dtype=np.int16)
+        self.category_codes = np.full(rows, -1, dtype=np.int32)
+        # Rows whose amounts changed since a SimilarityIndex last read them
+        self.dirty = np.zeros(rows, dtype=bool)
+        self.data_types: list[str] = []
+        self.categories: list[str] = []
+        self.units: dict[str, str] = {}
+        self._codes: dict[tuple[str, str], int] = {}
+        # FDC ID -> row, least recently used first
+        self._rows: OrderedDict[int, int] = OrderedDict()
+        self.evicted = 0
+    
+    def _allocate_row(self) -> int:
+        row = super()._allocate_row()
+        grow = len(self.fdc_ids) - len(self.type_codes)
+        if grow:
+            self.type_codes = np.concatenate([self.type_codes, np.full(grow, -1, dtype=np.int16)])
+            self.category_codes = np.concatenate([self.category_codes, np.full(grow, -1, dtype=np.int32)])
+            self.dirty = np.concatenate([self.dirty, np.zeros(grow, dtype=bool)])
+        return row
+    
+    def _code(self, names: list[str], kind: str, name: str) -> int:
+        code = self._codes.get((kind, name))
+        if code is None:
+            code = self._codes[(kind, name)] = len(names)
+            names.append(name)
+        return code
+    
+    def index(self, record: dict[str, Any]) -> bool:
+        """Add or update a food from any record shape with nutrients; False if it has none."""
+        fdc_id = record.get("fdcId")
+        nutrients = record.get("foodNutrients")
+        if not isinstance(fdc_id, int) or not isinstance(nutrients, list):
+            return False
+        columns, amounts = [], []
+        for item in nutrients:
+            if not isinstance(item, dict):
+                continue
+            number, _, amount, unit = nutrient_fields(item)
+            if number is None or type(amount) not in (int, float):
+                continue
+            number = str(number)
+            columns.append(self.column(number))
+            amounts.append(amount)
+            self.units.setdefault(number, unit)
+        row = self._rows.get(fdc_id)
+        if row is None:
+            if not columns:
+                return False
+            if self.count >= self.max_rows:
+                self._evict()
+            row = self._rows[fdc_id] = self._allocate_row()
+            self.fdc_ids[row] = fdc_id
+            self.live[row] = True
+            self.foods[row] = CompactFood(fdc_id, None, None, None, row)
+            self.count += 1
+        else:
+            self._rows.move_to_end(fdc_id)
+        self.values[row, columns] = amounts
+        self.dirty[row] = True
+        food = self.foods[row]
+        food.description = record.get("description") or food.description
+        data_type = record.get("dataType")
+        if data_type:
+            food.data_type = data_type
+            self.type_codes[row] = self._code(self.data_types, "type", data_type)
+        category = _food_category(record)
+        if category:
+            food.category = category
+            self.category_codes[row] = self._code(self.categories, "category", category)
+        return True
+    
+    def index_response(self, value: Any) -> None:
+        """Index the foods of a response: one food, a list of foods or a search page."""
+        if isinstance(value, dict):
+            foods = value.get("foods") if "foods" in value else [value]
+        else:
+            foods = value if isinstance(value, list) else None
+        for record in foods or []:
+            if isinstance(record, dict):
+                self.index(record)
+    
+    def vectors(self, terms: dict[str, tuple[str, ...]], rows: Any = None) -> dict[str, Any]:
+        """Per term label, the amount of the first of its numbers each food has (NaN if none).
+        
+        Covers every row in use, or only `rows` (an index array) if given.
+        """
+        selected = slice(0, self._next_row) if rows is None else rows
+        size = self._next_row if rows is None else len(rows)
+        result = {}
+        for label, numbers in terms.items():
+            amounts = None
+            for column in (self._columns[number] for number in numbers if number in self._columns):
+                values = self.values[selected, column].astype(np.float64)
+                amounts = values if amounts is None else np.where(np.isnan(amounts), values, amounts)
+            result[label] = np.full(size, np.nan) if amounts is None else amounts
+        return result
+    
+    def find_row(self, fdc_id: int) -> int | None:
+        """Row of a food (marking it recently used), or None if it is not indexed."""
+        row = self._rows.get(fdc_id)
+        if row is not None:
+            self._rows.move_to_end(fdc_id)
+        return row
+    
+    def _evict(self) -> None:
+        """Release the row of the least recently used food."""
+        _, row = self._rows.popitem(last=False)
+        self.release(self.foods[row])
+        self.type_codes[row] = -1
+        self.category_codes[row] = -1
+        # A SimilarityIndex zeroes the profile of a released row on its next refresh
+        self.dirty[row] = True
+        self.evicted += 1
+    
+    def mask(self, data_types: list[str], category: str | None) -> Any:
+        """Rows in use whose data type starts with one of `data_types` and whose category contains `category`."""
+        mask = self.live[:self._next_row].copy()
+        if data_types:
+            mask &= self._allowed(self.type_codes, [data_type_matches(name, data_types) for name in self.data_types])
+        if category:
+            part = category.lower()
+            mask &= self._allowed(self.category_codes, [part in name.lower() for name in self.categories])
+        return mask
+    
+    def _allowed(self, codes: Any, allowed: list[bool]) -> Any:
+        # Lookup table indexed by code; the extra last entry (False) is hit by -1, "unknown"
+        return np.array(allowed + [False], dtype=bool)[codes[:self._next_row]]
+    
+    @property
+    def nbytes(self) -> int:
+        return (self.values.nbytes + self.fdc_ids.nbytes + self.live.nbytes + self.dirty.nbytes
+                + self.type_codes.nbytes + self.category_codes.nbytes)
+    
+    def stats(self) -> dict[str, Any]:
+        return {**super().stats(), "max_foods": self.max_rows, "evicted": self.evicted}
+
+def top_rows(scores: Any, mask: Any, k: int, ascending: bool = False) -> tuple[Any, int]:
+    """Return the rows of the k best finite scores among `mask`, best first, and the candidate count.
+    
+    argpartition finds the k best in linear time; only those k are sorted.
+    """
+    rows = np.flatnonzero(mask & np.isfinite(scores))
+    candidates = len(rows)
+    keys = scores[rows] if ascending else -scores[rows]
+    if candidates > k:
+        best = np.argpartition(keys, k - 1)[:k]
+        rows, keys = rows[best], keys[best]
+    return rows[np.argsort(keys, kind="stable")], candidates
+
+_food_matrix: NutrientMatrix | None = None
+_food_matrix_task: asyncio.Future | None = None
+
+def build_food_matrix() -> NutrientMatrix:
+    """Index every food record available on disk, ingested or cached."""
+    matrix = NutrientMatrix()
+    for record in iter_indexable_records():
+        matrix.index(record)
+    return matrix
+
+async def get_food_matrix() -> NutrientMatrix:
+    """Return the analysis matrix, building it on first use.
+    
+    Records on disk are read in a worker thread; foods cached in memory
+    are indexed next, and from then on cache_store indexes every food it
+    stores. Concurrent first calls share one build.
+    """
+    global _food_matrix, _food_matrix_task
+    if _food_matrix is None:
+        if _food_matrix_task is None:
+            _food_matrix_task = asyncio.ensure_future(asyncio.to_thread(build_food_matrix))
+        task = _food_matrix_task
+        try:
+            matrix = await asyncio.shield(task)
+        except Exception:
+            if _food_matrix_task is task:
+                _food_matrix_task = None
+            raise
+        if _food_matrix is None:
+            for record in response_cache.iter_food_records():
+                matrix.index(record)
+            _food_matrix = matrix
+    return _food_matrix
+
+# Nutrients compared by find_similar_foods: energy, macronutrients and the
+# minerals and vitamins most records report
+SIMILARITY_NUTRIENTS = ("energy", "protein", "fat", "carbs", "fiber", "sugar", "saturated fat", "cholesterol",
+                        "sodium", "potassium", "calcium", "iron", "magnesium", "zinc", "vitamin c", "vitamin a, rae")
+SIMILARITY_TERMS = dict(map(resolve_ranking_term, SIMILARITY_NUTRIENTS))
+SIMILARITY_METRICS = ("cosine", "euclidean")
+# Rows scored per matrix-vector product, bounding temporary memory
+SIMILARITY_BLOCK_ROWS = 65536
+
+class SimilarityIndex:
+    """Nutrient profiles of the NutrientMatrix foods for nearest-neighbour queries.
+    
+    A profile holds the SIMILARITY_TERMS amounts of a food divided by the
+    standard deviation of each nutrient across foods, so no unit dominates;
+    a missing amount counts as 0. Queries are blocked brute force (one
+    float32 matrix-vector product per block, argpartition for the top k),
+    which at 16 dimensions beats tree indexes. Rows indexed since the last
+    query are recomputed on the next (a released row's profile becomes 0,
+    which no query returns); scales are recomputed, rebuilding every
+    profile, once the number of foods indexed, released ones included, has
+    grown by a quarter.
+    """
+    
+    def __init__(self, matrix: NutrientMatrix):
+        self.matrix = matrix
+        self.profiles = np.zeros((0, len(SIMILARITY_TERMS)), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.scale: Any = None
+        self._built_count = 0
+        self.rebuilds = 0
+        self.updated_rows = 0
+    
+    def _profiles(self, rows: Any = None) -> Any:
+        vectors = self.matrix.vectors(SIMILARITY_TERMS, rows)
+        raw = np.column_stack([vectors[label] for label in SIMILARITY_TERMS])
+        if self.scale is None:
+            # Standard deviation of the amounts present (nanstd warns on empty columns)
+            present = ~np.isnan(raw)
+            counts = np.maximum(present.sum(axis=0), 1)
+            mean = np.where(present, raw, 0).sum(axis=0) / counts
+            scale = np.sqrt(np.where(present, (raw - mean) ** 2, 0).sum(axis=0) / counts)
+            self.scale = np.where(scale > 0, scale, 1.0)
+        return np.nan_to_num(raw / self.scale).astype(np.float32)
+    
+    def refresh(self) -> None:
+        """Bring profiles up to date with the matrix."""
+        matrix = self.matrix
+        indexed = matrix.count + matrix.evicted
+        if self.scale is None or indexed > self._built_count * 1.25:
+            self.scale = None
+            self.profiles = self._profiles()
+            self.norms = np.linalg.norm(self.profiles, axis=1)
+            matrix.dirty[:] = False
+            self._built_count = indexed
+            self.rebuilds += 1
+            return
+        rows = np.flatnonzero(matrix.dirty[:matrix._next_row])
+        if not rows.size:
+            return
+        matrix.dirty[rows] = False
+        grow = matrix._next_row - len(self.profiles)
+        if grow > 0:
+            self.profiles = np.concatenate([self.profiles, np.zeros((grow, self.profiles.shape[1]), dtype=np.float32)])
+            self.norms = np.concatenate([self.norms, np.zeros(grow, dtype=np.float32)])
+        self.profiles[rows] = self._profiles(rows)
+        self.norms[rows] = np.linalg.norm(self.profiles[rows], axis=1)
+        self.updated_rows += rows.size
+    
+    def nearest(self, row: int, k: int, metric: str, mask: Any) -> tuple[Any, Any]:
+        """Return the rows of the k foods closest to `row` among `mask` (itself excluded) and their distances."""
+        query = self.profiles[row]
+        query_norm = self.norms[row]
+        found_rows, found_distances = [], []
+        for start in range(0, len(self.profiles), SIMILARITY_BLOCK_ROWS):
+            block = slice(start, start + SIMILARITY_BLOCK_ROWS)
+            dots = self.profiles[block] @ query
+            norms = self.norms[block]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if metric == "cosine":
+                    distances = 1 - dots / (norms * query_norm)
+                else:
+                    distances = np.sqrt(np.maximum(norms * norms - 2 * dots + query_norm * query_norm, 0))
+            # Foods without any compared nutrient have no meaningful distance
+            distances[~mask[block] | (norms == 0)] = np.inf
+            if start <= row < start + SIMILARITY_BLOCK_ROWS:
+                distances[row - start] = np.inf
+            best, _ = top_rows(distances, np.ones(len(distances), dtype=bool), k, ascending=True)
+            found_rows.append(best + start)
+            found_distances.append(distances[best])
+        rows = np.concatenate(found_rows)
+        distances = np.concatenate(found_distances)
+        order, _ = top_rows(distances, np.ones(len(distances), dtype=bool), k, ascending=True)
+        return rows[order], distances[order]
+    
+    def stats(self) -> dict[str, Any]:
+        return {"foods": int(np.count_nonzero(self.norms)), "rebuilds": self.rebuilds, "updated_rows": self.updated_rows}
+
+_similarity_index: SimilarityIndex | None = None
+
+async def get_similarity_index() -> SimilarityIndex:
+    """Return the similarity index over the analysis matrix, up to date with it."""
+    global _similarity_index
+    matrix = await get_food_matrix()
+    if _similarity_index is None or _similarity_index.matrix is not matrix:
+        _similarity_index = SimilarityIndex(matrix)
+    _similarity_index.refresh()
+    return _similarity_index
+
+@data_access
+async def fetch_food_nutrients(fdc_id: int, nutrient_numbers: list[str] | None = None) -> dict[str, Any] | None:
+    """Fetch a food record for nutrient lookups, projected to `nutrient_numbers` if given.
+    
+    A full record that is already cached is used as is; otherwise only the
+    requested nutrients are fetched, in abridged format.
+    """
+    endpoint = f"fdc/v1/food/{fdc_id}"
+    if not nutrient_numbers:
+        return await make_usda_request(endpoint)
+    if CACHE_ENABLED and BACKEND != "local":
+        cached = await cache_lookup(make_cache_key(endpoint))
+        if cached is not _MISSING:
+            return cached
+    return await make_usda_request(endpoint, {"format": "abridged", "nutrients": ",".join(nutrient_numbers)})
+
+# Output formats accepted by every tool: readable text, or JSON built directly
+# from the upstream record ("compact" uses tabular rows and name -> amount maps)
+OUTPUT_FORMATS = ("text", "json", "compact")
+OUTPUT_FORMAT_ERROR = f"Error: output_format must be one of {', '.join(OUTPUT_FORMATS)}"
+
+def nutrient_fields(nutrient: dict[str, Any]) -> tuple[str | None, str, Any, str]:
+    """Return (number, name, amount, unit) of a full, search-hit or abridged nutrient entry."""
+    inner = nutrient.get("nutrient")
+    if inner is not None:
+        return inner.get("number"), inner.get("name", "Unknown"), nutrient.get("amount"), inner.get("unitName", "")
+    number = nutrient.get("nutrientNumber", nutrient.get("number"))
+    # Search hits and abridged records spell units in upper case ("MG")
+    known = NUTRIENT_TABLE.get(str(number))
+    return (
+        number,
+        nutrient.get("nutrientName", nutrient.get("name", "Unknown")),
+        nutrient.get("value", nutrient.get("amount")),
+        known.unit if known else nutrient.get("unitName", "")
+    )
+
+def ordered_nutrients(food_nutrients: list[dict[str, Any]]) -> list[tuple[str | None, str, Any, str, str]]:
+    """Return (number, name, amount, unit, category) of each nutrient, in display order.
+    
+    Known nutrients take their canonical name and unit from NUTRIENT_TABLE;
+    unknown ones are filed under "other", after the known ones, in record order.
+    """
+    rows = []
+    for position, nutrient in enumerate(food_nutrients):
+        number, name, amount, unit = nutrient_fields(nutrient)
+        info = NUTRIENT_TABLE.get(str(number))
+        if info is None:
+            rows.append((len(NUTRIENT_TABLE) + position, (number, name, amount, unit, "other")))
+        else:
+            rows.append((info.order, (number, info.name, amount, info.unit, info.category)))
+    rows.sort(key=lambda row: row[0])
+    return [fields for _, fields in rows]
+
+# Energy in kcal, then the Atwater energies that Foundation foods report instead
+ENERGY_NUMBERS = ("208", "958", "957")
+
+# Energy, protein, fat and carbohydrate, shown for each search result; each
+# is the first of its numbers that a food reports
+KEY_NUTRIENT_NUMBERS = (ENERGY_NUMBERS, ("203",), ("204",), ("205",))
+
+def key_nutrients(food_nutrients: list[dict[str, Any]]) -> list[tuple[str | None, str, Any, str]]:
+    """Pick the key nutrients of a food, or its first three if it has none of them."""
+    by_number = {str(fields[0]): fields for fields in map(nutrient_fields, food_nutrients)}
+    picked = [next(by_number[number] for number in numbers if number in by_number)
+              for numbers in KEY_NUTRIENT_NUMBERS if any(number in by_number for number in numbers)]
+    return picked or [nutrient_fields(n) for n in food_nutrients[:3]]
+
+def food_calories(food: dict[str, Any]) -> Any:
+    """Energy in kcal (not kJ) of a food record, or None."""
+    by_number = {str(number): amount for number, _, amount, _ in map(nutrient_fields, food.get("foodNutrients") or [])}
+    return next((by_number[number] for number in ENERGY_NUMBERS if number in by_number), None)
+
+def structured_nutrients(nutrients: list[tuple[str | None, str, Any, str]], output_format: str) -> Any:
+    """Nutrient (number, name, amount, unit) tuples as a list of objects, or a name -> amount map."""
+    if output_format == "compact":
+        return {f"{name} ({unit})" if unit else name: amount for _, name, amount, unit in nutrients}
+    return [{"number": number, "name": name, "amount": amount, "unit": unit} for number, name, amount, unit in nutrients]
+
+def structured_rows(items: list[dict[str, Any]], output_format: str) -> Any:
+    """A list of flat objects, or a columns/rows table in compact format."""
+    if output_format != "compact":
+        return items
+    columns = list(dict.fromkeys(key for item in items for key in item))
+    return {"columns": columns, "rows": [[item.get(column) for column in columns] for item in items]}
+
+def drop_empty(fields: dict[str, Any]) -> dict[str, Any]:
+    """Remove fields without a value so structured output stays minimal."""
+    return {key: value for key, value in fields.items() if value is not None and value != "" and value != []}
+
+def render_structured(payload: Any) -> str:
+    """Serialize a structured tool result without whitespace."""
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+def format_search_hit(food: dict[str, Any]) -> str:
+    """Text block describing one search result."""
+    description = food.get("description", "No description")
+    fdc_id = food.get("fdcId", "N/A")
+    brand_owner = food.get("brandOwner", "Generic")
+    data_type = food.get("dataType", "N/A")
+    
+    # Include basic nutrition if available
+    nutrients_text = ""
+    if "foodNutrients" in food and food["foodNutrients"]:
+        key_nutrient_text = [
+            f"{name}: {value if value is not None else 0} {unit}"
+            for _, name, value, unit in key_nutrients(food["foodNutrients"])
+        ]
+        if key_nutrient_text:
+            nutrients_text = f"\nKey Nutrients: {', '.join(key_nutrient_text)}"
+    
+    return f"ID: {fdc_id}\nDescription: {description}\nBrand: {brand_owner}\nData Type: {data_type}{nutrients_text}"
+
+def structured_search_hit(food: dict[str, Any], output_format: str) -> dict[str, Any]:
+    """Minimal structured form of one search result."""
+    return drop_empty({
+        "fdc_id": food.get("fdcId"),
+        "description": food.get("description"),
+        "brand_owner": food.get("brandOwner"),
+        "data_type": food.get("dataType"),
+        "key_nutrients": structured_nutrients(key_nutrients(food.get("foodNutrients") or []), output_format)
+    })
+
+def format_list_item(food: dict[str, Any]) -> str:
+    """Text line describing one food of a list page."""
+    fdc_id = food.get("fdcId", "N/A")
+    description = food.get("description", "No description")
+    data_type = food.get("dataType", "N/A")
+    publication_date = food.get("publicationDate", "N/A")
+    return f"ID: {fdc_id} | {description} | Type: {data_type} | Published: {publication_date}"
+
+def structured_list_item(food: dict[str, Any]) -> dict[str, Any]:
+    """Minimal structured form of one food of a list page."""
+    return drop_empty({
+        "fdc_id": food.get("fdcId"),
+        "description": food.get("description"),
+        "data_type": food.get("dataType"),
+        "publication_date": food.get("publicationDate")
+    })
+
+def page_items(endpoint: str, data: Any) -> list[dict[str, Any]]:
+    """Results of one search or list page."""
+    if endpoint == "fdc/v1/foods/search":
+        return (data or {}).get("foods") or []
+    return data or []
+
+@data_access
+async def fetch_pages(endpoint: str, params: dict[str, Any], start_page: int, limit: int,
+                      on_page: Callable[[int, list[dict[str, Any]]], Awaitable[None]] | None = None
+                      ) -> tuple[list[dict[str, Any]], int | None, str | None]:
+    """Collect up to `limit` results from consecutive 200-result pages.
+    
+    The first page is fetched interactively; for search its totalHits tells
+    how many more pages exist. The rest are fetched concurrently at
+    background priority through the rate limiter, and no page past the first
+    short one (or past the limit) is requested. `on_page` is awaited as each
+    page arrives, in completion order. Returns the results in page order,
+    totalHits (None for list) and the error that stopped pagination, if any.
+    """
+    page_size = min(limit, 200)
+    pages: dict[int, list[dict[str, Any]]] = {}
+    first = await make_usda_request(endpoint, {**params, "pageSize": page_size, "pageNumber": start_page})
+    pages[start_page] = page_items(endpoint, first)
+    if on_page is not None:
+        await on_page(start_page, pages[start_page])
+    total_hits = (first or {}).get("totalHits") if endpoint == "fdc/v1/foods/search" else None
+    
+    last_page = start_page + math.ceil(limit / page_size) - 1
+    if total_hits is not None:
+        last_page = min(last_page, math.ceil(total_hits / page_size))
+    # First page known to hold fewer than page_size results; nothing after it exists
+    end_page = start_page if len(pages[start_page]) < page_size else None
+    error: str | None = None
+    semaphore = asyncio.Semaphore(PAGINATION_CONCURRENCY)
+    
+    async def fetch(page: int) -> None:
+        nonlocal end_page, error
+        async with semaphore:
+            if end_page is not None and page > end_page:
+                return
+            try:
+                data = await make_usda_request(endpoint, {**params, "pageSize": page_size, "pageNumber": page},
+                                               PRIORITY_BACKGROUND)
+            except Exception as e:
+                # Keep the pages before the failure
+                if end_page is None or page - 1 < end_page:
+                    end_page, error = page - 1, str(e)
+                return
+        pages[page] = page_items(endpoint, data)
+        if len(pages[page]) < page_size and (end_page is None or page < end_page):
+            end_page = page
+        if on_page is not None and (end_page is None or page <= end_page):
+            await on_page(page, pages[page])
+    
+    if end_page is None:
+        await asyncio.gather(*(fetch(page) for page in range(start_page + 1, last_page + 1)))
+    
+    results = []
+    for page in range(start_page, (end_page if end_page is not None else last_page) + 1):
+        results.extend(pages.get(page, []))
+    return results[:limit], total_hits, error
+
+def pagination_limit(max_results: int | None, all_pages: bool) -> int | None:
+    """Number of results to collect across pages, or None for a single page."""
+    if all_pages:
+        return min(max_results or PAGINATION_MAX_RESULTS, PAGINATION_MAX_RESULTS)
+    if max_results:
+        return min(max_results, PAGINATION_MAX_RESULTS)
+    return None
+
+def progress_reporter(ctx: Context | None, limit: int, render: Callable[[list[dict[str, Any]]], str]
+                      ) -> Callable[[int, list[dict[str, Any]]], Awaitable[None]] | None:
+    """Build an on_page callback that streams each page as an MCP progress notification."""
+    if ctx is None:
+        return None
+    received = 0
+    
+    async def on_page(page: int, items: list[dict[str, Any]]) -> None:
+        nonlocal received
+        received = min(limit, received + len(items))
+        try:
+            await ctx.report_progress(received, limit, f"Page {page}:\n{render(items)}")
         except Exception as e:
-            raise Exception(f"Unexpected error: {e}")
+            logger.debug("Progress notification failed: %s", e)
+    return on_page
 
 @mcp.tool()
-async def search_foods(query: str, page_size: int = 50, data_type: str = None, page_number: int = 1) -> str:
+@instrumented
+async def search_foods(query: str, page_size: int = 50, data_type: str = None, page_number: int = 1,
+                       output_format: str = "text", max_results: int = None, all_pages: bool = False,
+                       ctx: Context = None) -> str:
     """Search for foods in the USDA FoodData Central database.
     
     Args:
@@ -50,63 +3802,151 @@ async def search_foods(query: str, page_size: int = 50, data_type: str = None, p
         page_size: Number of results to return (default: 50, max: 200)
         data_type: Optional data type filter (e.g., 'Foundation', 'SR Legacy', 'Survey')
         page_number: Page number for pagination (default: 1)
+        output_format: 'text' (default), 'json' or 'compact' (JSON with tabular rows)
+        max_results: Collect up to this many results across pages of 200; page_number is then the first such page
+        all_pages: Collect every result (up to the configured maximum); pages stream as progress notifications
     """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
     try:
-        params = {
-            "query": query,
-            "pageSize": min(page_size, 200),
-            "pageNumber": page_number
-        }
-        
+        params = {"query": query}
         if data_type:
             params["dataType"] = data_type
         
-        data = await make_usda_request("fdc/v1/foods/search", params)
+        def render(foods: list[dict[str, Any]]) -> str:
+            if output_format == "text":
+                return "\n---\n".join(format_search_hit(food) for food in foods)
+            return render_structured(structured_rows([structured_search_hit(food, output_format) for food in foods],
+                                                     output_format))
+        
+        limit = pagination_limit(max_results, all_pages)
+        error = None
+        if limit is None:
+            data = await make_usda_request("fdc/v1/foods/search", {
+                **params, "pageSize": min(page_size, 200), "pageNumber": page_number
+            })
+            foods = page_items("fdc/v1/foods/search", data)
+            total_hits = (data or {}).get("totalHits", 0)
+        else:
+            foods, total_hits, error = await fetch_pages("fdc/v1/foods/search", params, page_number, limit,
+                                                         progress_reporter(ctx, limit, render))
         
-        if not data or "foods" not in data:
-            return "No foods found for the given query."
+        # The next call is usually about one of the top hits
+        prefetcher.schedule([food["fdcId"] for food in foods[:PREFETCH_TOP_N] if "fdcId" in food])
         
-        foods = data["foods"]
-        total_hits = data.get("totalHits", 0)
+        if output_format != "text":
+            return render_structured({
+                "total_hits": total_hits or 0,
+                "page": page_number,
+                "foods": structured_rows([structured_search_hit(food, output_format) for food in foods],
+                                         output_format),
+                **({"error": error} if error else {})
+            })
         
         if not foods:
-            return "No foods found for the given query."
+            return "No foods found for the given query." + (f" ({error})" if error else "")
         
-        results = []
-        for food in foods:
-            description = food.get("description", "No description")
-            fdc_id = food.get("fdcId", "N/A")
-            brand_owner = food.get("brandOwner", "Generic")
-            data_type = food.get("dataType", "N/A")
-            
-            # Include basic nutrition if available
-            nutrients_text = ""
-            if "foodNutrients" in food and food["foodNutrients"]:
-                key_nutrients = []
-                for nutrient in food["foodNutrients"][:3]:  # Show first 3 nutrients
-                    name = nutrient.get("nutrientName", "Unknown")
-                    value = nutrient.get("value", 0)
-                    unit = nutrient.get("unitName", "")
-                    key_nutrients.append(f"{name}: {value} {unit}")
-                if key_nutrients:
-                    nutrients_text = f"\nKey Nutrients: {', '.join(key_nutrients)}"
-            
-            result = f"ID: {fdc_id}\nDescription: {description}\nBrand: {brand_owner}\nData Type: {data_type}{nutrients_text}"
-            results.append(result)
+        if limit is None:
+            header = f"Found {total_hits} total foods. Showing page {page_number} ({len(foods)} results):\n\n"
+        else:
+            header = f"Found {total_hits} total foods. Showing {len(foods)} results from page {page_number} on:\n\n"
+        output = header + render(foods)
+        if error:
+            output += f"\n\nStopped after {len(foods)} results: {error}"
+        return output
+        
+    except Exception as e:
+        return f"Error searching foods: {str(e)}"
+
+@mcp.tool()
+@instrumented
+async def search_foods_batch(queries: str, page_size: int = 5, data_type: str = None,
+                             output_format: str = "text") -> str:
+    """Run several food searches at once, e.g. one per ingredient of a recipe.
+    
+    Queries run concurrently; repeated queries (ignoring case and spacing)
+    are searched once, and a failed query does not affect the others.
+    
+    Args:
+        queries: Search terms separated by semicolons or newlines (e.g., "rolled oats; whole milk; banana")
+        page_size: Number of results per query (default: 5, max: 200)
+        data_type: Optional data type filter applied to every query (e.g., 'Foundation', 'SR Legacy')
+        output_format: 'text' (default), 'json' or 'compact' (JSON with tabular rows)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
+    try:
+        # One search per distinct query, in first-seen order
+        distinct: dict[str, str] = {}
+        for query in re.split(r"[;\n]", queries):
+            query = " ".join(query.split())
+            if query:
+                distinct.setdefault(query.lower(), query)
+        if not distinct:
+            return "Error: no queries given"
+        if len(distinct) > SEARCH_BATCH_MAX_QUERIES:
+            return f"Error: Maximum {SEARCH_BATCH_MAX_QUERIES} distinct queries allowed per batch"
+        
+        semaphore = asyncio.Semaphore(SEARCH_BATCH_CONCURRENCY)
+        
+        async def search(query: str) -> tuple[list[dict[str, Any]], int] | Exception:
+            params = {"query": query, "pageSize": min(page_size, 200), "pageNumber": 1}
+            if data_type:
+                params["dataType"] = data_type
+            async with semaphore:
+                try:
+                    data = await make_usda_request("fdc/v1/foods/search", params)
+                except Exception as e:
+                    return e
+            return page_items("fdc/v1/foods/search", data), (data or {}).get("totalHits", 0)
         
-        return f"Found {total_hits} total foods. Showing page {page_number} ({len(results)} results):\n\n" + "\n---\n".join(results)
+        outcomes = await asyncio.gather(*(search(query) for query in distinct.values()))
+        results = dict(zip(distinct.values(), outcomes))
+        
+        # The usual follow-up is about the top hit of each query
+        top_hits = [outcome[0][0].get("fdcId") for outcome in outcomes if not isinstance(outcome, Exception) and outcome[0]]
+        prefetcher.schedule([fdc_id for fdc_id in top_hits if fdc_id is not None])
+        
+        if output_format != "text":
+            return render_structured({"results": [
+                {"query": query, "error": str(outcome)} if isinstance(outcome, Exception) else {
+                    "query": query,
+                    "total_hits": outcome[1] or 0,
+                    "foods": structured_rows([structured_search_hit(food, output_format) for food in outcome[0]],
+                                             output_format)
+                }
+                for query, outcome in results.items()
+            ]})
+        
+        failures = sum(isinstance(outcome, Exception) for outcome in outcomes)
+        sections = []
+        for query, outcome in results.items():
+            if isinstance(outcome, Exception):
+                sections.append(f"=== {query} ===\nError searching foods: {outcome}")
+            elif not outcome[0]:
+                sections.append(f"=== {query} ===\nNo foods found for the given query.")
+            else:
+                foods, total_hits = outcome
+                sections.append(f"=== {query} (found {total_hits} total foods, showing {len(foods)}) ===\n"
+                                + "\n---\n".join(format_search_hit(food) for food in foods))
+        header = f"Searched {len(results)} queries ({len(results) - failures} succeeded):\n\n"
+        return header + "\n\n".join(sections)
         
     except Exception as e:
         return f"Error searching foods: {str(e)}"
 
 @mcp.tool()
-async def get_food_details(fdc_id: int, nutrients: str = None) -> str:
+@instrumented
+async def get_food_details(fdc_id: int, nutrients: str = None, output_format: str = "text") -> str:
     """Get detailed information about a specific food item by its FDC ID.
     
     Args:
         fdc_id: FoodData Central ID of the food item
         nutrients: Optional comma-separated list of nutrient numbers to include
+        output_format: 'text' (default), 'json' or 'compact' (JSON with a name -> amount nutrient map)
     """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
     try:
         params = {}
         if nutrients:
@@ -117,6 +3957,19 @@ async def get_food_details(fdc_id: int, nutrients: str = None) -> str:
         if not data:
             return f"No food found with FDC ID: {fdc_id}"
         
+        if output_format != "text":
+            # Nutrient amounts are per 100g, as in the text output
+            food_nutrients = [fields[:4] for fields in ordered_nutrients(data.get("foodNutrients") or [])]
+            return render_structured(drop_empty({
+                "fdc_id": fdc_id,
+                "description": data.get("description"),
+                "brand_owner": data.get("brandOwner"),
+                "data_type": data.get("dataType"),
+                "ingredients": data.get("ingredients"),
+                "category": _food_category(data),
+                "nutrients": structured_nutrients([n for n in food_nutrients if n[2] and n[2] > 0], output_format)
+            }))
+        
         description = data.get("description", "No description")
         brand_owner = data.get("brandOwner", "Generic")
         data_type = data.get("dataType", "N/A")
@@ -130,16 +3983,13 @@ async def get_food_details(fdc_id: int, nutrients: str = None) -> str:
         # Add nutrition information
         if "foodNutrients" in data and data["foodNutrients"]:
             result += "\nNutrition Facts (per 100g):\n"
-            for nutrient in data["foodNutrients"]:
-                name = nutrient.get("nutrient", {}).get("name", "Unknown")
-                value = nutrient.get("amount", 0)
-                unit = nutrient.get("nutrient", {}).get("unitName", "")
+            for _, name, value, unit, _ in ordered_nutrients(data["foodNutrients"]):
                 if value and value > 0:
                     result += f"- {name}: {value} {unit}\n"
         
-        # Add food category if available
-        if "foodCategory" in data:
-            category = data["foodCategory"].get("description", "Unknown")
+        # Add food category if available (Branded foods have their own field)
+        category = _food_category(data)
+        if category:
             result += f"\nCategory: {category}"
         
         return result
@@ -148,43 +3998,51 @@ async def get_food_details(fdc_id: int, nutrients: str = None) -> str:
         return f"Error retrieving food details: {str(e)}"
 
 @mcp.tool()
-async def get_multiple_foods(fdc_ids: str, nutrients: str = None) -> str:
+@instrumented
+async def get_multiple_foods(fdc_ids: str, nutrients: str = None, output_format: str = "text") -> str:
     """Get details for multiple food items by their FDC IDs.
     
     Args:
-        fdc_ids: Comma-separated list of FDC IDs (e.g., "123456,789012,345678")
+        fdc_ids: Comma-separated list of FDC IDs (e.g., "123456,789012,345678"), up to 500
         nutrients: Optional comma-separated list of nutrient numbers to include
+        output_format: 'text' (default), 'json' or 'compact' (JSON with tabular rows)
     """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
     try:
         # Parse the comma-separated FDC IDs
         id_list = [int(id.strip()) for id in fdc_ids.split(",")]
         
-        if len(id_list) > 20:
-            return "Error: Maximum 20 FDC IDs allowed per request"
-        
-        params = {"fdcIds": id_list}
-        if nutrients:
-            params["nutrients"] = nutrients
-        
-        # Use POST method for multiple IDs
-        url = f"{USDA_API_BASE}/fdc/v1/foods"
-        headers = {
-            "User-Agent": "usda-mcp-server/1.0",
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
+        if len(id_list) > MULTI_FOOD_MAX_IDS:
+            return f"Error: Maximum {MULTI_FOOD_MAX_IDS} FDC IDs allowed per request"
         
-        request_data = params.copy()
-        request_data["api_key"] = API_KEY
+        found, missing, failed = await fetch_foods(id_list, nutrients)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=request_data, timeout=30.0)
-            response.raise_for_status()
-            data = response.json()
+        if output_format != "text":
+            foods = []
+            for fdc_id in dict.fromkeys(id_list):
+                food = found.get(fdc_id)
+                if food is None:
+                    continue
+                calories = food_calories(food)
+                foods.append(drop_empty({
+                    "fdc_id": fdc_id,
+                    "description": food.get("description"),
+                    "brand_owner": food.get("brandOwner"),
+                    "calories_kcal": calories
+                }))
+            return render_structured(drop_empty({
+                "foods": structured_rows(foods, output_format),
+                "not_found": missing,
+                "failed": {str(fdc_id): error for fdc_id, error in failed.items()} or None
+            }))
         
-        if not data:
+        if not found and not failed:
             return "No foods found for the provided FDC IDs"
         
+        # Merge results back in input order (duplicates collapsed)
+        data = [found[fdc_id] for fdc_id in dict.fromkeys(id_list) if fdc_id in found]
+        
         results = []
         for food in data:
             fdc_id = food.get("fdcId", "N/A")
@@ -194,21 +4052,33 @@ async def get_multiple_foods(fdc_ids: str, nutrients: str = None) -> str:
             # Basic nutrition summary
             nutrition_summary = ""
             if "foodNutrients" in food and food["foodNutrients"]:
-                calories = next((n.get("amount", 0) for n in food["foodNutrients"] 
-                               if n.get("nutrient", {}).get("name") == "Energy"), None)
+                calories = food_calories(food)
                 if calories:
                     nutrition_summary = f" | Calories: {calories} kcal"
             
             result = f"ID: {fdc_id} | {description} | Brand: {brand_owner}{nutrition_summary}"
             results.append(result)
         
-        return f"Retrieved {len(results)} foods:\n\n" + "\n".join(results)
+        output = f"Retrieved {len(results)} foods:\n\n" + "\n".join(results)
+        if missing:
+            output += "\n\nNot found: " + ", ".join(str(fdc_id) for fdc_id in missing)
+        if failed:
+            # A failed chunk reports one error for all of its IDs
+            by_error: dict[str, list[str]] = {}
+            for fdc_id, error in failed.items():
+                by_error.setdefault(error, []).append(str(fdc_id))
+            for error, ids in by_error.items():
+                output += f"\n\nFailed to retrieve {', '.join(ids)}: {error}"
+        return output
         
     except Exception as e:
         return f"Error retrieving multiple foods: {str(e)}"
 
 @mcp.tool()
-async def list_foods(page_size: int = 50, page_number: int = 1, data_type: str = None, sort_by: str = None) -> str:
+@instrumented
+async def list_foods(page_size: int = 50, page_number: int = 1, data_type: str = None, sort_by: str = None,
+                     output_format: str = "text", max_results: int = None, all_pages: bool = False,
+                     ctx: Context = None) -> str:
     """Get a paginated list of foods in abridged format for browsing.
     
     Args:
@@ -216,113 +4086,574 @@ async def list_foods(page_size: int = 50, page_number: int = 1, data_type: str =
         page_number: Page number for pagination (default: 1)
         data_type: Optional data type filter (e.g., 'Foundation', 'SR Legacy', 'Survey')
         sort_by: Optional sort field (e.g., 'dataType.keyword', 'description.keyword')
+        output_format: 'text' (default), 'json' or 'compact' (JSON with tabular rows)
+        max_results: Collect up to this many foods across pages of 200; page_number is then the first such page
+        all_pages: Collect every food (up to the configured maximum); pages stream as progress notifications
     """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
     try:
-        params = {
-            "pageSize": min(page_size, 200),
-            "pageNumber": page_number
-        }
-        
+        params = {}
         if data_type:
             params["dataType"] = data_type
         if sort_by:
             params["sortBy"] = sort_by
         
-        data = await make_usda_request("fdc/v1/foods/list", params)
+        def render(foods: list[dict[str, Any]]) -> str:
+            if output_format == "text":
+                return "\n".join(format_list_item(food) for food in foods)
+            return render_structured(structured_rows([structured_list_item(food) for food in foods], output_format))
         
-        if not data:
-            return "No foods found"
+        limit = pagination_limit(max_results, all_pages)
+        error = None
+        if limit is None:
+            data = await make_usda_request("fdc/v1/foods/list", {
+                **params, "pageSize": min(page_size, 200), "pageNumber": page_number
+            })
+            foods = page_items("fdc/v1/foods/list", data)
+        else:
+            foods, _, error = await fetch_pages("fdc/v1/foods/list", params, page_number, limit,
+                                                progress_reporter(ctx, limit, render))
         
-        foods = data
-        if not foods:
-            return "No foods found"
+        if output_format != "text":
+            return render_structured({
+                "page": page_number,
+                "foods": structured_rows([structured_list_item(food) for food in foods], output_format),
+                **({"error": error} if error else {})
+            })
         
-        results = []
-        for food in foods:
-            fdc_id = food.get("fdcId", "N/A")
-            description = food.get("description", "No description")
-            data_type = food.get("dataType", "N/A")
-            publication_date = food.get("publicationDate", "N/A")
-            
-            result = f"ID: {fdc_id} | {description} | Type: {data_type} | Published: {publication_date}"
-            results.append(result)
+        if not foods:
+            return "No foods found" + (f" ({error})" if error else "")
         
-        return f"Foods list (Page {page_number}, {len(results)} results):\n\n" + "\n".join(results)
+        if limit is None:
+            header = f"Foods list (Page {page_number}, {len(foods)} results):\n\n"
+        else:
+            header = f"Foods list ({len(foods)} results from page {page_number} on):\n\n"
+        output = header + render(foods)
+        if error:
+            output += f"\n\nStopped after {len(foods)} results: {error}"
+        return output
         
     except Exception as e:
         return f"Error listing foods: {str(e)}"
 
 @mcp.tool()
-async def get_food_nutrients(fdc_id: int, nutrient_names: str = None) -> str:
+@instrumented
+async def get_food_nutrients(fdc_id: int, nutrient_names: str = None, output_format: str = "text") -> str:
     """Get detailed nutrient information for a specific food item.
     
     Args:
         fdc_id: FoodData Central ID of the food item
         nutrient_names: Optional comma-separated list of nutrient names to filter (e.g., "Energy,Protein,Total lipid")
+        output_format: 'text' (default), 'json' or 'compact' (JSON with name -> amount maps)
     """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
     try:
-        data = await make_usda_request(f"fdc/v1/food/{fdc_id}")
+        # Fetch only the requested nutrients when the names are known locally
+        nutrient_numbers = resolve_nutrient_numbers(nutrient_names) if nutrient_names else None
+        data = await fetch_food_nutrients(fdc_id, nutrient_numbers)
         
         if not data:
             return f"No food found with FDC ID: {fdc_id}"
         
         description = data.get("description", "No description")
         
-        if "foodNutrients" not in data or not data["foodNutrients"]:
+        # A projected record may legitimately have none of the requested nutrients
+        if not data.get("foodNutrients") and not nutrient_numbers:
             return f"No nutrient data available for {description} (FDC ID: {fdc_id})"
         
         result = f"Nutrient Information for: {description} (FDC ID: {fdc_id})\n\n"
         
-        # Filter nutrients if specific names requested
-        nutrients_to_show = data["foodNutrients"]
+        # Filter nutrients if specific names requested; a cached full record is
+        # narrowed to the same numbers a projected fetch would have returned
+        nutrients_to_show = data.get("foodNutrients") or []
         if nutrient_names:
             filter_names = [name.strip().lower() for name in nutrient_names.split(",")]
+            wanted = set(nutrient_numbers or ())
             nutrients_to_show = [
-                n for n in data["foodNutrients"] 
-                if any(filter_name in n.get("nutrient", {}).get("name", "").lower() 
+                n for n in nutrients_to_show
+                if (not wanted or str(nutrient_fields(n)[0]) in wanted)
+                and any(filter_name in nutrient_fields(n)[1].lower() 
                       for filter_name in filter_names)
             ]
         
-        # Group nutrients by category
-        macro_nutrients = []
-        vitamins = []
-        minerals = []
-        other_nutrients = []
-        
-        for nutrient in nutrients_to_show:
-            name = nutrient.get("nutrient", {}).get("name", "Unknown")
-            value = nutrient.get("amount", 0)
-            unit = nutrient.get("nutrient", {}).get("unitName", "")
-            
+        # Group nutrients by category (one table lookup each, in display order)
+        groups: dict[str, list[tuple]] = {category: [] for category in NUTRIENT_CATEGORIES}
+        for number, name, value, unit, category in ordered_nutrients(nutrients_to_show):
             if value and value > 0:
-                nutrient_line = f"{name}: {value} {unit}"
-                
-                # Categorize nutrients
-                name_lower = name.lower()
-                if any(macro in name_lower for macro in ["energy", "protein", "carbohydrate", "fat", "lipid", "fiber"]):
-                    macro_nutrients.append(nutrient_line)
-                elif any(vitamin in name_lower for vitamin in ["vitamin", "folate", "niacin", "thiamin", "riboflavin"]):
-                    vitamins.append(nutrient_line)
-                elif any(mineral in name_lower for mineral in ["calcium", "iron", "magnesium", "phosphorus", "potassium", "sodium", "zinc"]):
-                    minerals.append(nutrient_line)
-                else:
-                    other_nutrients.append(nutrient_line)
+                groups[category].append((number, name, value, unit))
+        
+        if output_format != "text":
+            return render_structured({
+                "fdc_id": fdc_id,
+                "description": description,
+                "nutrients": {category: structured_nutrients(entries, output_format)
+                              for category, entries in groups.items() if entries}
+            })
         
         # Format output by category
-        if macro_nutrients:
-            result += "Macronutrients:\n" + "\n".join(f"- {n}" for n in macro_nutrients) + "\n\n"
-        if vitamins:
-            result += "Vitamins:\n" + "\n".join(f"- {n}" for n in vitamins) + "\n\n"
-        if minerals:
-            result += "Minerals:\n" + "\n".join(f"- {n}" for n in minerals) + "\n\n"
-        if other_nutrients:
-            result += "Other Nutrients:\n" + "\n".join(f"- {n}" for n in other_nutrients)
+        sections = [
+            f"{NUTRIENT_CATEGORIES[category]}:\n" + "\n".join(f"- {name}: {value} {unit}" for _, name, value, unit in entries)
+            for category, entries in groups.items() if entries
+        ]
+        result += "\n\n".join(sections)
         
         return result.strip()
         
     except Exception as e:
         return f"Error retrieving nutrient information: {str(e)}"
 
-if __name__ == "__main__":
+# Grams per unit for ingredient quantities given by mass
+MASS_UNITS = {"": 1.0, "g": 1.0, "gram": 1.0, "grams": 1.0, "kg": 1000.0, "mg": 0.001,
+              "oz": 28.3495, "ounce": 28.3495, "ounces": 28.3495, "lb": 453.592, "lbs": 453.592, "pound": 453.592}
+
+_INGREDIENT_PATTERN = re.compile(r"^\s*(\d+)\s*:\s*(\d+\s*/\s*\d+|\d+(?:\.\d*)?|\.\d+)\s*(.*?)\s*$")
+
+def parse_ingredients(ingredients: str) -> list[tuple[int, float, str]]:
+    """Parse "fdc_id:quantity unit" items separated by commas, semicolons or newlines.
+    
+    Raises ValueError naming the first item that does not parse.
+    """
+    parsed = []
+    for item in re.split(r"[,;\n]", ingredients):
+        if not item.strip():
+            continue
+        match = _INGREDIENT_PATTERN.match(item)
+        if match is None:
+            raise ValueError(f"cannot parse ingredient {item.strip()!r}, expected fdc_id:quantity unit (e.g. 171688:150 g)")
+        numerator, _, denominator = match.group(2).partition("/")
+        if denominator and float(denominator) == 0:
+            raise ValueError(f"Invalid quantity in {item.strip()!r}")
+        quantity = float(numerator) / float(denominator) if denominator else float(numerator)
+        parsed.append((int(match.group(1)), quantity, match.group(3).lower()))
+    return parsed
+
+def portion_names(portion: dict[str, Any]) -> list[str]:
+    """Names a household measure of a food can be referred to by ("cup", "cup, chopped", "1 large")."""
+    measure = portion.get("measureUnit") or {}
+    names = [measure.get("name"), measure.get("abbreviation"), portion.get("modifier"), portion.get("portionDescription")]
+    names = [str(name).lower().strip() for name in names if name and name != "undetermined"]
+    # "1 cup" can be asked for as "cup"
+    return names + [name[2:] for name in names if name.startswith("1 ")]
+
+def portion_grams(food: dict[str, Any], quantity: float, unit: str) -> float | None:
+    """Grams of `quantity` `unit` of a food, or None if the food has no such measure.
+    
+    Mass units convert directly; "serving" uses a branded serving size in
+    grams; other units are matched against the food's foodPortions, exactly
+    first and then as a prefix ("cup" matches "cup, chopped").
+    """
+    if unit in MASS_UNITS:
+        return quantity * MASS_UNITS[unit]
+    if unit in ("serving", "servings") and str(food.get("servingSizeUnit", "")).lower() in ("g", "grm"):
+        return quantity * food["servingSize"] if food.get("servingSize") else None
+    singular = unit[:-1] if unit.endswith("s") else unit
+    portions = [(portion_names(portion), portion) for portion in food.get("foodPortions") or [] if portion.get("gramWeight")]
+    for matches in (lambda name: name in (unit, singular), lambda name: name.startswith((unit, singular))):
+        for names, portion in portions:
+            if any(matches(name) for name in names):
+                return quantity * portion["gramWeight"] / (portion.get("amount") or 1)
+    return None
+
+def weighted_nutrient_totals(weights: list[float], amounts: list[list[float]]) -> list[float]:
+    """Column sums of `amounts` (ingredients x nutrients) weighted per ingredient."""
+    if np is not None:
+        return (np.asarray(weights, dtype=np.float64) @ np.asarray(amounts, dtype=np.float64)).tolist()
+    return [math.fsum(weight * row[column] for weight, row in zip(weights, amounts)) for column in range(len(amounts[0]))]
+
+@mcp.tool()
+@instrumented
+async def compute_recipe_nutrients(ingredients: str, servings: float = 1, nutrient_names: str = None,
+                                   output_format: str = "text") -> str:
+    """Compute total and per-serving nutrients of a recipe or meal.
+    
+    All foods are fetched in one batched lookup. Household measures are
+    converted to grams with each food's portion weights.
+    
+    Args:
+        ingredients: Comma-separated "fdc_id:quantity unit" items, e.g. "171688:150 g, 173944:1 cup, 171287:2 large";
+            units are g (default), kg, mg, oz, lb, serving or a measure listed in the food's portions
+        servings: Number of servings the recipe makes
+        nutrient_names: Optional comma-separated list of nutrient names to filter (e.g., "Energy,Protein,Sodium")
+        output_format: 'text' (default), 'json' or 'compact' (JSON with name -> amount maps)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
+    try:
+        try:
+            items = parse_ingredients(ingredients)
+        except ValueError as e:
+            return f"Error: {e}"
+        if not items:
+            return "Error: no ingredients given"
+        if len(items) > MULTI_FOOD_MAX_IDS:
+            return f"Error: Maximum {MULTI_FOOD_MAX_IDS} ingredients allowed per recipe"
+        if servings <= 0:
+            return "Error: servings must be positive"
+        
+        found, missing, failed = await fetch_foods([fdc_id for fdc_id, _, _ in items])
+        
+        # Resolve each ingredient to grams; unresolvable ones are reported, not guessed
+        included: list[tuple[dict[str, Any], float, str, float]] = []
+        excluded: dict[str, str] = {}
+        for fdc_id, quantity, unit in items:
+            food = found.get(fdc_id)
+            if food is None:
+                excluded[str(fdc_id)] = failed.get(fdc_id, "not found")
+                continue
+            grams = portion_grams(food, quantity, unit)
+            if grams is None:
+                measures = sorted({names[0] for names in map(portion_names, food.get("foodPortions") or []) if names})
+                excluded[str(fdc_id)] = f"unknown unit {unit!r}" + (f" (portions: {', '.join(measures)})" if measures else "")
+                continue
+            included.append((food, quantity, unit, grams))
+        if not included:
+            return "No ingredients could be resolved: " + "; ".join(f"{fdc_id}: {reason}" for fdc_id, reason in excluded.items())
+        
+        # One row of amounts (per 100 g) per ingredient, one column per nutrient
+        columns: dict[str, tuple[str, str]] = {}
+        reported: dict[str, int] = {}
+        rows = []
+        for food, _, _, _ in included:
+            amounts = {}
+            for number, name, amount, unit in map(nutrient_fields, food.get("foodNutrients") or []):
+                if number is None or type(amount) not in (int, float):
+                    continue
+                number = str(number)
+                amounts[number] = amount
+                columns.setdefault(number, (name, unit))
+            # Foundation foods report energy only as Atwater factors
+            if "208" not in amounts:
+                energy = amounts.get("958", amounts.get("957"))
+                if energy is not None:
+                    amounts["208"] = energy
+                    columns.setdefault("208", (NUTRIENT_TABLE["208"].name, NUTRIENT_TABLE["208"].unit))
+            for number in amounts:
+                reported[number] = reported.get(number, 0) + 1
+            rows.append(amounts)
+        numbers = list(columns)
+        matrix = [[amounts.get(number, 0.0) for number in numbers] for amounts in rows]
+        totals = weighted_nutrient_totals([grams / 100 for _, _, _, grams in included], matrix) if numbers else []
+        
+        entries = [{"number": number, "name": columns[number][0], "amount": total, "unitName": columns[number][1]}
+                   for number, total in zip(numbers, totals)]
+        if nutrient_names:
+            filter_names = [name.strip().lower() for name in nutrient_names.split(",")]
+            entries = [entry for entry in entries if any(f in str(entry["name"]).lower() for f in filter_names)]
+        groups: dict[str, list[tuple]] = {category: [] for category in NUTRIENT_CATEGORIES}
+        for number, name, total, unit, category in ordered_nutrients(entries):
+            if total > 0:
+                groups[category].append((number, name, total, unit))
+        # Nutrients some ingredients do not report: their totals are a lower bound
+        partial = {number for number in numbers if reported[number] < len(included)}
+        
+        total_grams = sum(grams for _, _, _, grams in included)
+        if output_format != "text":
+            def scaled(entries: list[tuple], divisor: float) -> Any:
+                return structured_nutrients([(number, name, round(total / divisor, 3), unit)
+                                             for number, name, total, unit in entries], output_format)
+            return render_structured(drop_empty({
+                "servings": servings,
+                "total_grams": round(total_grams, 1),
+                "ingredients": structured_rows([drop_empty({
+                    "fdc_id": food.get("fdcId"),
+                    "description": food.get("description"),
+                    "quantity": f"{quantity:g} {unit or 'g'}",
+                    "grams": round(grams, 1)
+                }) for food, quantity, unit, grams in included], output_format),
+                "not_included": excluded or None,
+                "totals": {category: scaled(group, 1) for category, group in groups.items() if group},
+                "per_serving": {category: scaled(group, servings) for category, group in groups.items() if group},
+                "partial": [name for group in groups.values() for number, name, _, _ in group if number in partial] or None
+            }))
+        
+        result = (f"Recipe: {len(included)} ingredients, {total_grams:.1f} g total, "
+                  f"{servings:g} servings ({total_grams / servings:.1f} g each)\n\nIngredients:\n")
+        for food, quantity, unit, grams in included:
+            amount = f"{quantity:g} g" if unit in ("", "g") else f"{quantity:g} {unit} = {grams:.1f} g"
+            result += f"- {food.get('description', 'No description')} (FDC ID: {food.get('fdcId')}): {amount}\n"
+        if excluded:
+            result += "\nNot included:\n" + "\n".join(f"- {fdc_id}: {reason}" for fdc_id, reason in excluded.items()) + "\n"
+        
+        sections = [
+            f"{NUTRIENT_CATEGORIES[category]}:\n" + "\n".join(
+                f"- {name}{'*' if number in partial else ''}: {round(total, 3)} {unit} "
+                f"(per serving: {round(total / servings, 3)} {unit})" for number, name, total, unit in group)
+            for category, group in groups.items() if group
+        ]
+        result += "\n" + "\n\n".join(sections)
+        if any(number in partial for group in groups.values() for number, _, _, _ in group):
+            result += "\n\n* Not reported for every ingredient; the total covers the ingredients that report it"
+        return result.strip()
+    
+    except Exception as e:
+        return f"Error computing recipe nutrients: {str(e)}"
+
+@mcp.tool()
+@instrumented
+async def rank_foods_by_nutrient(expression: str, data_type: str = None, category: str = None, top_k: int = 10,
+                                 ascending: bool = False, output_format: str = "text") -> str:
+    """Rank the foods available locally by a nutrient amount or a ratio of nutrients.
+    
+    Ranks every ingested or cached food (amounts per 100 g) in one pass, so
+    it answers "which foods have the most X" without searching first. Foods
+    lacking a nutrient of the expression are left out.
+    
+    Args:
+        expression: A nutrient or arithmetic over nutrients, e.g. "protein", "protein / energy",
+            "fiber - sugar", "'vitamin c' / calories"; quote names with spaces or use underscores
+        data_type: Optional comma-separated data types to keep (e.g., "Foundation,SR Legacy,Survey")
+        category: Optional text the food category must contain (e.g., "vegetables")
+        top_k: Number of foods to return (max 100)
+        ascending: Rank lowest values first instead of highest
+        output_format: 'text' (default), 'json' or 'compact' (JSON table)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
+    if np is None:
+        return "Error ranking foods: numpy is not installed (install the numpy extra)"
+    try:
+        try:
+            parsed = NutrientExpression(expression)
+        except ValueError as e:
+            return f"Error ranking foods: {e}"
+        top_k = max(1, min(top_k, MAX_RANKED_FOODS))
+        matrix = await get_food_matrix()
+        
+        vectors = matrix.vectors(parsed.terms)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = parsed.evaluate(vectors)
+        rows, candidates = top_rows(scores, matrix.mask(_split_list(data_type), category), top_k, ascending)
+        
+        if not rows.size:
+            return (f"No foods with data for {expression} among {matrix.count} foods available locally. "
+                    "Ingest a bulk download or look foods up first to rank more foods.")
+        
+        units = {label: (NUTRIENT_TABLE[numbers[0]].unit if numbers[0] in NUTRIENT_TABLE
+                         else matrix.units.get(numbers[0], "")) for label, numbers in parsed.terms.items()}
+        ranked = []
+        for row in rows.tolist():
+            food = matrix.foods[row]
+            ranked.append((food, float(scores[row]), {label: float(vector[row]) for label, vector in vectors.items()}))
+        
+        if output_format != "text":
+            return render_structured({
+                "expression": expression,
+                "candidates": candidates,
+                "foods": structured_rows([drop_empty({
+                    "fdc_id": food.fdc_id,
+                    "description": food.description,
+                    "data_type": food.data_type,
+                    "category": food.category,
+                    "score": float(f"{score:.6g}"),
+                    **{f"{label} ({units[label]})" if units[label] else label: float(f"{amount:.6g}")
+                       for label, amount in amounts.items()}
+                }) for food, score, amounts in ranked], output_format)
+            })
+        
+        order = "lowest" if ascending else "highest"
+        result = f"Foods ranked by {expression} ({order} first, per 100 g), top {len(ranked)} of {candidates}:\n\n"
+        for rank, (food, score, amounts) in enumerate(ranked, 1):
+            values = " | ".join(f"{label}: {amount:.4g} {units[label]}".rstrip() for label, amount in amounts.items())
+            result += f"{rank}. {food.description or 'No description'} (FDC ID: {food.fdc_id})\n"
+            result += f"   Score: {score:.4g} | {values}\n"
+            result += f"   Type: {food.data_type or 'N/A'} | Category: {food.category or 'N/A'}\n\n"
+        return result.strip()
+    
+    except Exception as e:
+        return f"Error ranking foods: {str(e)}"
+
+@mcp.tool()
+@instrumented
+async def find_similar_foods(fdc_id: int, top_k: int = 10, metric: str = "cosine", data_type: str = None,
+                             category: str = None, output_format: str = "text") -> str:
+    """Find the foods whose nutrient profile is closest to a given food, e.g. for substitutions.
+    
+    Compares energy, macronutrients, sugars, fiber, cholesterol and key
+    minerals and vitamins (per 100 g), each scaled by its spread across
+    foods, against every food available locally.
+    
+    Args:
+        fdc_id: FoodData Central ID of the food to match
+        top_k: Number of similar foods to return (max 100)
+        metric: 'cosine' (default; similar proportions) or 'euclidean' (similar amounts)
+        data_type: Optional comma-separated data types to keep (e.g., "Foundation,SR Legacy,Survey")
+        category: Optional text the food category must contain (e.g., "vegetables")
+        output_format: 'text' (default), 'json' or 'compact' (JSON table)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        return OUTPUT_FORMAT_ERROR
+    if metric not in SIMILARITY_METRICS:
+        return f"Error: metric must be one of {', '.join(SIMILARITY_METRICS)}"
+    if np is None:
+        return "Error finding similar foods: numpy is not installed (install the numpy extra)"
+    try:
+        matrix = await get_food_matrix()
+        if matrix.find_row(fdc_id) is None:
+            record = await make_usda_request(f"fdc/v1/food/{fdc_id}")
+            if not record:
+                return f"No food found with FDC ID: {fdc_id}"
+            matrix.index(record)
+        index = await get_similarity_index()
+        row = index.matrix.find_row(fdc_id)
+        if row is None or not index.norms[row]:
+            return f"No comparable nutrient data available for FDC ID: {fdc_id}"
+        
+        top_k = max(1, min(top_k, MAX_RANKED_FOODS))
+        rows, distances = index.nearest(row, top_k, metric, index.matrix.mask(_split_list(data_type), category))
+        reference = index.matrix.foods[row]
+        if not rows.size:
+            return f"No similar foods found for {reference.description} among {index.matrix.count} foods available locally"
+        
+        similar = [(index.matrix.foods[r], float(d)) for r, d in zip(rows.tolist(), distances.tolist())]
+        if output_format != "text":
+            return render_structured({
+                "fdc_id": fdc_id,
+                "description": reference.description,
+                "metric": metric,
+                "foods": structured_rows([drop_empty({
+                    "fdc_id": food.fdc_id,
+                    "description": food.description,
+                    "data_type": food.data_type,
+                    "category": food.category,
+                    "distance": float(f"{distance:.6g}")
+                }) for food, distance in similar], output_format)
+            })
+        
+        result = (f"Foods most similar to: {reference.description} (FDC ID: {fdc_id}), "
+                  f"by {metric} distance over {len(SIMILARITY_TERMS)} nutrients\n\n")
+        for rank, (food, distance) in enumerate(similar, 1):
+            result += f"{rank}. {food.description or 'No description'} (FDC ID: {food.fdc_id})\n"
+            result += f"   Distance: {distance:.4g} | Type: {food.data_type or 'N/A'} | Category: {food.category or 'N/A'}\n\n"
+        return result.strip()
+    
+    except Exception as e:
+        return f"Error finding similar foods: {str(e)}"
+
+@mcp.resource("usda://server-stats", name="server_stats", mime_type="application/json")
+def server_stats_resource() -> str:
+    """Latency histograms, upstream status counts and cache statistics of this server."""
+    return json.dumps(collect_server_stats(), indent=2)
+
+@mcp.tool()
+async def server_stats() -> str:
+    """Report server performance statistics.
+    
+    Includes per-tool latency histograms (split into data access and
+    formatting), per-endpoint upstream latency, status codes and response
+    sizes, cache hit ratios, in-flight requests and rate limiter state.
+    
+    Returns:
+        JSON document with the current statistics
+    """
+    return json.dumps(collect_server_stats(), indent=2)
+
+@mcp.custom_route("/health", methods=["GET"])
+async def health(request: Request) -> JSONResponse:
+    """Liveness probe for load balancers.
+    
+    There is no separate draining state: on shutdown uvicorn stops accepting
+    connections first, so a stopping worker simply stops answering probes.
+    """
+    return JSONResponse({"status": "ok", "pid": os.getpid(), "transport": SERVER_TRANSPORT})
+
+def create_http_app():
+    """ASGI app of one HTTP worker process (uvicorn factory).
+    
+    Workers share responses through the persistent SQLite cache and split the
+    API key's request quota between them. With several workers, streamable
+    HTTP runs stateless so any worker can answer any request.
+    """
+    global _process_managed, rate_limiter, prefetcher
+    _process_managed = True
+    if SERVER_WORKERS > 1:
+        rate_limiter = RateLimiter(RATE_LIMIT_PER_HOUR / SERVER_WORKERS, max(1.0, RATE_LIMIT_BURST / SERVER_WORKERS))
+        prefetcher = Prefetcher(PREFETCH_BUDGET / SERVER_WORKERS)
+        mcp.settings.stateless_http = True
+        if not DISK_CACHE_ENABLED:
+            logger.warning("USDA_DISK_CACHE is off: workers will not share cached responses")
+    app = mcp.sse_app() if SERVER_TRANSPORT == "sse" else mcp.streamable_http_app()
+    session_lifespan = app.router.lifespan_context
+    
+    @asynccontextmanager
+    async def lifespan(app) -> AsyncIterator[None]:
+        async with server_resources(), session_lifespan(app):
+            yield
+    
+    app.router.lifespan_context = lifespan
+    return app
+
+def serve_http(transport: str, host: str, port: int, workers: int, shutdown_timeout: float) -> None:
+    """Run the server over HTTP, as `workers` processes sharing one port.
+    
+    On SIGINT/SIGTERM each worker stops accepting connections, lets open
+    requests finish for up to `shutdown_timeout` seconds and then closes
+    its HTTP client and caches.
+    """
+    import uvicorn
+    
+    # Worker processes import this module afresh and read their settings from the environment
+    os.environ["USDA_TRANSPORT"] = transport
+    os.environ["USDA_WORKERS"] = str(workers)
+    uvicorn.run(
+        "main:create_http_app",
+        factory=True,
+        app_dir=str(Path(__file__).resolve().parent),
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=shutdown_timeout
+    )
+
+def main_cli(argv: list[str] = None) -> None:
+    """Command-line entry point: run the server, ingest bulk downloads or build the search index."""
+    parser = argparse.ArgumentParser(description="USDA FoodData Central MCP server")
+    subparsers = parser.add_subparsers(dest="command")
+    ingest = subparsers.add_parser("ingest", help="Ingest FoodData Central bulk downloads for offline use")
+    ingest.add_argument("paths", nargs="+", help="Bulk JSON files (.json/.zip) or CSV downloads (directory/.zip)")
+    ingest.add_argument("--store", default=str(LOCAL_STORE_PATH), help="Path of the local food store")
+    ingest.add_argument("--index", default=str(SEARCH_INDEX_PATH), help="Path of the local search index")
+    ingest.add_argument("--no-index", action="store_true", help="Skip rebuilding the search index")
+    build_index = subparsers.add_parser("build-index", help="Rebuild the local search index from ingested and cached foods")
+    build_index.add_argument("--store", default=str(LOCAL_STORE_PATH), help="Path of the local food store")
+    build_index.add_argument("--index", default=str(SEARCH_INDEX_PATH), help="Path of the local search index")
+    serve = subparsers.add_parser("serve", help="Run one shared server over HTTP for several clients")
+    serve.add_argument("--transport", choices=["streamable-http", "sse"], default=SERVER_TRANSPORT,
+                       help="Streamable HTTP (endpoint /mcp) or legacy SSE (endpoint /sse)")
+    serve.add_argument("--host", default=SERVER_HOST, help="Interface to listen on (0.0.0.0 for the whole network)")
+    serve.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on")
+    serve.add_argument("--workers", type=int, default=SERVER_WORKERS, help="Worker processes sharing the port")
+    serve.add_argument("--shutdown-timeout", type=float, default=SERVER_SHUTDOWN_TIMEOUT,
+                       help="Seconds open requests may take to finish on shutdown")
+    args = parser.parse_args(argv)
+    
+    if args.command == "serve":
+        if args.transport == "sse" and args.workers > 1:
+            parser.error("SSE sessions are bound to one process; use --transport streamable-http with several workers")
+        serve_http(args.transport, args.host, args.port, max(1, args.workers), args.shutdown_timeout)
+        return
+    
+    if args.command == "ingest":
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        store = LocalFoodStore(Path(args.store), readonly=False)
+        try:
+            for path in args.paths:
+                count = ingest_bulk_download(Path(path), store)
+                print(f"Ingested {count} foods from {path}", file=sys.stderr)
+            print(f"Local store {args.store} now holds {len(store)} foods", file=sys.stderr)
+        finally:
+            store.close()
+        if args.no_index:
+            return
+    
+    if args.command in ("ingest", "build-index"):
+        index = build_search_index(Path(args.store), Path(args.index))
+        print(f"Search index {args.index} covers {len(index)} foods", file=sys.stderr)
+        return
+    
     # Initialize and run the server
     mcp.run(transport='stdio')
+
+if __name__ == "__main__":
+    main_cli()